@@ -1 +1,3 @@
-from .apns import ApnsManager, Message, Error, Feedback  # noqa
+from .apns import ApnsManager, Message, TemplateMessage, Environment, Error, Feedback, RawFeedback, FeedbackParser, FlushResult, DeliveryReport  # noqa
+from .grace import AdaptiveGrace  # noqa
+from .window import InFlightWindow  # noqa
@@ -0,0 +1,131 @@
+"""
+An asyncio front end for :class:`~apns_worker.ApnsManager`.
+
+This requires Python 3.5 or later.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+
+from .apns import ApnsManager, Message
+
+
+class AsyncApnsManager(object):
+    """
+    A coroutine-friendly wrapper around :class:`~apns_worker.ApnsManager`.
+
+    The network I/O still happens on the manager's backend. This only makes
+    sure that the event loop is never blocked for long: messages are encoded
+    and queued in the loop's default executor, as are blocking waits. Large
+    messages are queued in chunks, so that the backend can start sending
+    before the whole message is queued. It works with any backend.
+
+    Positional and keyword arguments are passed through to
+    :class:`~apns_worker.ApnsManager`, except for the following.
+
+    :param int chunk_size: The maximum number of tokens to queue at once,
+        which bounds how long the backend waits for the queue lock.
+    :param manager: An existing manager to wrap, instead of creating one.
+    :type manager: :class:`~apns_worker.ApnsManager`
+    :param loop: The event loop to use. Defaults to the running loop.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self.chunk_size = kwargs.pop('chunk_size', 1000)
+        manager = kwargs.pop('manager', None)
+        self._loop = kwargs.pop('loop', None)
+
+        self.manager = manager if (manager is not None) else ApnsManager(*args, **kwargs)
+
+    @property
+    def loop(self):
+        return self._loop if (self._loop is not None) else asyncio.get_event_loop()
+
+    async def send_aps(self, tokens, alert=None, badge=None, sound=None, content_available=None, category=None):
+        """
+        Coroutine version of :meth:`~apns_worker.ApnsManager.send_aps`.
+
+        """
+        payload = ApnsManager._aps_payload(alert, badge, sound, content_available, category)
+        message = await self.loop.run_in_executor(None, Message, tokens, payload)
+
+        return await self.send_message(message)
+
+    async def send_message(self, message):
+        """
+        Queues a message for delivery.
+
+        Building a :class:`~apns_worker.Message` decodes all of its tokens, so
+        build large ones in an executor as well, or use
+        :meth:`~apns_worker.aio.AsyncApnsManager.send_aps`.
+
+        :returns: An :class:`asyncio.Future` that resolves to the message's
+            :class:`~apns_worker.DeliveryReport`. Await it if you care about
+            delivery; queueing is complete either way.
+
+        """
+        future = await self.loop.run_in_executor(None, self._queue_message, message)
+
+        return asyncio.wrap_future(future, loop=self.loop)
+
+    async def flush(self, timeout=None):
+        """
+        Coroutine version of :meth:`~apns_worker.ApnsManager.flush_messages`.
+
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        return await self.loop.run_in_executor(None, self.manager.flush_messages, timeout)
+
+    def feedback(self, batch_size=None, lazy=False):
+        """
+        Retrieves feedback as an asynchronous iterator::
+
+            async for feedback in apns.feedback():
+                ...
+
+        This takes the same arguments as
+        :meth:`~apns_worker.ApnsManager.get_feedback`.
+
+        """
+        return _FeedbackIterator(self.manager, self.loop, batch_size, lazy)
+
+    def _queue_message(self, message):
+        """ Queues a message in chunks. This runs in the executor. """
+        self.manager._ensure_started()
+        queue = self.manager._queue
+        count = len(message._encoded_tokens)
+
+        # The first chunk may be finished before we queue the next, so the
+        # future has to wait for all of them from the start.
+        future = queue.append(message, 0, self.chunk_size, expected=count)
+        for start in range(self.chunk_size, count, self.chunk_size):
+            queue.append(message, start, start + self.chunk_size, expected=0)
+
+        return future
+
+
+class _FeedbackIterator(object):
+    """ Bridges feedback callbacks into an asyncio queue. """
+    _end = object()
+
+    def __init__(self, manager, loop, batch_size, lazy):
+        self._loop = loop
+        self._items = asyncio.Queue()
+
+        self._future = manager.get_feedback(self._put, batch_size=batch_size, lazy=lazy)
+        self._future.add_done_callback(lambda f: self._put(self._end))
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._items.put_nowait, item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._items.get()
+        if item is self._end:
+            self._future.result()
+            raise StopAsyncIteration
+
+        return item
@@ -3,17 +3,26 @@ from __future__ import unicode_literals, absolute_import
 from binascii import hexlify, unhexlify
 from calendar import timegm
 from collections import namedtuple
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from importlib import import_module
 from itertools import repeat
 import json
+from json.encoder import encode_basestring
 import logging
-from struct import unpack
+from string import Formatter
+from struct import Struct, unpack
+from threading import Lock
 
-from six import python_2_unicode_compatible
-from six.moves import map, range
+from six import python_2_unicode_compatible, string_types, text_type
+from six.moves import map, range, zip
+from six.moves.queue import Queue
 
 from .data import Notification
+from . import fork
+from .dispatch import Dispatcher
+from .hooks import Hooks
+from .metrics import Metrics
 from .queue import NotificationQueue
 
 
@@ -33,36 +42,160 @@ class ApnsManager(object):
     :param str key_path: Path to your PEM-encoded APNs client key.
     :param str cert_path: Path to your PEM-encoded APNs client certificate.
 
-    :param str environment: APNs environment: `'sandbox'` or `'production'`.
+    :param environment: APNs environment: `'sandbox'`, `'production'` or an
+        :class:`~apns_worker.Environment` with custom endpoints.
 
     :param str backend_path: Module path to a subclass of
         :class:`apns_worker.backend.base.Backend`. The backend provides the
         network access and concurrency.
 
-    :param int message_grace: Number of seconds to hold on to a delivered
-        message before assuming that it was successful.
+    :param dict backend_options: Extra keyword arguments for the backend,
+        such as the `engine` of an
+        :class:`apns_worker.backend.engine.Backend`.
+
+    :param message_grace: Number of seconds to hold on to a delivered message
+        before assuming that it was successful. This may also be an
+        :class:`~apns_worker.AdaptiveGrace` to tune the grace period according
+        to how long APNs actually takes to report errors.
 
     :param error_handler: An optional function to process delivery errors. The
         function should take one argument, which will be an
-        :class:`~apns_worker.Error`.
+        :class:`~apns_worker.Error`. It's called from the network thread, so
+        wrap it in a :class:`~apns_worker.dispatch.Dispatcher` if it may be
+        slow.
+
+    :param window: An optional limit on the number of unconfirmed
+        notifications or bytes to have on the wire at any time. This bounds the
+        number of notifications that need to be resent when an error occurs.
+    :type window: :class:`~apns_worker.InFlightWindow`
+
+    :param int probe_interval: If given, a deliberately invalid notification
+        will be sent after every `probe_interval` notifications. The error
+        response confirms everything sent before it, which releases those
+        notifications long before `message_grace` expires, at the cost of
+        reconnecting each time. Choose an interval that corresponds to a few
+        seconds of your typical throughput.
+
+    :param int max_attempts: If given, a notification whose delivery has been
+        interrupted this many times is given up on and reported to
+        `error_handler` with the status
+        :attr:`~apns_worker.Error.ERR_TOO_MANY_ATTEMPTS`. This keeps a
+        notification that keeps breaking the connection from being resent
+        forever. Only a processing error, a shutdown or a connection dropped
+        partway through a write counts as an attempt; notifications resent
+        because another one was rejected are not charged.
+
+    :param bool lazy_start: If `True`, the backend won't be started until the
+        manager is first used. This is convenient when the manager is created
+        at import time in a process that will fork before sending anything.
+
+    :param str queue_path: If given, notifications are queued in a
+        :class:`~apns_worker.durable.DurableNotificationQueue` in this
+        directory, so that they survive a restart. Only one process can use
+        the directory at a time, so don't share a manager with a durable
+        queue across a fork.
+
+    A manager is safe to inherit across :func:`os.fork`. The first time it's
+    used in a new process, it abandons the parent's backend and starts a new
+    one with an empty queue, new :attr:`metrics` and its own connection.
+    Notifications queued before the fork are only sent by the parent.
+
+    .. attribute:: metrics
+
+        The :class:`~apns_worker.metrics.Metrics` for this manager's queue and
+        connections. This is replaced after a fork.
+
+    .. attribute:: hooks
+
+        The :class:`~apns_worker.hooks.Hooks` for this manager's queue and
+        connections.
 
     """
     def __init__(self, key_path, cert_path,
                  environment='production',
                  backend_path='apns_worker.backend.threaded.Backend',
-                 message_grace=5, error_handler=None):
-
-        self._queue = NotificationQueue(grace=message_grace)
-        self._backend = self._load_backend(backend_path, environment, key_path, cert_path, error_handler)
-
-        self._backend.start()
-
-    def _load_backend(self, path, environment, key_path, cert_path, error_handler):
+                 message_grace=5, error_handler=None, window=None,
+                 probe_interval=None, max_attempts=None, lazy_start=False, queue_path=None,
+                 backend_options=None):
+
+        self.hooks = Hooks()
+        self._options = {
+            'key_path': key_path,
+            'cert_path': cert_path,
+            'environment': environment,
+            'backend_path': backend_path,
+            'backend_options': backend_options or {},
+            'message_grace': message_grace,
+            'error_handler': error_handler,
+            'window': window,
+            'probe_interval': probe_interval,
+            'max_attempts': max_attempts,
+            'queue_path': queue_path,
+        }
+        self._pid = None
+
+        self._setup()
+
+        if not lazy_start:
+            self._start()
+
+    def _setup(self):
+        options = self._options
+        error_handler = options['error_handler']
+
+        self.metrics = Metrics()
+        queue_kwargs = {
+            'grace': options['message_grace'],
+            'window': options['window'],
+            'probe_interval': options['probe_interval'],
+            'metrics': self.metrics,
+            'hooks': self.hooks,
+            'max_attempts': options['max_attempts'],
+        }
+        if options['queue_path'] is not None:
+            from .durable import DurableNotificationQueue
+            self._queue = DurableNotificationQueue(options['queue_path'], **queue_kwargs)
+        else:
+            self._queue = NotificationQueue(**queue_kwargs)
+
+        if isinstance(error_handler, Dispatcher):
+            self.metrics.gauge('error_dispatch_pending', "Errors waiting for the error handler.",
+                               lambda: error_handler.pending)
+            self.metrics.gauge('error_dispatch_dropped', "Errors dropped because the error handler fell behind.",
+                               lambda: error_handler.dropped)
+        self._backend = self._load_backend(
+            options['backend_path'], options['environment'], options['key_path'], options['cert_path'], error_handler,
+            options['backend_options']
+        )
+
+    def _load_backend(self, path, environment, key_path, cert_path, error_handler, options):
         path, name = path.rsplit('.', 1)
         mod = import_module(path)
         backend_cls = getattr(mod, name)
 
-        return backend_cls(self._queue, environment, key_path, cert_path, error_handler)
+        return backend_cls(self._queue, environment, key_path, cert_path, error_handler, **options)
+
+    def _ensure_started(self):
+        """ Starts the backend if it isn't running in this process. """
+        if self._pid != fork.current_pid():
+            self._start()
+
+    def _start(self):
+        with fork.lock:
+            pid = fork.current_pid()
+            if self._pid == pid:
+                return
+
+            if self._pid is not None:
+                # We've been forked. The backend's threads didn't come with
+                # us and its locks may be held, so we leave it alone (along
+                # with the parent's connection) and start over with an empty
+                # queue. The parent still owns anything it queued.
+                logger.debug("Restarting APNs backend in forked process {0}.".format(pid))
+                self._setup()
+
+            self._backend.start()
+            self._pid = pid
 
     #
     # Client APIs
@@ -89,6 +222,12 @@ class ApnsManager(object):
         :param str category:
 
         """
+        message = Message(tokens, self._aps_payload(alert, badge, sound, content_available, category))
+
+        return self.send_message(message)
+
+    @staticmethod
+    def _aps_payload(alert, badge, sound, content_available, category):
         aps = {}
         if alert is not None:
             aps['alert'] = alert
@@ -101,9 +240,7 @@ class ApnsManager(object):
         if category is not None:
             aps['category'] = category
 
-        message = Message(tokens, {'aps': aps})
-
-        return self.send_message(message)
+        return {'aps': aps}
 
     def send_message(self, message):
         """
@@ -112,26 +249,72 @@ class ApnsManager(object):
         :param message:
         :type message: :class:`~apns_worker.Message`
 
+        :returns: A future that resolves to a
+            :class:`~apns_worker.DeliveryReport` once every token in the
+            message has been delivered (according to the grace period),
+            rejected or expired. Callbacks added to the future run on a backend
+            thread, so they should be quick.
+        :rtype: :class:`concurrent.futures.Future`
+
+        """
+        self._ensure_started()
+
+        return self._queue.append(message)
+
+    def send_messages(self, messages):
         """
-        self._queue.append(message)
+        Queues a batch of messages for delivery.
 
-    def flush_messages(self):
+        This is much more efficient than calling
+        :meth:`~apns_worker.ApnsManager.send_message` repeatedly when sending
+        many distinct messages, such as personalized notifications.
+
+        Unlike :meth:`~apns_worker.ApnsManager.send_message`, this doesn't
+        return delivery futures. Call :meth:`~apns_worker.Message.delivery` on
+        the messages that you want to track.
+
+        :param messages:
+        :type messages: iterable of :class:`~apns_worker.Message`
+
+        """
+        self._ensure_started()
+        self._queue.extend_messages(messages)
+
+    def flush_messages(self, timeout=None):
         """
         Wait until all queued messages have been delivered.
 
         This will not return until all messages have been presumed successful
-        (according to the delivery grace period).
+        (according to the delivery grace period) or the timeout expires.
 
         The only reason to call this is to make sure the queue is empty before
         allowing a process to terminate.
 
+        :param float timeout: The maximum number of seconds to wait (optional).
+
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        self._ensure_started()
+        pending = self._queue.wait_empty(timeout)
+
+        return FlushResult(pending)
+
+    def recent_writes(self):
         """
-        delay = self._queue.purge_expired()
-        while not self._queue.is_empty():
-            self._backend.sleep(delay)
-            delay = self._queue.purge_expired()
+        Returns the most recent notifications written to APNs, oldest first.
+
+        This is useful for working out what led to an error. The threaded
+        backend remembers the last 256 writes.
+
+        :rtype: list of :class:`~apns_worker.recorder.FlightRecord`
 
-    def get_feedback(self, callback):
+        """
+        self._ensure_started()
+
+        return self._backend.recent_writes()
+
+    def get_feedback(self, callback, batch_size=None, lazy=False):
         """
         Start retrieving tokens from the APNs feedback service.
 
@@ -140,10 +323,111 @@ class ApnsManager(object):
 
         :param callback: A function that takes a single
             :class:`~apns_worker.Feedback` object. The callback will be called
-            zero or more times.
+            zero or more times. If this is a
+            :class:`~apns_worker.dispatch.Dispatcher`, records wait for room in
+            its queue instead of following its overflow policy, since they
+            can't be fetched again. The future won't resolve until it has
+            handled every record.
+
+        :param int batch_size: If given, the callback will instead receive
+            lists of up to `batch_size` records. This is much cheaper when
+            processing large volumes of feedback.
+
+        :param bool lazy: If `True`, records will be
+            :class:`~apns_worker.RawFeedback` objects, which only decode the
+            token and timestamp on demand.
+
+        :returns: A future that resolves to the number of records delivered
+            once the feedback service closes the connection. If the connection
+            or the callback fails, the future will hold the exception.
+        :rtype: :class:`concurrent.futures.Future`
 
         """
-        self._backend.start_feedback(callback)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        counter = [0]
+
+        def deliver(item):
+            if isinstance(callback, Dispatcher):
+                callback.submit(item, block=True)
+            else:
+                callback(item)
+            counter[0] += len(item) if (batch_size is not None) else 1
+
+        def done(error):
+            if isinstance(callback, Dispatcher):
+                callback.flush()
+
+            if error is None:
+                future.set_result(counter[0])
+            else:
+                future.set_exception(error)
+
+        self._ensure_started()
+        self._backend.start_feedback(deliver, batch_size=batch_size, lazy=lazy, done=done)
+
+        return future
+
+    def iter_feedback(self, batch_size=None, lazy=False):
+        """
+        Retrieves feedback as a blocking iterator.
+
+        This takes the same arguments as
+        :meth:`~apns_worker.ApnsManager.get_feedback`. Iteration ends when the
+        feedback service closes the connection. If the session fails, the
+        exception is raised from the iterator after the last record.
+
+        Records are buffered without limit until you consume them, so use
+        batches for large volumes.
+
+        """
+        items = Queue()
+        end = object()
+
+        future = self.get_feedback(items.put, batch_size=batch_size, lazy=lazy)
+        future.add_done_callback(lambda f: items.put(end))
+
+        return _drain(items, end, future)
+
+    def save_feedback(self, sink):
+        """
+        Retrieves feedback into a sink.
+
+        :param sink: Destination for the feedback records.
+        :type sink: :class:`~apns_worker.sinks.FeedbackSink`
+
+        :returns: A future that resolves to the number of records received
+            once the sink has been closed.
+        :rtype: :class:`concurrent.futures.Future`
+
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def done(f):
+            try:
+                sink.close()
+                future.set_result(f.result())
+            except Exception as e:
+                future.set_exception(e)
+
+        self.get_feedback(sink.write, batch_size=sink.batch_size, lazy=True).add_done_callback(done)
+
+        return future
+
+
+# Protects the creation and resolution of delivery futures.
+_delivery_lock = Lock()
+
+
+def _drain(items, end, future):
+    """ Yields items from a queue until we get to the end marker. """
+    item = items.get()
+    while item is not end:
+        yield item
+        item = items.get()
+
+    future.result()
 
 
 class Message(object):
@@ -170,6 +454,8 @@ class Message(object):
 
         self._validate()
 
+        self._delivery = self._new_delivery()
+
     def _validate(self):
         self._validate_tokens()
         self._validate_payload()
@@ -180,7 +466,7 @@ class Message(object):
         self._encoded_tokens = list(map(unhexlify, self._tokens))
 
     def _validate_payload(self):
-        self._encoded_payload = json.dumps(self.payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self._encoded_payload = _encode_json(self.payload)
 
     def _validate_expiration(self):
         if self.expiration is not None:
@@ -212,7 +498,7 @@ class Message(object):
     def priority(self):
         return self._priority
 
-    def notifications(self, idents=None):
+    def notifications(self, idents=None, start=0, stop=None):
         """
         Generates a sequence of serializable notifications.
 
@@ -222,13 +508,502 @@ class Message(object):
         :param iterable idents: An optional iterable of 32-bit identifiers for
             the notifications. :func:`itertools.count` is useful here.
 
+        :param int start: Index of the first token to generate.
+        :param int stop: Index after the last token to generate.
+
         """
         if idents is None:
             idents = repeat(None)
 
-        for encoded_token in self._encoded_tokens:
+        encoded_tokens = self._encoded_tokens
+        if (start != 0) or (stop is not None):
+            encoded_tokens = encoded_tokens[start:stop]
+
+        for encoded_token in encoded_tokens:
             yield Notification(self, encoded_token, next(idents))
 
+    def delivery(self):
+        """
+        Returns a future for the delivery of this message.
+
+        The future resolves to a :class:`~apns_worker.DeliveryReport` once
+        every token in the message has been presumed delivered, rejected or
+        expired. Futures are only created on demand, so this costs nothing
+        for messages that nobody is waiting on.
+
+        :rtype: :class:`concurrent.futures.Future`
+
+        """
+        return self._delivery.future()
+
+    def report(self):
+        """
+        Returns the delivery progress of this message so far.
+
+        :rtype: :class:`~apns_worker.DeliveryReport`
+
+        """
+        return self._delivery.report()
+
+    #
+    # Delivery tracking. These are called by the queue with its lock held.
+    #
+
+    def _new_delivery(self):
+        return _Delivery()
+
+    def _track(self, count):
+        """ Adds `count` notifications to track. """
+        if self._delivery.resolved:
+            # Sending a message again starts a new round of tracking.
+            self._delivery = self._new_delivery()
+
+        self._delivery.expected += count
+
+    def _record_sent(self):
+        self._delivery.sent += 1
+
+    def _record_unsent(self):
+        self._delivery.sent -= 1
+
+    def _record_delivered(self):
+        delivery = self._delivery
+        delivery.delivered += 1
+
+        return delivery.is_complete()
+
+    def _record_failed(self, status):
+        delivery = self._delivery
+        delivery.failed += 1
+        delivery.errors[status] = delivery.errors.get(status, 0) + 1
+
+        return delivery.is_complete()
+
+    def _record_expired(self):
+        delivery = self._delivery
+        delivery.expired += 1
+
+        return delivery.is_complete()
+
+    def _is_complete(self):
+        return self._delivery.is_complete()
+
+    def _resolve(self):
+        """ Called by the queue without its lock held. """
+        self._delivery.resolve()
+
+
+class _Delivery(object):
+    """
+    The delivery progress of one round of sending a message.
+
+    This is kept apart from the message so that a durable queue can track
+    notifications that it has rebuilt from its log, after letting go of the
+    original message.
+
+    """
+    __slots__ = ['expected', 'sent', 'delivered', 'failed', 'expired', 'errors', '_future', '_future_set', 'resolved']
+
+    def __init__(self):
+        self.expected = 0
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.expired = 0
+        self.errors = {}
+
+        self._future = None
+        self._future_set = False
+        self.resolved = False
+
+    def report(self):
+        return DeliveryReport(self.sent, self.delivered, self.failed, self.expired, dict(self.errors))
+
+    def is_complete(self):
+        return (self.delivered + self.failed + self.expired >= self.expected)
+
+    def future(self):
+        with _delivery_lock:
+            if self._future is None:
+                self._future = Future()
+                self._future.set_running_or_notify_cancel()
+
+            future = self._future
+            setter = self.resolved and (not self._future_set)
+            if setter:
+                self._future_set = True
+
+        if setter:
+            future.set_result(self.report())
+
+        return future
+
+    def resolve(self):
+        with _delivery_lock:
+            self.resolved = True
+
+            future = self._future
+            setter = (future is not None) and (not self._future_set)
+            if setter:
+                self._future_set = True
+
+        if setter:
+            future.set_result(self.report())
+
+
+class TemplateMessage(Message):
+    """
+    A push notification with a personalized payload for each device.
+
+    The payload is a template: any string in it may contain :meth:`str.format`
+    replacement fields, which are filled in from the corresponding entry of
+    `values` for each token. A string that consists of nothing but a single
+    replacement field is replaced by the value itself, so templates can produce
+    numbers and other JSON types as well as text. Literal braces must be
+    doubled, as usual. Dictionary keys are never formatted.
+
+    The static parts of the payload are encoded once, so each token only costs
+    the encoding of its own values. The resulting frames are identical to
+    those of a :class:`~apns_worker.Message` sent to the same token with the
+    rendered payload (see :meth:`payload_for`).
+
+    :param list tokens: A list of hex-encoded device tokens.
+    :param dict payload: The payload template.
+    :param list values: A dictionary of replacement values for each token.
+    :param datetime expiration: An expiration time (optional).
+    :param int priority: Notification priority (optional).
+
+    All payloads are rendered up front, so missing values will raise
+    exceptions here rather than when the message is sent.
+
+    """
+    def __init__(self, tokens, payload, values, expiration=None, priority=None):
+        self._values = values
+
+        super(TemplateMessage, self).__init__(tokens, payload, expiration, priority)
+
+    def _validate(self):
+        super(TemplateMessage, self)._validate()
+        self._validate_values()
+
+    def _validate_payload(self):
+        fields = []
+        encoded = _encode_json(_compile_template(self.payload, fields))
+
+        # Split the encoded template around each field's marker, which
+        # appears in traversal order.
+        parts = []
+        for i in range(len(fields)):
+            chunks = encoded.split(_encode_json(_template_marker(i)))
+            if len(chunks) != 2:
+                raise ValueError("Payload templates may not contain the characters U+E000 or U+E001.")
+
+            parts.append(chunks[0])
+            encoded = chunks[1]
+        parts.append(encoded)
+
+        self._fields = fields
+        self._encoded_parts = parts
+        self._encoded_payload = None
+
+    def _validate_values(self):
+        if len(self._values) != len(self._encoded_tokens):
+            raise ValueError("A TemplateMessage needs one set of values per token.")
+
+        self._encoded_payloads = list(map(self._render, self._values))
+
+    @property
+    def values(self):
+        return self._values
+
+    def payload_for(self, index):
+        """
+        Returns the rendered payload for one token.
+
+        :param int index: Index of the token.
+
+        :rtype: dict
+
+        """
+        return _render_template(self.payload, self._values[index])
+
+    def notifications(self, idents=None, start=0, stop=None):
+        if idents is None:
+            idents = repeat(None)
+
+        encoded_tokens = self._encoded_tokens
+        encoded_payloads = self._encoded_payloads
+        if (start != 0) or (stop is not None):
+            encoded_tokens = encoded_tokens[start:stop]
+            encoded_payloads = encoded_payloads[start:stop]
+
+        for encoded_token, encoded_payload in zip(encoded_tokens, encoded_payloads):
+            yield Notification(self, encoded_token, next(idents), encoded_payload)
+
+    def _render(self, values):
+        """ Splices encoded values into the static parts of the payload. """
+        parts = self._encoded_parts
+        chunks = [parts[0]]
+
+        for (render, arg), part in zip(self._fields, parts[1:]):
+            chunks.append(_encode_value(render(arg, values)))
+            chunks.append(part)
+
+        return b''.join(chunks)
+
+
+class _EncodedMessage(Message):
+    """
+    A message that only exists in its encoded form, such as one received by
+    the sender daemon or replayed from a durable queue.
+
+    The tokens, payload and expiration are only decoded if someone asks for
+    them, such as an error handler.
+
+    :param list encoded_tokens: Binary device tokens.
+    :param bytes encoded_payload: The payload shared by every token, or
+        `None`.
+    :param list encoded_payloads: One payload for each token, or `None`.
+    :param int expiration: Seconds since the epoch, or `None`.
+    :param int priority: The priority, or `None`.
+
+    """
+    def __init__(self, encoded_tokens, encoded_payload, encoded_payloads=None, expiration=None, priority=None):
+        # Everything is already encoded, so we skip Message's validation.
+        self._encoded_tokens = encoded_tokens
+        self._encoded_payload = encoded_payload
+        self._encoded_payloads = encoded_payloads
+        self._encoded_expiration = expiration
+        self._priority = priority
+
+        self._delivery = self._new_delivery()
+
+    @property
+    def tokens(self):
+        return [hexlify(encoded_token).decode('ascii') for encoded_token in self._encoded_tokens]
+
+    @property
+    def payload(self):
+        if self._encoded_payload is None:
+            return None
+
+        return json.loads(self._encoded_payload.decode('utf-8'))
+
+    @property
+    def expiration(self):
+        if self._encoded_expiration is None:
+            return None
+
+        return datetime.utcfromtimestamp(self._encoded_expiration)
+
+    def notifications(self, idents=None, start=0, stop=None):
+        if self._encoded_payloads is None:
+            for notification in super(_EncodedMessage, self).notifications(idents, start, stop):
+                yield notification
+        else:
+            if idents is None:
+                idents = repeat(None)
+
+            encoded_tokens = self._encoded_tokens[start:stop]
+            encoded_payloads = self._encoded_payloads[start:stop]
+
+            for encoded_token, encoded_payload in zip(encoded_tokens, encoded_payloads):
+                yield Notification(self, encoded_token, next(idents), encoded_payload)
+
+
+# json.dumps() builds a new encoder whenever it's given options.
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def _encode_json(obj):
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+def _encode_value(value):
+    """ _encode_json() with shortcuts for the common field types. """
+    if isinstance(value, text_type):
+        encoded = encode_basestring(value).encode('utf-8')
+    elif type(value) is int:
+        encoded = str(value).encode('ascii')
+    else:
+        encoded = _encode_json(value)
+
+    return encoded
+
+
+_formatter = Formatter()
+
+
+def _template_marker(index):
+    """ A placeholder for a templated field, from the private use area. """
+    return '\ue000{0}\ue001'.format(index)
+
+
+def _format_field(template, values):
+    return template.format(**values)
+
+
+def _get_field(name, values):
+    return values[name]
+
+
+def _lookup_field(name, values):
+    return _formatter.get_field(name, (), values)[0]
+
+
+def _parse_template(template):
+    """
+    Returns a function and argument to render a template string, or `None` if
+    the string has no replacement fields.
+
+    """
+    parsed = list(_formatter.parse(template))
+
+    if all(field_name is None for _, field_name, _, _ in parsed):
+        render = None
+    elif (len(parsed) == 1) and (parsed[0][0] == '') and (parsed[0][2] == '') and (parsed[0][3] is None):
+        name = parsed[0][1]
+        if ('.' in name) or ('[' in name):
+            render = (_lookup_field, name)
+        else:
+            render = (_get_field, name)
+    else:
+        render = (_format_field, template)
+
+    return render
+
+
+def _compile_template(obj, fields):
+    """
+    Returns a copy of a payload template with each templated string replaced by
+    a marker. The corresponding renderers are appended to `fields`.
+
+    """
+    if isinstance(obj, dict):
+        compiled = dict((key, _compile_template(value, fields)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        compiled = [_compile_template(value, fields) for value in obj]
+    elif isinstance(obj, string_types):
+        render = _parse_template(obj)
+        if render is None:
+            compiled = _format_field(obj, {})
+        else:
+            compiled = _template_marker(len(fields))
+            fields.append(render)
+    else:
+        compiled = obj
+
+    return compiled
+
+
+def _render_template(obj, values):
+    """ Renders a payload template the slow way. """
+    if isinstance(obj, dict):
+        rendered = dict((key, _render_template(value, values)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        rendered = [_render_template(value, values) for value in obj]
+    elif isinstance(obj, string_types):
+        render = _parse_template(obj)
+        if render is None:
+            rendered = _format_field(obj, {})
+        else:
+            rendered = render[0](render[1], values)
+    else:
+        rendered = obj
+
+    return rendered
+
+
+class DeliveryReport(namedtuple('DeliveryReport', ['sent', 'delivered', 'failed', 'expired', 'errors'])):
+    """
+    Delivery counts for a single :class:`~apns_worker.Message`.
+
+    .. attribute:: sent
+
+        The number of notifications written to APNs, including resends.
+
+    .. attribute:: delivered
+
+        The number of tokens presumed delivered.
+
+    .. attribute:: failed
+
+        The number of tokens rejected by APNs.
+
+    .. attribute:: expired
+
+        The number of tokens that were dropped without sending because the
+        message expired while they were queued.
+
+    .. attribute:: errors
+
+        A dictionary mapping APNs status codes to the number of tokens rejected
+        with that status.
+
+    """
+
+
+class FlushResult(namedtuple('FlushResult', ['pending'])):
+    """
+    The outcome of :meth:`~apns_worker.ApnsManager.flush_messages`.
+
+    .. attribute:: pending
+
+        The number of notifications that were still queued (sent or not) when
+        the flush returned.
+
+    """
+    @property
+    def complete(self):
+        """ `True` if the queue was drained. """
+        return (self.pending == 0)
+
+
+class Environment(namedtuple('Environment', ['gateway', 'feedback', 'ca_certs'])):
+    """
+    The endpoints of an APNs environment.
+
+    You only need this to talk to something other than Apple, such as
+    :mod:`apns_worker.simulator`.
+
+    .. attribute:: gateway
+
+        The `(host, port)` address of the notification gateway.
+
+    .. attribute:: feedback
+
+        The `(host, port)` address of the feedback service.
+
+    .. attribute:: ca_certs
+
+        Path to the PEM-encoded certificates used to verify the server. If
+        this is `None`, the server will not be verified. The built-in
+        `'production'` and `'sandbox'` environments don't verify Apple's
+        servers, as in earlier versions. To verify them, replace this::
+
+            Environment.get('production')._replace(ca_certs=ca_path)
+
+    """
+    @classmethod
+    def get(cls, environment):
+        """
+        Resolves an environment name.
+
+        :param environment: `'sandbox'`, `'production'` or an
+            :class:`~apns_worker.Environment`, which is returned as-is.
+
+        :rtype: :class:`~apns_worker.Environment`
+
+        """
+        if isinstance(environment, Environment):
+            pass
+        elif environment == 'production':
+            environment = cls(('gateway.push.apple.com', 2195), ('feedback.push.apple.com', 2196), None)
+        else:
+            environment = cls(('gateway.sandbox.push.apple.com', 2195), ('feedback.sandbox.push.apple.com', 2196), None)
+
+        return environment
+
 
 @python_2_unicode_compatible
 class Error(namedtuple('Error', ['status', 'message', 'token'])):
@@ -266,6 +1041,11 @@ class Error(namedtuple('Error', ['status', 'message', 'token'])):
     ERR_TOKEN_INVAL = 8
     ERR_UNKNOWN = 255
 
+    #: Not an APNs status. The notification was given up on after its
+    #: delivery was interrupted `max_attempts` times, typically because the
+    #: connection kept failing while it was in flight.
+    ERR_TOO_MANY_ATTEMPTS = 256
+
     descriptions = {
         ERR_PROCESSING: "Processing error",
         ERR_NO_TOKEN: "Missing device token",
@@ -275,6 +1055,7 @@ class Error(namedtuple('Error', ['status', 'message', 'token'])):
         ERR_TOPIC_SIZE: "Invalid topic size",
         ERR_PAYLOAD_SIZE: "Invalid payload size",
         ERR_TOKEN_INVAL: "Invalid token",
+        ERR_TOO_MANY_ATTEMPTS: "Too many attempts",
     }
 
     def __str__(self):
@@ -328,3 +1109,120 @@ class Feedback(namedtuple('Feedback', ['token', 'when'])):
                 remainder = buf[total_len:]
 
         return (feedback, remainder)
+
+
+class RawFeedback(namedtuple('RawFeedback', ['encoded_token', 'timestamp'])):
+    """
+    A feedback record that hasn't been decoded yet.
+
+    This has the same :attr:`token` and :attr:`when` attributes as
+    :class:`~apns_worker.Feedback`, but they're computed on access. If you only
+    need some of the records, or you're going to store the binary token or the
+    raw timestamp anyway, this saves a lot of work.
+
+    .. attribute:: encoded_token
+
+        The binary device token.
+
+    .. attribute:: timestamp
+
+        The time at which this device stopped receiving notifications, in
+        seconds since the epoch.
+
+    """
+    @property
+    def token(self):
+        return hexlify(self.encoded_token).decode('ascii')
+
+    @property
+    def when(self):
+        return Feedback._epoch + timedelta(seconds=self.timestamp)
+
+    def decode(self):
+        """
+        Returns the equivalent :class:`~apns_worker.Feedback`.
+
+        """
+        return Feedback(self.token, self.when)
+
+
+class FeedbackParser(object):
+    """
+    Incrementally parses the stream from the feedback service.
+
+    Data is accumulated in a single buffer and parsed in place. Consumed bytes
+    are only discarded once enough of them have accumulated, so the cost of
+    parsing is linear in the size of the stream.
+
+    :param bool lazy: If `True`, generate :class:`~apns_worker.RawFeedback`
+        records rather than :class:`~apns_worker.Feedback`.
+
+    :param int compact_at: Number of consumed bytes to accumulate before
+        discarding them.
+
+    """
+    _header = Struct('!IH')
+
+    def __init__(self, lazy=False, compact_at=65536):
+        self.lazy = lazy
+        self.compact_at = compact_at
+
+        self._buf = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        """ The number of unparsed bytes. """
+        return len(self._buf) - self._offset
+
+    def feed(self, data):
+        """
+        Adds data received from the feedback service.
+
+        :param bytes data:
+
+        """
+        self._buf.extend(data)
+
+    def parse(self):
+        """
+        Parses all complete records in the buffer.
+
+        :returns: :class:`~apns_worker.Feedback` or
+            :class:`~apns_worker.RawFeedback` objects.
+        :rtype: list
+
+        """
+        buf = self._buf
+        offset = self._offset
+        end = len(buf)
+        unpack_header = self._header.unpack_from
+
+        records = []
+        append = records.append
+        lazy = self.lazy
+        epoch = Feedback._epoch
+        new = tuple.__new__
+
+        while end - offset >= 6:
+            timestamp, token_len = unpack_header(buf, offset)
+            start = offset + 6
+            stop = start + token_len
+            if stop > end:
+                break
+
+            # Build the tuples directly to skip namedtuple's __new__.
+            if lazy:
+                append(new(RawFeedback, (bytes(buf[start:stop]), timestamp)))
+            else:
+                token = hexlify(buf[start:stop]).decode('ascii')
+                append(new(Feedback, (token, epoch + timedelta(0, timestamp))))
+
+            offset = stop
+
+        if (offset == end) or (offset >= self.compact_at):
+            del buf[:offset]
+            offset = 0
+
+        self._offset = offset
+
+        return records
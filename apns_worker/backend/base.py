@@ -1,7 +1,13 @@
 from abc import ABCMeta, abstractmethod
+import logging
 
 from six import add_metaclass
 
+from apns_worker import apns
+
+
+logger = logging.getLogger(__name__)
+
 
 @add_metaclass(ABCMeta)
 class Backend(object):
@@ -20,7 +26,9 @@ class Backend(object):
 
     .. attribute:: environment
 
-        The APNs environment to talk to (`'sandbox'` or `'production'`).
+        The APNs environment to talk to: `'sandbox'`, `'production'` or an
+        :class:`~apns_worker.Environment`. Use
+        :meth:`apns_worker.Environment.get` to resolve it.
 
     .. attribute:: key_path
 
@@ -59,7 +67,7 @@ class Backend(object):
         """
 
     @abstractmethod
-    def start_feedback(self, callback):
+    def start_feedback(self, callback, batch_size=None, lazy=False, done=None):
         """
         Override this.
 
@@ -67,6 +75,15 @@ class Backend(object):
         more times with a :class:`~apns_worker.Feedback` object as the single
         argument.
 
+        If `batch_size` is given, the callback will instead be called with
+        lists of up to `batch_size` records. If `lazy` is `True`, records will
+        be :class:`~apns_worker.RawFeedback` objects.
+        :class:`~apns_worker.FeedbackParser` implements both options.
+
+        If `done` is given, it must be called exactly once after the last
+        callback, when the connection has been closed. It takes one argument:
+        the exception that ended the session, or `None`.
+
         """
 
     @abstractmethod
@@ -77,6 +94,12 @@ class Backend(object):
         Returns an object compatible with :class:`threading.Lock`. Subclasses
         that don't require locking may return a dummy lock.
 
+        Other than :meth:`~apns_worker.queue.NotificationQueue.has_unclaimed`
+        and :meth:`~apns_worker.queue.NotificationQueue.can_claim`, don't call
+        the queue's methods while holding this lock. They may resolve delivery
+        futures and report errors, whose callbacks can call back into the
+        queue.
+
         """
 
     @abstractmethod
@@ -101,6 +124,74 @@ class Backend(object):
 
         """
 
+    def queue_wait(self, timeout):
+        """
+        Waits for :meth:`~apns_worker.backend.base.Backend.queue_notify`.
+
+        This is always called while the object returned by
+        :meth:`~apns_worker.backend.base.Backend.queue_lock` is acquired and
+        must release it while waiting. It may return early. The default
+        implementation assumes that the lock is a
+        :class:`threading.Condition`.
+
+        :param float timeout: The maximum number of seconds to wait.
+
+        """
+        self.queue_lock().wait(timeout)
+
+    def recent_writes(self):
+        """
+        Returns a record of the most recent notifications written to APNs,
+        oldest first.
+
+        The default implementation doesn't keep any.
+
+        :rtype: list of :class:`~apns_worker.recorder.FlightRecord`
+
+        """
+        return []
+
+    def handle_response(self, status, ident, channel=None):
+        """
+        Processes an error response from APNs.
+
+        This updates the queue, calls the ``response`` hook and reports the
+        error. Backends call it after reading a response and before
+        reconnecting.
+
+        :param int status: The status code from the response.
+        :param int ident: The identifier from the response.
+        :param channel: The channel that the connection claimed notifications
+            for, if any.
+
+        :returns: The notification that the response refers to, if we still
+            have it.
+        :rtype: :class:`~apns_worker.data.Notification` or None
+
+        """
+        queue = self.queue
+        is_shutdown = (status == 10)
+        notification = queue.backtrack(ident, status=(None if is_shutdown else status), channel=channel)
+
+        hook = queue.hooks.response
+        if hook is not None:
+            hook(status, ident, notification)
+
+        if status in [apns.Error.ERR_PROCESSING, apns.Error.ERR_UNKNOWN]:
+            records = self.recent_writes()
+            logger.warning("APNs returned status {0} for notification {1}. The last {2} writes:\n{3}".format(
+                status, ident, len(records), '\n'.join(str(record) for record in records)
+            ))
+
+        if (notification is not None) and notification.is_probe:
+            logger.debug("Probe {0} confirmed delivery.".format(ident))
+        elif (notification is not None) and (not is_shutdown):
+            error = apns.Error(status, notification.message, notification.token)
+            logger.debug("Received response from push service: {0}".format(error))
+            self.delivery_error(error)
+
+        return notification
+
     def delivery_error(self, error):
         """
         Reports a permanent error delivering a message.
@@ -0,0 +1,744 @@
+"""
+A backend that serves any number of queues from a single I/O thread.
+
+The threaded backend runs two threads and a connection for every
+:class:`~apns_worker.ApnsManager`, and each connection drains its own queue
+as fast as it can. This backend instead registers each manager's queue with
+an :class:`~apns_worker.backend.engine.Engine`, which drives all of their
+connections over non-blocking sockets from one thread. The engine takes turns
+between queues that have notifications waiting, claiming at most
+:attr:`~apns_worker.backend.engine.Engine.quantum` from each per turn, so a
+large campaign for one app doesn't hold up the others.
+
+Managers that don't pass an `engine` in `backend_options` share a
+process-wide default::
+
+    ApnsManager(key_path, cert_path, backend_path='apns_worker.backend.engine.Backend')
+
+With an :class:`~apns_worker.scaling.AutoScaler` as the `scaler` option, a
+queue is written over as many connections as it needs.
+
+Error handlers, delivery callbacks and hooks all run on the engine thread, so
+a slow one holds up every queue. Wrap error handlers in a
+:class:`~apns_worker.dispatch.Dispatcher`.
+
+This requires the :mod:`selectors` module (Python 3.4 or later).
+"""
+from collections import deque
+from copy import copy
+import errno
+import logging
+import os
+import selectors
+import socket
+import ssl
+import struct
+from threading import Condition, Event, Lock, Thread, current_thread
+from itertools import count
+import time
+
+from apns_worker import apns, fork
+from apns_worker.recorder import FlightRecorder
+from apns_worker.scaling import AutoScaler
+
+from . import base
+from .threaded import FeedbackThread
+
+
+logger = logging.getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_in_progress = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+class Engine(object):
+    """
+    Drives the gateway connections of any number of
+    :class:`~apns_worker.backend.engine.Backend` instances from one thread.
+
+    The thread starts when the first backend is added. After a fork, the next
+    backend added in the child starts a new thread; backends from the parent
+    are left behind with it.
+
+    """
+    #: The most notifications to claim from one queue per turn.
+    quantum = 64
+
+    #: A connection with this many bytes waiting to be written doesn't get a
+    #: turn.
+    high_water = 65536
+
+    #: The longest to go without checking for expired notifications, in
+    #: seconds.
+    poll_interval = 1.0
+
+    #: Seconds to allow for opening a TLS connection.
+    connect_timeout = 30.0
+
+    #: Seconds to wait before reconnecting after a connection fails. This
+    #: doubles with each consecutive failure, up to :attr:`max_backoff`.
+    backoff = 0.1
+
+    #: The longest to wait before reconnecting, in seconds.
+    max_backoff = 30.0
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pid = None
+        self._thread = None
+        self._backends = []
+        self._removed = []
+        self._turn = 0
+        self._woken = False
+        self._should_terminate = False
+
+    @property
+    def backends(self):
+        """ The backends currently being served. """
+        with self._lock:
+            return list(self._backends)
+
+    def add(self, backend):
+        """ Starts serving a backend's queue. """
+        if self._pid != fork.current_pid():
+            self._lock = Lock()
+
+        with self._lock:
+            if (self._pid != fork.current_pid()) or (self._thread is None) or self._should_terminate:
+                self._start()
+
+            if backend not in self._backends:
+                backend._stopped.clear()
+                self._backends.append(backend)
+
+        self.wake()
+
+    def remove(self, backend):
+        """
+        Stops serving a backend's queue and closes its connection.
+
+        Anything left in the queue stays there.
+
+        """
+        with self._lock:
+            if backend not in self._backends:
+                return
+
+            self._backends.remove(backend)
+            self._removed.append(backend)
+            thread = self._thread
+
+        self.wake()
+
+        if (thread is not None) and (thread is not current_thread()) and thread.is_alive():
+            if not backend._stopped.wait(1):
+                logger.warning("Engine did not close the connection cleanly.")
+
+    def stop(self):
+        """ Closes every connection and stops the thread. """
+        with self._lock:
+            thread = self._thread
+            if (thread is None) or (self._pid != fork.current_pid()):
+                return
+
+            self._should_terminate = True
+
+        self.wake()
+
+        if thread is not current_thread():
+            thread.join(1)
+            if thread.is_alive():
+                logger.warning("Engine thread did not terminate cleanly.")
+
+        with self._lock:
+            if self._thread is thread:
+                self._thread = None
+
+    def wake(self):
+        """
+        Interrupts the engine thread's wait for I/O.
+
+        Backends call this whenever their queue may have changed.
+
+        """
+        if not self._woken:
+            self._woken = True
+            try:
+                self._waker.send(b'\0')
+            except (socket.error, AttributeError):
+                pass
+
+    #
+    # Engine thread
+    #
+
+    def _start(self):
+        # Must be called with the lock held. Anything we inherited belongs to
+        # our parent process.
+        self._pid = fork.current_pid()
+        self._backends = []
+        self._removed = []
+        self._should_terminate = False
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._woken = False
+
+        self._thread = Thread(target=self._run, name='apns-engine')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        logger.debug("Engine thread starting.")
+
+        selector = self._selector
+        while not self._should_terminate:
+            try:
+                timeout = self._service()
+                for key, events in selector.select(timeout):
+                    if key.data is None:
+                        self._drain_wakeup()
+                    else:
+                        key.data.handle(events)
+            except Exception as e:
+                logger.warning("Uncaught exception in engine thread: {0}".format(e))
+
+        self._shutdown()
+
+        logger.debug("Engine thread terminating.")
+
+    def _service(self):
+        """
+        Closes removed backends, takes turns claiming notifications and writes
+        what we can.
+
+        :returns: The number of seconds to wait for I/O.
+
+        """
+        with self._lock:
+            backends = list(self._backends)
+            removed, self._removed = self._removed, []
+
+        for backend in removed:
+            backend._close()
+            backend._stopped.set()
+
+        # Start each round of turns with a different queue.
+        if len(backends) > 1:
+            self._turn = (self._turn + 1) % len(backends)
+            backends = backends[self._turn:] + backends[:self._turn]
+
+        now = _monotonic()
+        ready = [backend for backend in backends if backend._ready(self, now)]
+        while len(ready) > 0:
+            ready = [backend for backend in ready if backend._take_turn(self.quantum, self.high_water)]
+
+        timeout = self.poll_interval
+        for backend in backends:
+            delay = backend._service(self, now)
+            if delay is not None:
+                timeout = min(timeout, delay)
+
+        return max(timeout, 0)
+
+    def _drain_wakeup(self):
+        # Clear the flag after draining, or a wake() in between could leave it
+        # set with nothing to read. A wake() that sees it still set is covered
+        # by the _service() call that follows.
+        try:
+            while len(self._wakeup.recv(4096)) > 0:
+                pass
+        except socket.error:
+            pass
+        self._woken = False
+
+    def _shutdown(self):
+        with self._lock:
+            backends = self._backends + self._removed
+            self._backends = []
+            self._removed = []
+
+        for backend in backends:
+            backend._close()
+            backend._stopped.set()
+
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+
+class Backend(base.Backend):
+    """
+    A backend whose connections are driven by an
+    :class:`~apns_worker.backend.engine.Engine`.
+
+    Pass options in the manager's `backend_options`:
+
+    - `engine`: The :class:`~apns_worker.backend.engine.Engine` to use.
+      Otherwise, the process-wide default is used.
+    - `scaler`: An :class:`~apns_worker.scaling.AutoScaler` to vary the number
+      of connections with the queue. The backend uses a copy. By default, we
+      open one connection when there's something to send and keep it.
+
+    Each connection writes its own share of the queue, so an error response
+    only causes the notifications written after it on the same connection to
+    be resent. Feedback connections are short-lived, so they still get a
+    thread of their own.
+
+    """
+    #: The number of recent writes to keep for
+    #: :meth:`~apns_worker.backend.engine.Backend.recent_writes`.
+    recorder_size = 256
+
+    def __init__(self, *args, **kwargs):
+        engine = kwargs.pop('engine', None)
+        scaler = kwargs.pop('scaler', None)
+
+        super(Backend, self).__init__(*args, **kwargs)
+
+        self.engine = engine if (engine is not None) else default_engine
+        self.scaler = copy(scaler) if (scaler is not None) else AutoScaler(1, 1)
+        self.queue_cond = Condition()
+        self.recorder = FlightRecorder(self.recorder_size)
+
+        # These belong to the engine thread.
+        self.links = []
+        self._written = 0
+        self._failures = 0
+        self._retry_at = 0
+        self._channels = count(1)
+        self._ssl_context = None
+        self._stopped = Event()
+
+        self.queue.metrics.gauge('open_connections', "Gateway connections currently open.",
+                                 lambda: len(self._open_links()))
+
+    def start(self):
+        self.engine.add(self)
+
+    def stop(self):
+        self.engine.remove(self)
+
+    def start_feedback(self, callback, batch_size=None, lazy=False, done=None):
+        thread = FeedbackThread(
+            self.environment, self.key_path, self.cert_path, callback,
+            batch_size=batch_size, lazy=lazy, done=done
+        )
+        thread.start()
+
+    def recent_writes(self):
+        return self.recorder.dump()
+
+    def queue_lock(self):
+        return self.queue_cond
+
+    def queue_notify(self):
+        self.queue_cond.notify_all()
+        self.engine.wake()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    #
+    # Engine thread
+    #
+
+    def _ready(self, engine, now):
+        """ Returns `True` if we can take a turn writing notifications. """
+        return any((len(link.out) < engine.high_water) for link in self._open_links())
+
+    def _take_turn(self, quantum, high_water):
+        """
+        Claims up to `quantum` notifications, each for the connection with the
+        least buffered.
+
+        :returns: `True` if we might have more to write.
+
+        """
+        links = self._open_links()
+        claimed = 0
+
+        while claimed < quantum:
+            link = min(links, key=lambda link: len(link.out))
+            if len(link.out) >= high_water:
+                break
+
+            notification = self.queue.claim(link.channel)
+            if notification is None:
+                break
+
+            link.buffer(notification)
+            claimed += 1
+
+        return (claimed == quantum) and any((len(link.out) < high_water) for link in links)
+
+    def _service(self, engine, now):
+        """
+        Writes anything buffered, purges the queue and opens or closes
+        connections.
+
+        :returns: The number of seconds until we need attention, or `None`.
+
+        """
+        scaler = self.scaler
+
+        for link in list(self.links):
+            if link.is_open:
+                link.flush()
+            elif now - link.opened > engine.connect_timeout:
+                logger.info("Timed out connecting to {0}.".format(link.address))
+                link.close(failed=True)
+
+        links = self._open_links()
+        scaler.record(now, self._written, len(links))
+
+        # Close at most one idle connection at a time, and never one with
+        # anything left to write.
+        # Wait out the grace period as well, so that APNs has had its chance to
+        # report errors for whatever the connection wrote.
+        for link in links:
+            idle = now - link.last_write
+            if (len(link.out) == 0) and (idle >= self.queue.grace) and scaler.should_close(len(links), idle):
+                logger.info("Closing idle connection to {0}.".format(link.address))
+                link.close()
+                break
+
+        delay = self.queue.idle_delay()
+
+        # Add connections one at a time.
+        if len(links) == len(self.links):
+            depth = self.queue.unclaimed_count()
+            if now < self._retry_at:
+                if depth > 0:
+                    delay = min(delay, self._retry_at - now) if (delay is not None) else (self._retry_at - now)
+            elif scaler.should_add(now, len(links), depth):
+                if len(links) > 0:
+                    logger.info("Adding a connection for {0} unclaimed notifications.".format(depth))
+                self._connect(engine)
+
+        if len(self.links) > len(links):
+            delay = min(delay, engine.poll_interval) if (delay is not None) else engine.poll_interval
+
+        return delay
+
+    def _open_links(self):
+        return [link for link in self.links if link.is_open]
+
+    def _connect(self, engine):
+        if self._ssl_context is None:
+            environment = apns.Environment.get(self.environment)
+            self._ssl_context = _ssl_context(self.key_path, self.cert_path, environment.ca_certs)
+
+        try:
+            # With only one connection, there's nothing to tell apart.
+            channel = next(self._channels) if (self.scaler.max_connections > 1) else None
+            self.links.append(Link(self, engine._selector, self._ssl_context, channel))
+        except Exception as e:
+            logger.info("Failed to connect to APNs: {0}".format(e))
+            self._connect_failed()
+
+    def _connected(self):
+        self._failures = 0
+
+    def _connect_failed(self):
+        engine = self.engine
+        self._failures += 1
+        delay = min(engine.backoff * (2 ** (self._failures - 1)), engine.max_backoff)
+        self._retry_at = _monotonic() + delay
+
+    def _closed(self, link):
+        if link in self.links:
+            self.links.remove(link)
+
+    def _close(self):
+        for link in list(self.links):
+            link.close()
+
+
+class Link(object):
+    """
+    A non-blocking connection to the gateway, used by the engine thread.
+
+    Notifications are buffered and written as the socket allows. If the
+    connection closes with notifications still in the buffer, they're returned
+    to the queue. Name resolution blocks the engine thread briefly.
+
+    .. attribute:: address
+
+        The `(host, port)` of the gateway.
+
+    .. attribute:: channel
+
+        Identifies the notifications claimed for this connection.
+
+    """
+    CONNECTING = 'connecting'
+    HANDSHAKING = 'handshaking'
+    OPEN = 'open'
+    CLOSED = 'closed'
+
+    #: The most to hand to the socket at once.
+    write_size = 65536
+
+    def __init__(self, backend, selector, ssl_context, channel=None):
+        environment = apns.Environment.get(backend.environment)
+
+        self.backend = backend
+        self.queue = backend.queue
+        self.metrics = backend.queue.metrics
+        self.hooks = backend.queue.hooks
+        self.address = environment.gateway
+        self.selector = selector
+        self.ssl_context = ssl_context
+        self.channel = channel
+
+        self.state = self.CONNECTING
+        self.opened = _monotonic()
+        self.last_write = self.opened
+        self.out = bytearray()
+        self.inbuf = b''
+
+        # (notification, end offset) for everything not yet fully written.
+        self._unsent = deque()
+        self._buffered = 0
+        self._written = 0
+        self._events = 0
+        self._started = _clock()
+
+        logger.debug("Opening connection to {0}.".format(self.address))
+        family, type_, proto, _, sockaddr = socket.getaddrinfo(
+            self.address[0], self.address[1], 0, socket.SOCK_STREAM
+        )[0]
+        self.sock = socket.socket(family, type_, proto)
+        try:
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex(sockaddr)
+            if err not in _in_progress:
+                raise socket.error(err, os.strerror(err))
+            self._watch(selectors.EVENT_WRITE)
+        except Exception:
+            self.sock.close()
+            raise
+
+    @property
+    def is_open(self):
+        return (self.state == self.OPEN)
+
+    def buffer(self, notification):
+        """ Adds a claimed notification to the outgoing buffer. """
+        hook = self.hooks.before_write
+        if hook is not None:
+            hook(notification)
+
+        frame = notification.frame()
+        self.out += frame
+        self._buffered += len(frame)
+        self._unsent.append((notification, self._buffered))
+        self.backend.recorder.record(notification)
+
+    def handle(self, events):
+        """ Handles readiness reported by the selector. """
+        try:
+            if self.state == self.CONNECTING:
+                self._finish_connecting()
+            elif self.state == self.HANDSHAKING:
+                self._handshake()
+            elif self.state == self.OPEN:
+                if events & selectors.EVENT_READ:
+                    self._read()
+                if (events & selectors.EVENT_WRITE) and self.is_open:
+                    self.flush()
+        except Exception as e:
+            logger.info("Connection to {0} failed: {1}".format(self.address, e))
+            self.close(failed=(self.state != self.OPEN))
+
+    def flush(self):
+        """ Writes as much of the buffer as the socket will take. """
+        if len(self.out) == 0:
+            return
+
+        started = _clock()
+        released = 0
+        try:
+            while len(self.out) > 0:
+                try:
+                    sent = self.sock.send(self.out[:self.write_size])
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                    break
+                except socket.error as e:
+                    if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                        break
+                    raise
+
+                del self.out[:sent]
+                self._written += sent
+                released += self._release_written()
+        except socket.error as e:
+            logger.info("Socket error while writing: {0}.".format(e))
+            self.close()
+            return
+
+        if released > 0:
+            self.metrics.write_seconds.observe(_clock() - started)
+            self.metrics.write_batch_size.observe(released)
+
+        self._watch(selectors.EVENT_READ | (selectors.EVENT_WRITE if (len(self.out) > 0) else 0))
+
+    def close(self, failed=False):
+        """
+        Closes the connection and returns unwritten notifications to the
+        queue.
+
+        :param bool failed: `True` if the connection never opened.
+
+        """
+        if self.state == self.CLOSED:
+            return
+
+        was_open = self.is_open
+        self.state = self.CLOSED
+
+        logger.debug("Closing connection to {0}.".format(self.address))
+
+        if self._events != 0:
+            try:
+                self.selector.unregister(self.sock)
+            except (KeyError, ValueError):
+                pass
+            self._events = 0
+
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+        # Unwritten notifications are the last ones claimed for this
+        # connection. Put them back to be written on another.
+        if len(self._unsent) > 0:
+            notification, end = self._unsent[0]
+            interrupted = (self._written > end - notification.size)
+            self.queue.unclaim_from(notification, self.channel, interrupted)
+            self._unsent.clear()
+        self.out = bytearray()
+
+        self.backend._closed(self)
+
+        if failed:
+            self.backend._connect_failed()
+
+        if was_open:
+            hook = self.hooks.close
+            if hook is not None:
+                hook(self)
+
+    def _finish_connecting(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, os.strerror(err))
+
+        # The TLS socket takes over the file descriptor.
+        self.selector.unregister(self.sock)
+        self._events = 0
+        self.sock = self.ssl_context.wrap_socket(
+            self.sock, server_hostname=self.address[0], do_handshake_on_connect=False
+        )
+        self.state = self.HANDSHAKING
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._watch(selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self._watch(selectors.EVENT_WRITE)
+            return
+
+        self.state = self.OPEN
+        self.backend._connected()
+        self.metrics.connect_seconds.observe(_clock() - self._started)
+        self.metrics.connections.inc()
+
+        hook = self.hooks.connect
+        if hook is not None:
+            hook(self)
+
+        self._watch(selectors.EVENT_READ)
+
+    def _read(self):
+        try:
+            more = self.sock.recv(4096)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            logger.info("Socket error while reading: {0}.".format(e))
+            self.close()
+            return
+
+        if len(more) == 0:
+            self.close()
+            return
+
+        self.inbuf += more
+        if len(self.inbuf) >= 6:
+            # APNs closes the connection after an error response.
+            buf = self.inbuf[:6]
+            self.close()
+            self._handle_response_data(buf)
+
+    def _handle_response_data(self, buf):
+        try:
+            _, status, ident = struct.unpack('!BBI', buf)
+        except Exception as e:
+            logger.warning("Failed to parse APNs response {0!r}: {1}".format(buf, e))
+        else:
+            self.backend.handle_response(status, ident, self.channel)
+
+    def _release_written(self):
+        """ Accounts for notifications that have been completely written. """
+        released = 0
+        hook = self.hooks.after_write
+
+        while (len(self._unsent) > 0) and (self._unsent[0][1] <= self._written):
+            notification, _ = self._unsent.popleft()
+            released += 1
+            if hook is not None:
+                hook(notification)
+
+        if released > 0:
+            self.last_write = _monotonic()
+            self.backend._written += released
+            self.metrics.written.inc(released)
+
+        return released
+
+    def _watch(self, events):
+        if events != self._events:
+            if self._events == 0:
+                self.selector.register(self.sock, events, self)
+            else:
+                self.selector.modify(self.sock, events, self)
+            self._events = events
+
+
+def _ssl_context(key_path, cert_path, ca_certs=None):
+    if ca_certs is not None:
+        context = ssl.create_default_context(cafile=ca_certs)
+    else:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    context.load_cert_chain(cert_path, key_path)
+
+    return context
+
+
+#: The engine used by backends that aren't given one.
+default_engine = Engine()
@@ -1,21 +1,22 @@
 from binascii import hexlify
 from copy import copy
 import logging
-import os.path
 import socket
 import ssl
 import struct
 from threading import Thread, RLock, Condition
 import time
 
-import apns_worker
 from apns_worker import apns
+from apns_worker.recorder import FlightRecorder
 
 from . import base
 
 
 logger = logging.getLogger(__name__)
 
+_clock = getattr(time, 'perf_counter', time.time)
+
 
 class Backend(base.Backend):
     """
@@ -24,6 +25,10 @@ class Backend(base.Backend):
     This uses Python threads to interact with APNs.
 
     """
+    #: The number of recent writes to keep for
+    #: :meth:`~apns_worker.backend.threaded.Backend.recent_writes`.
+    recorder_size = 256
+
     def __init__(self, *args, **kwargs):
         super(Backend, self).__init__(*args, **kwargs)
 
@@ -33,7 +38,7 @@ class Backend(base.Backend):
     def start(self):
         self.thread = ReadThread(
             self, self.environment, self.key_path, self.cert_path,
-            self.queue, self.queue_cond
+            self.queue, self.queue_cond, FlightRecorder(self.recorder_size)
         )
         self.thread.setDaemon(True)
         self.thread.start()
@@ -43,10 +48,18 @@ class Backend(base.Backend):
             self.thread.terminate(wait=True)
             self.thread = None
 
-    def start_feedback(self, callback):
-        thread = FeedbackThread(self.environment, self.key_path, self.cert_path, callback)
+    def start_feedback(self, callback, batch_size=None, lazy=False, done=None):
+        thread = FeedbackThread(
+            self.environment, self.key_path, self.cert_path, callback,
+            batch_size=batch_size, lazy=lazy, done=done
+        )
         thread.start()
 
+    def recent_writes(self):
+        thread = self.thread
+
+        return thread.recorder.dump() if (thread is not None) else []
+
     def queue_lock(self):
         return self.queue_cond
 
@@ -65,25 +78,23 @@ class ReadThread(Thread):
     It runs indefinitely, reconnecting as necessary.
 
     """
-    def __init__(self, backend, environment, key_path, cert_path, queue, queue_cond):
+    def __init__(self, backend, environment, key_path, cert_path, queue, queue_cond, recorder=None):
         super(ReadThread, self).__init__()
 
+        environment = apns.Environment.get(environment)
+
         self.backend = backend
-        self.connection = _new_connection(self._address(environment), key_path, cert_path)
+        self.connection = _new_connection(
+            environment.gateway, key_path, cert_path, environment.ca_certs,
+            metrics=queue.metrics, hooks=queue.hooks
+        )
         self.queue = queue
         self.queue_cond = queue_cond
+        self.recorder = recorder if (recorder is not None) else FlightRecorder()
 
         self.writer = None
         self._should_terminate = False
 
-    def _address(self, environment):
-        if environment == 'production':
-            host = 'gateway.push.apple.com'
-        else:
-            host = 'gateway.sandbox.push.apple.com'
-
-        return (host, 2195)
-
     def terminate(self, wait=True):
         with self.queue_cond:
             self._should_terminate = True
@@ -113,12 +124,17 @@ class ReadThread(Thread):
 
     def wait_for_notification(self):
         """ Blocks until we have a notification to send. """
-        with self.queue_cond:
-            while (not self.queue.has_unclaimed()) and (not self._should_terminate):
-                self.queue_cond.wait()
+        while True:
+            # Purging resolves delivery futures, which must happen without the
+            # lock.
+            delay = self.queue.idle_delay()
+            with self.queue_cond:
+                if self.queue.has_unclaimed() or self._should_terminate:
+                    break
+                self.queue_cond.wait(delay)
 
     def start_writing(self):
-        self.writer = WriteThread(self.connection, self.queue, self.queue_cond)
+        self.writer = WriteThread(self.connection, self.queue, self.queue_cond, self.recorder)
         self.writer.start()
 
     def wait_for_error(self):
@@ -143,12 +159,7 @@ class ReadThread(Thread):
         except Exception as e:
             logger.warning("Failed to parse APNs response {0}: {1}".format(hexlify(buf), e))
         else:
-            is_shutdown = (status == 10)
-            notification = self.queue.backtrack(ident)
-            if (notification is not None) and (not is_shutdown):
-                error = apns.Error(status, notification.message, notification.token)
-                logger.debug("Received response from push service: {0}".format(error))
-                self.backend.delivery_error(error)
+            self.backend.handle_response(status, ident)
 
     def reset(self):
         self.connection.close()
@@ -171,12 +182,15 @@ class WriteThread(Thread):
     when it's ready to start writing again.
 
     """
-    def __init__(self, connection, queue, queue_cond):
+    def __init__(self, connection, queue, queue_cond, recorder=None):
         super(WriteThread, self).__init__()
 
         self.connection = connection
         self.queue = queue
         self.queue_cond = queue_cond
+        self.recorder = recorder if (recorder is not None) else FlightRecorder()
+        self.metrics = queue.metrics
+        self.hooks = queue.hooks
 
         self._should_terminate = False
 
@@ -201,18 +215,38 @@ class WriteThread(Thread):
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Sending {0}".format(notification))
 
+            hook = self.hooks.before_write
+            if hook is not None:
+                hook(notification)
+
+            started = _clock()
             try:
                 self.connection.sendall(notification.frame())
             except Exception:
                 self.queue.unclaim(notification)
                 raise
 
+            self.recorder.record(notification)
+            self.metrics.write_seconds.observe(_clock() - started)
+            self.metrics.write_batch_size.observe(1)
+            self.metrics.written.inc()
+
+            hook = self.hooks.after_write
+            if hook is not None:
+                hook(notification)
+
     def wait_for_notification(self):
-        with self.queue_cond:
+        # Claiming may resolve delivery futures and report errors, so we only
+        # hold the lock to wait.
+        notification = self.claim_notification()
+        while (notification is None) and (not self._should_terminate):
+            # Wake up in time to purge confirmed notifications, which may
+            # reopen the in-flight window.
+            delay = self.queue.idle_delay()
+            with self.queue_cond:
+                if (not self._should_terminate) and (not self.queue.can_claim()):
+                    self.queue_cond.wait(delay)
             notification = self.claim_notification()
-            while (notification is None) and (not self._should_terminate):
-                self.queue_cond.wait()
-                notification = self.claim_notification()
 
         return notification
 
@@ -238,53 +272,79 @@ class FeedbackThread(Thread):
     callback as they arrive. It terminates when the connection is closed from
     the other end.
 
+    If `batch_size` is given, the callback receives lists of records instead.
+    If `done` is given, it's called with `None` or the exception that
+    terminated the thread.
+
     """
-    def __init__(self, environment, key_path, cert_path, callback):
-        super(FeedbackThread, self).__init__()
+    read_size = 65536
 
-        self.connection = _new_connection(self._address(environment), key_path, cert_path)
-        self.callback = callback
-        self.buf = b''
+    def __init__(self, environment, key_path, cert_path, callback, batch_size=None, lazy=False, done=None):
+        super(FeedbackThread, self).__init__()
 
-    def _address(self, environment):
-        if environment == 'production':
-            host = 'feedback.push.apple.com'
-        else:
-            host = 'feedback.sandbox.push.apple.com'
+        environment = apns.Environment.get(environment)
 
-        return (host, 2196)
+        self.connection = _new_connection(environment.feedback, key_path, cert_path, environment.ca_certs)
+        self.callback = callback
+        self.batch_size = batch_size
+        self.done = done
+        self.parser = apns.FeedbackParser(lazy=lazy)
+        self.batch = []
 
     def run(self):
         logger.debug("Feedback thread starting.")
 
-        while not self.connection.is_closed:
-            self.read_more()
-            self.process_buffer()
+        error = None
+        try:
+            while not self.connection.is_closed:
+                self.read_more()
+                self.process_buffer()
+
+            self.flush_batch()
+        except Exception as e:
+            logger.warning("Exception while processing feedback: {0}".format(e))
+            error = e
+        finally:
+            self.connection.close()
+
+        if self.done is not None:
+            self.done(error)
 
         logger.debug("Feedback thread terminating.")
 
     def read_more(self):
-        more = self.connection.recv()
+        more = self.connection.recv(self.read_size)
         if len(more) > 0:
-            self.buf += more
+            self.parser.feed(more)
         else:
             self.connection.close()
 
     def process_buffer(self):
-        feedback, remain = apns.Feedback.parse(self.buf)
-        while feedback is not None:
-            if logger.isEnabledFor(logging.DEBUG):
+        records = self.parser.parse()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for feedback in records:
                 logger.debug("Received feedback: {0}".format(feedback))
 
-            self.callback(feedback)
-            feedback, remain = apns.Feedback.parse(remain)
+        if self.batch_size is None:
+            for feedback in records:
+                self.callback(feedback)
+        else:
+            self.batch.extend(records)
+            while len(self.batch) >= self.batch_size:
+                batch = self.batch[:self.batch_size]
+                del self.batch[:self.batch_size]
+                self.callback(batch)
 
-        self.buf = remain
+    def flush_batch(self):
+        if len(self.batch) > 0:
+            batch, self.batch = self.batch, []
+            self.callback(batch)
 
 
-def _new_connection(address, key_path, cert_path):
+def _new_connection(address, key_path, cert_path, ca_certs=None, metrics=None, hooks=None):
     """ Mock target. """
-    return Connection(address, key_path, cert_path)
+    return Connection(address, key_path, cert_path, ca_certs, metrics, hooks)
 
 
 class Connection(object):
@@ -295,18 +355,25 @@ class Connection(object):
     connection is closed, it can not be reopened. Use the copy module to create
     a shallow copy with a new uninitialized socket.
 
+    If `ca_certs` is given, the server's certificate and host name will be
+    verified. If `metrics` is given, connections are counted and timed. If
+    `hooks` is given, its ``connect`` and ``close`` hooks are called.
+
     """
-    def __init__(self, address, key_path, cert_path):
+    def __init__(self, address, key_path, cert_path, ca_certs=None, metrics=None, hooks=None):
         self.address = address
         self.key_path = key_path
         self.cert_path = cert_path
+        self.ca_certs = ca_certs
+        self.metrics = metrics
+        self.hooks = hooks
 
         self.lock = RLock()
         self._sock = None
         self._is_closed = False
 
     def __copy__(self):
-        return self.__class__(self.address, self.key_path, self.cert_path)
+        return self.__class__(self.address, self.key_path, self.cert_path, self.ca_certs, self.metrics, self.hooks)
 
     def connect(self):
         """ Force connection, if necssary. """
@@ -350,27 +417,72 @@ class Connection(object):
     def close(self):
         with self.lock:
             if self._sock is not None:
+                logger.debug("Closing connection to {0}.".format(self.address))
+
+                # Wake up any thread blocked on this socket. This bypasses the
+                # TLS layer, which other threads may still be using.
+                try:
+                    socket.socket.shutdown(self._sock, socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
                 try:
-                    logger.debug("Closing connection to {0}.".format(self.address))
                     self._sock.close()
                 finally:
                     self._sock = None
 
+                hook = self.hooks.close if (self.hooks is not None) else None
+                if hook is not None:
+                    hook(self)
+
             self._is_closed = True
 
     def sock(self):
         with self.lock:
             if (self._sock is None) and (not self._is_closed):
                 logger.debug("Opening connection to {0}.".format(self.address))
+                started = _clock()
                 sock = socket.create_connection(self.address)
-                sock = ssl.wrap_socket(
-                    sock, self.key_path, self.cert_path,
-                    ssl_version=ssl.PROTOCOL_TLSv1, ca_certs=self.ca_certs()
-                )
+                try:
+                    sock = self.wrap_socket(sock)
+                except Exception:
+                    sock.close()
+                    raise
                 self._sock = sock
 
+                if self.metrics is not None:
+                    self.metrics.connect_seconds.observe(_clock() - started)
+                    self.metrics.connections.inc()
+
+                hook = self.hooks.connect if (self.hooks is not None) else None
+                if hook is not None:
+                    hook(self)
+
         return self._sock
 
-    def ca_certs(self):
-        """ Path to the anchor certs. """
-        return os.path.join(os.path.dirname(apns_worker.__file__), 'certs/anchors.pem')
+    def wrap_socket(self, sock):
+        if hasattr(ssl, 'create_default_context'):
+            return self.ssl_context().wrap_socket(sock, server_hostname=self.address[0])
+
+        # Python 3.3 and 2.7 before 2.7.9 have no SSLContext defaults.
+        sock = ssl.wrap_socket(
+            sock, self.key_path, self.cert_path,
+            cert_reqs=(ssl.CERT_REQUIRED if (self.ca_certs is not None) else ssl.CERT_NONE),
+            ca_certs=self.ca_certs
+        )
+        if (self.ca_certs is not None) and hasattr(ssl, 'match_hostname'):
+            ssl.match_hostname(sock.getpeercert(), self.address[0])
+
+        return sock
+
+    def ssl_context(self):
+        if self.ca_certs is not None:
+            context = ssl.create_default_context(cafile=self.ca_certs)
+        else:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        context.load_cert_chain(self.cert_path, self.key_path)
+
+        return context
@@ -0,0 +1,670 @@
+"""
+A sender daemon shared by local processes.
+
+Every :class:`~apns_worker.ApnsManager` has its own queue and its own
+connection to APNs. A server with dozens of worker processes ends up holding
+dozens of mostly idle connections. Instead, run a single
+:class:`~apns_worker.daemon.SenderDaemon` on each host and have the workers
+submit messages to it over a Unix domain socket with an
+:class:`~apns_worker.daemon.ApnsClient`::
+
+    python -m apns_worker.daemon --socket /run/apns.sock --key key.pem --cert cert.pem
+
+::
+
+    from apns_worker.daemon import ApnsClient
+
+    apns = ApnsClient('/run/apns.sock', error_handler=_log_apns_error)
+    apns.send_aps(tokens, badge=1)
+
+The client has the same sending API as the manager. Messages are encoded in
+the client, so the daemon never parses a payload, and delivery reports and
+errors are sent back to the client that submitted the message.
+
+Every frame on the socket starts with a one-byte command and a four-byte
+length, followed by that many bytes of body. All integers are big-endian.
+
+==========  =========  ====================================================
+Command     Direction  Body
+==========  =========  ====================================================
+1 (send)    to daemon  Message id (4), flags (1), expiration (4), priority
+                       (1), token count (4), the 32-byte tokens and the
+                       payload. With :attr:`TEMPLATED`, the payload is
+                       replaced by one payload per token, each preceded by
+                       a two-byte length.
+8 (error)   to client  Message id (4), status (2) and token (32).
+9 (report)  to client  Message id (4), sent, delivered, failed and expired
+                       counts (4 each), error count (2) and that many
+                       pairs of status (2) and count (4).
+==========  =========  ====================================================
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+from binascii import hexlify, unhexlify
+from concurrent.futures import Future
+from itertools import cycle
+import logging
+import os
+import socket
+import struct
+from threading import Condition, Lock, Thread
+import time
+
+from six.moves import socketserver
+
+from . import fork
+from .apns import ApnsManager, DeliveryReport, Error, FlushResult, Message, _Delivery, _EncodedMessage
+from .dispatch import Dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+SEND = 1
+ERROR = 8
+REPORT = 9
+
+#: Send flags.
+HAS_EXPIRATION = 1
+HAS_PRIORITY = 2
+TEMPLATED = 4
+
+#: The largest frame either side will accept.
+MAX_FRAME = 64 * 1024 * 1024
+
+_frame_header = struct.Struct('!BI')
+_send_header = struct.Struct('!IBIBI')
+_error_body = struct.Struct('!IH32s')
+_report_header = struct.Struct('!IIIIIH')
+_report_error = struct.Struct('!HI')
+_payload_length = struct.Struct('!H')
+
+
+class SenderDaemon(object):
+    """
+    Delivers messages from local clients.
+
+    The daemon listens on a Unix domain socket between :meth:`start` and
+    :meth:`stop`, and is also a context manager. Messages are handed to a
+    pool of :class:`~apns_worker.ApnsManager` instances in turn, each with its
+    own queue and connection.
+
+    :param str path: The path of the socket. An existing file at this path is
+        replaced.
+    :param str key_path: Path to your PEM-encoded APNs client key.
+    :param str cert_path: Path to your PEM-encoded APNs client certificate.
+    :param int connections: The number of managers, and so connections, to
+        spread messages across.
+    :param error_handler: An optional function that's also called with each
+        :class:`~apns_worker.Error`, after it's been sent to the client.
+
+    Any other keyword arguments are passed to each
+    :class:`~apns_worker.ApnsManager`.
+
+    """
+    def __init__(self, path, key_path, cert_path, connections=1, error_handler=None, **kwargs):
+        self.path = path
+        self.error_handler = error_handler
+
+        self.managers = [
+            ApnsManager(key_path, cert_path, error_handler=self._route_error, lazy_start=True, **kwargs)
+            for i in range(connections)
+        ]
+
+        self._next_manager = cycle(self.managers)
+        self._server = None
+        self._lock = Lock()
+        self._clients = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """ Starts listening. """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self._server = _UnixServer(self.path, ClientHandler, self)
+
+        thread = Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.1})
+        thread.daemon = True
+        thread.start()
+
+        logger.debug("Sender daemon listening on {0}.".format(self.path))
+
+    def stop(self, timeout=None):
+        """
+        Stops accepting connections, waits for the queues to drain and
+        disconnects.
+
+        :param float timeout: The maximum number of seconds to wait for each
+            queue (optional).
+
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+        # Connected clients still get their reports.
+        started = [manager for manager in self.managers if manager._pid is not None]
+        for manager in started:
+            manager.flush_messages(timeout)
+
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.replies.flush(timeout)
+            client.disconnect()
+
+        for manager in started:
+            manager._backend.stop()
+
+    @property
+    def clients(self):
+        """ The number of connected clients. """
+        return len(self._clients)
+
+    def submit(self, message):
+        """ Queues a message from a client. """
+        next(self._next_manager).send_messages([message])
+
+    def _route_error(self, error):
+        delivery = getattr(error.message, '_delivery', None)
+        if isinstance(delivery, _RemoteDelivery):
+            delivery.client.send_error(delivery.message_id, error.status, error.token)
+
+        if self.error_handler is not None:
+            self.error_handler(error)
+
+    def _register(self, client):
+        with self._lock:
+            self._clients.add(client)
+
+    def _unregister(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, handler_cls, daemon):
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, handler_cls)
+
+        self.daemon = daemon
+
+
+class ClientHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a single client connection.
+
+    Responses are written from a :class:`~apns_worker.dispatch.Dispatcher`,
+    so the backend's network threads never wait on a slow client. A client
+    that falls :attr:`max_pending_replies` behind is disconnected, which fails
+    its outstanding futures.
+
+    """
+    max_pending_replies = 10000
+
+    def setup(self):
+        self.daemon = self.server.daemon
+        self.replies = Dispatcher(self.write_replies, batch_size=256,
+                                  max_pending=self.max_pending_replies, overflow=Dispatcher.DROP_NEWEST)
+        self.connected = True
+
+    def handle(self):
+        daemon = self.daemon
+
+        daemon._register(self)
+        try:
+            for command, body in _read_frames(self.request):
+                if command == SEND:
+                    daemon.submit(self.parse_message(body))
+                else:
+                    raise ValueError("Unknown command {0}.".format(command))
+        except (socket.error, ValueError, struct.error) as e:
+            logger.warning("Sender daemon client failed: {0}".format(e))
+        finally:
+            daemon._unregister(self)
+            self.disconnect()
+            self.replies.close(timeout=0)
+
+    def parse_message(self, body):
+        message_id, flags, expiration, priority, count = _send_header.unpack_from(body)
+
+        offset = _send_header.size
+        end = offset + count * 32
+        if end > len(body):
+            raise ValueError("Truncated message.")
+        encoded_tokens = [body[start:start + 32] for start in range(offset, end, 32)]
+
+        if flags & TEMPLATED:
+            encoded_payload = None
+            encoded_payloads = []
+            offset = end
+            for i in range(count):
+                length, = _payload_length.unpack_from(body, offset)
+                offset += _payload_length.size
+                encoded_payloads.append(body[offset:offset + length])
+                offset += length
+        else:
+            encoded_payload = body[end:]
+            encoded_payloads = None
+
+        return _RemoteMessage(
+            self, message_id, encoded_tokens, encoded_payload, encoded_payloads,
+            expiration if (flags & HAS_EXPIRATION) else None,
+            priority if (flags & HAS_PRIORITY) else None,
+        )
+
+    def send_error(self, message_id, status, token):
+        body = _error_body.pack(message_id, status, _pad_token(token))
+        self.reply(ERROR, body)
+
+    def send_report(self, message_id, report):
+        header = _report_header.pack(message_id, report.sent, report.delivered, report.failed, report.expired,
+                                     len(report.errors))
+        errors = [_report_error.pack(status, count) for status, count in sorted(report.errors.items())]
+        self.reply(REPORT, header + b''.join(errors))
+
+    def reply(self, command, body):
+        if self.connected:
+            try:
+                queued = self.replies.submit(_frame_header.pack(command, len(body)) + body)
+            except RuntimeError:
+                # The client went away while we were replying.
+                queued = True
+
+            if not queued:
+                # The client has stopped reading. Once a reply is lost, the
+                # client can't trust its pending futures anyway.
+                logger.warning("Disconnecting a sender daemon client that isn't reading its replies.")
+                self.disconnect()
+
+    def write_replies(self, frames):
+        if self.connected:
+            try:
+                self.request.sendall(b''.join(frames))
+            except socket.error as e:
+                logger.debug("Lost sender daemon client: {0}".format(e))
+                self.connected = False
+
+    def disconnect(self):
+        self.connected = False
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _RemoteMessage(_EncodedMessage):
+    """ A message received by the daemon, still in its encoded form. """
+    def __init__(self, client, message_id, encoded_tokens, encoded_payload, encoded_payloads, expiration, priority):
+        self._client = client
+        self._message_id = message_id
+
+        super(_RemoteMessage, self).__init__(encoded_tokens, encoded_payload, encoded_payloads, expiration, priority)
+
+    def _new_delivery(self):
+        return _RemoteDelivery(self._client, self._message_id)
+
+
+class _RemoteDelivery(_Delivery):
+    """
+    Tracks the delivery of a client's message and reports back to it.
+
+    Errors and reports are routed through this rather than the message, which
+    a durable queue may have replaced with one rebuilt from its log.
+
+    """
+    __slots__ = ['client', 'message_id']
+
+    def __init__(self, client, message_id):
+        super(_RemoteDelivery, self).__init__()
+
+        self.client = client
+        self.message_id = message_id
+
+    def resolve(self):
+        super(_RemoteDelivery, self).resolve()
+
+        self.client.send_report(self.message_id, self.report())
+
+
+class ApnsClient(object):
+    """
+    Sends messages through a :class:`~apns_worker.daemon.SenderDaemon`.
+
+    This has the same sending API as :class:`~apns_worker.ApnsManager`. It
+    connects on first use and again after a fork or a lost connection.
+
+    :param str path: The path of the daemon's socket.
+    :param error_handler: An optional function to process delivery errors. It
+        takes an :class:`~apns_worker.Error` for one of this client's messages
+        and is called from the client's reader thread.
+
+    """
+    def __init__(self, path, error_handler=None):
+        self.path = path
+        self.error_handler = error_handler
+
+        self._sock = None
+        self._pid = None
+        self._cond = Condition()
+        self._send_lock = Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._pending_tokens = 0
+
+    def send_aps(self, tokens, alert=None, badge=None, sound=None, content_available=None, category=None):
+        """ See :meth:`ApnsManager.send_aps() <apns_worker.ApnsManager.send_aps>`. """
+        message = Message(tokens, ApnsManager._aps_payload(alert, badge, sound, content_available, category))
+
+        return self.send_message(message)
+
+    def send_message(self, message):
+        """
+        Sends a message to the daemon.
+
+        :type message: :class:`~apns_worker.Message`
+
+        :returns: A future that resolves to a
+            :class:`~apns_worker.DeliveryReport`, or fails with
+            :exc:`socket.error` if the connection to the daemon is lost first.
+            Unlike the manager, :meth:`Message.delivery()
+            <apns_worker.Message.delivery>` isn't resolved.
+        :rtype: :class:`concurrent.futures.Future`
+
+        :raises ValueError: If a device token isn't 32 bytes. The daemon
+            relies on that to split the tokens apart.
+
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        self._send([(message, future)])
+
+        return future
+
+    def send_messages(self, messages):
+        """
+        Sends a batch of messages to the daemon in a single write.
+
+        :type messages: iterable of :class:`~apns_worker.Message`
+
+        :raises ValueError: If a device token isn't 32 bytes. Nothing is sent
+            in that case.
+
+        """
+        self._send([(message, None) for message in messages])
+
+    def flush_messages(self, timeout=None):
+        """
+        Waits until the daemon has reported on every message sent by this
+        client.
+
+        :param float timeout: The maximum number of seconds to wait (optional).
+
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        deadline = (time.time() + timeout) if (timeout is not None) else None
+
+        with self._cond:
+            while self._pending_tokens > 0:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+            return FlushResult(self._pending_tokens)
+
+    def close(self):
+        """ Disconnects from the daemon. Unreported messages fail. """
+        with self._send_lock:
+            sock, self._sock = self._sock, None
+
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _send(self, items):
+        # Tokens are sent back to back, so one of the wrong size would garble
+        # everything after it.
+        for message, _ in items:
+            for encoded in message._encoded_tokens:
+                if len(encoded) != 32:
+                    raise ValueError("Device token {0} is {1} bytes, not 32.".format(
+                        hexlify(encoded).decode('ascii'), len(encoded)
+                    ))
+
+        frames = []
+
+        with self._send_lock:
+            sock = self._connect()
+
+            with self._cond:
+                for message, future in items:
+                    message_id = self._next_id
+                    self._next_id = (message_id + 1) % (2 ** 32)
+                    pending = self._pending[message_id] = _Pending(message, future)
+                    self._pending_tokens += pending.tokens
+                    frames.append(_encode_message(message_id, message))
+
+            try:
+                sock.sendall(b''.join(frames))
+            except socket.error:
+                self._sock = None
+                raise
+
+    def _connect(self):
+        """ Must be called with the send lock held. """
+        if (self._sock is None) or (self._pid != fork.current_pid()):
+            if self._pid != fork.current_pid():
+                # Anything pending belongs to our parent.
+                with self._cond:
+                    self._pending = {}
+                    self._pending_tokens = 0
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+
+            self._sock = sock
+            self._pid = fork.current_pid()
+
+            thread = Thread(target=self._read, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+        return self._sock
+
+    def _read(self, sock):
+        try:
+            for command, body in _read_frames(sock):
+                if command == ERROR:
+                    self._handle_error(body)
+                elif command == REPORT:
+                    self._handle_report(body)
+        except (socket.error, ValueError, struct.error) as e:
+            logger.warning("Lost connection to the sender daemon: {0}".format(e))
+        finally:
+            sock.close()
+            self._lost(sock)
+
+    def _handle_error(self, body):
+        message_id, status, encoded_token = _error_body.unpack(body)
+
+        with self._cond:
+            pending = self._pending.get(message_id)
+
+        if self.error_handler is not None:
+            message = pending.message if (pending is not None) else None
+            try:
+                self.error_handler(Error(status, message, hexlify(encoded_token).decode('ascii')))
+            except Exception as e:
+                logger.warning("Exception in error handler {0!r}: {1}".format(self.error_handler, e))
+
+        if pending is not None:
+            pending.errors += 1
+            self._complete(message_id, pending)
+
+    def _handle_report(self, body):
+        message_id, sent, delivered, failed, expired, count = _report_header.unpack_from(body)
+        errors = dict(
+            _report_error.unpack_from(body, _report_header.size + i * _report_error.size) for i in range(count)
+        )
+
+        with self._cond:
+            pending = self._pending.get(message_id)
+
+        if pending is not None:
+            pending.report = DeliveryReport(sent, delivered, failed, expired, errors)
+            self._complete(message_id, pending)
+
+    def _complete(self, message_id, pending):
+        """
+        Resolves a message once we have its report and all of its errors,
+        which may arrive in either order.
+
+        """
+        report = pending.report
+        if (report is None) or (pending.errors < report.failed):
+            return
+
+        with self._cond:
+            self._pending.pop(message_id, None)
+            self._pending_tokens -= pending.tokens
+            self._cond.notify_all()
+
+        if pending.future is not None:
+            pending.future.set_result(report)
+
+    def _lost(self, sock):
+        """ Fails everything pending on a connection that's gone. """
+        with self._send_lock:
+            if self._sock is sock:
+                self._sock = None
+
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                self._pending_tokens = 0
+                self._cond.notify_all()
+
+        for item in pending.values():
+            if item.future is not None:
+                item.future.set_exception(socket.error("Lost connection to the sender daemon."))
+
+
+class _Pending(object):
+    """ A message sent by a client that the daemon hasn't reported on. """
+    __slots__ = ['message', 'future', 'tokens', 'errors', 'report']
+
+    def __init__(self, message, future):
+        self.message = message
+        self.future = future
+        self.tokens = len(message._encoded_tokens)
+        self.errors = 0
+        self.report = None
+
+
+def _encode_message(message_id, message):
+    """ Returns a send frame for a message. """
+    encoded_payloads = getattr(message, '_encoded_payloads', None)
+    flags = 0
+    if message._encoded_expiration is not None:
+        flags |= HAS_EXPIRATION
+    if message.priority is not None:
+        flags |= HAS_PRIORITY
+    if encoded_payloads is not None:
+        flags |= TEMPLATED
+        payload = b''.join(_payload_length.pack(len(encoded)) + encoded for encoded in encoded_payloads)
+    else:
+        payload = message._encoded_payload
+
+    body = b''.join([
+        _send_header.pack(message_id, flags, message._encoded_expiration or 0, message.priority or 0,
+                          len(message._encoded_tokens)),
+        b''.join(message._encoded_tokens),
+        payload,
+    ])
+
+    return _frame_header.pack(SEND, len(body)) + body
+
+
+def _pad_token(token):
+    """ The error body has room for a 32-byte token. """
+    encoded = unhexlify(token) if token else b''
+
+    return encoded.ljust(32, b'\0')[:32]
+
+
+def _read_frames(sock):
+    """ Yields `(command, body)` from a socket until it closes. """
+    buf = bytearray()
+    header_size = _frame_header.size
+
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buf.extend(data)
+
+        offset = 0
+        while len(buf) - offset >= header_size:
+            command, length = _frame_header.unpack_from(buf, offset)
+            if length > MAX_FRAME:
+                raise ValueError("Frame of {0} bytes is too large.".format(length))
+            if len(buf) - offset - header_size < length:
+                break
+
+            start = offset + header_size
+            yield command, bytes(buf[start:start + length])
+            offset = start + length
+
+        del buf[:offset]
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs a sender daemon for local APNs clients.")
+    parser.add_argument('--socket', required=True, help="Path of the Unix domain socket to listen on.")
+    parser.add_argument('--key', required=True, help="PEM-encoded APNs client key.")
+    parser.add_argument('--cert', required=True, help="PEM-encoded APNs client certificate.")
+    parser.add_argument('--environment', default='production', choices=['production', 'sandbox'])
+    parser.add_argument('--connections', type=int, default=1, help="Number of APNs connections.")
+    parser.add_argument('--grace', type=float, default=5, help="Seconds to hold delivered notifications.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=(logging.DEBUG if args.verbose else logging.INFO))
+
+    daemon = SenderDaemon(
+        args.socket, args.key, args.cert, connections=args.connections,
+        environment=args.environment, message_grace=args.grace,
+    )
+
+    with daemon:
+        print("Listening on {0}".format(args.socket))
+        try:
+            while True:
+                time.sleep(10)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
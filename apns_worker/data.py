@@ -19,15 +19,23 @@ class Notification(object):
 
     :param bytes encoded_token: Binary representation of a device token.
     :param int ident: 32-bit notification identifier.
+    :param bytes encoded_payload: This notification's payload, if it differs
+        from the message's (optional).
 
     """
-    def __init__(self, message, encoded_token, ident):
+    is_probe = False
+
+    def __init__(self, message, encoded_token, ident, encoded_payload=None):
         self.message = message
         self.encoded_token = encoded_token
         self.ident = ident
 
+        if (encoded_payload is None) and (message is not None):
+            encoded_payload = message._encoded_payload
+        self.encoded_payload = encoded_payload
+
     def __str__(self):
-        return "{0} -> {1}".format(self.message._encoded_payload, self.token)
+        return "{0} -> {1}".format(self.encoded_payload, self.token)
 
     @property
     def token(self):
@@ -37,7 +45,40 @@ class Notification(object):
         :rtype: str
 
         """
-        return hexlify(self.encoded_token)
+        return hexlify(self.encoded_token).decode('ascii')
+
+    @property
+    def size(self):
+        """
+        The length of this notification's frame, without rendering it.
+
+        :rtype: int
+
+        """
+        message = self.message
+        size = 5 + 35 + 3 + len(self.encoded_payload)
+
+        if self.ident is not None:
+            size += 7
+        if message._encoded_expiration is not None:
+            size += 7
+        if message.priority is not None:
+            size += 4
+
+        return size
+
+    def is_expired(self, timestamp):
+        """
+        Returns `True` if our message expired before `timestamp`.
+
+        :param int timestamp: Seconds since the epoch.
+
+        :rtype: bool
+
+        """
+        expiration = self.message._encoded_expiration
+
+        return (expiration is not None) and (expiration < timestamp)
 
     def frame(self):
         """
@@ -47,7 +88,7 @@ class Notification(object):
         :rtype: bytes
 
         """
-        encoded_payload = self.message._encoded_payload
+        encoded_payload = self.encoded_payload
         encoded_expiration = self.message._encoded_expiration
         priority = self.message.priority
 
@@ -72,3 +113,41 @@ class Notification(object):
             packed = pack('!BH{0}s'.format(length), item_id, length, data)
 
         return packed
+
+
+@python_2_unicode_compatible
+class ProbeNotification(Notification):
+    """
+    A deliberately invalid notification used as a sync point.
+
+    APNs only responds to a stream of notifications when something goes wrong,
+    and it processes notifications in order. A notification with an empty
+    device token is guaranteed to be rejected, so the error response for one
+    of these confirms that everything sent before it was accepted.
+
+    :param int ident: 32-bit notification identifier.
+
+    """
+    is_probe = True
+
+    def __init__(self, ident):
+        super(ProbeNotification, self).__init__(None, b'', ident)
+
+    def __str__(self):
+        return "Probe {0}".format(self.ident)
+
+    @property
+    def size(self):
+        return len(self.frame())
+
+    def is_expired(self, timestamp):
+        return False
+
+    def frame(self):
+        content = b''.join([
+            pack('!BH', 1, 0),
+            self._pack_data(2, b'{}'),
+            pack('!BHI', 3, 4, self.ident),
+        ])
+
+        return pack('!BI', 2, len(content)) + content
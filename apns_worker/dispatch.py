@@ -0,0 +1,212 @@
+"""
+Calling error and feedback handlers off the network threads.
+
+Error handlers are normally called on the backend's read thread, before it
+reconnects and resends, and feedback callbacks are called between reads. A
+handler that does slow work, such as writing to a database, holds up
+delivery. Wrap it in a :class:`~apns_worker.dispatch.Dispatcher` to run it on
+worker threads of its own::
+
+    from apns_worker.dispatch import Dispatcher
+
+    def save_errors(errors):
+        Device.objects.filter(token__in=[error.token for error in errors]).delete()
+
+    apns = ApnsManager(key_path, cert_path, error_handler=Dispatcher(save_errors, batch_size=100))
+
+Items wait in a bounded queue. When it fills up, the overflow policy decides
+whether to drop the oldest waiting item, drop the new one or make the caller
+wait. Feedback records can't be fetched again, so
+:meth:`~apns_worker.ApnsManager.get_feedback` always waits.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from collections import deque
+import logging
+from threading import Condition, Thread
+import time
+
+from . import fork
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Calls a handler from worker threads.
+
+    A dispatcher is callable, so it can be used anywhere a handler is
+    expected: as the `error_handler` of an :class:`~apns_worker.ApnsManager`
+    or as the callback to :meth:`~apns_worker.ApnsManager.get_feedback`.
+
+    :param handler: The function to call.
+    :param int batch_size: If given, `handler` takes a list of up to this many
+        items instead of one at a time. Batches contain whatever is waiting;
+        they're not held back to fill up.
+    :param int max_pending: The largest number of items to hold.
+    :param str overflow: What to do with a new item when `max_pending` items
+        are already waiting: :attr:`DROP_OLDEST`, :attr:`DROP_NEWEST` or
+        :attr:`BLOCK`. Blocking applies back pressure to the network thread,
+        which is what this is meant to avoid, but never loses anything.
+    :param int workers: The number of worker threads. With more than one,
+        items may be handled out of order.
+
+    After a fork, the first item submitted in the child starts new workers
+    with an empty queue.
+
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+
+    def __init__(self, handler, batch_size=None, max_pending=10000, overflow=DROP_OLDEST, workers=1):
+        if overflow not in [self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK]:
+            raise ValueError("Unknown overflow policy {0!r}.".format(overflow))
+
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.workers = workers
+
+        #: The number of items dropped because the queue was full.
+        self.dropped = 0
+
+        self._closed = False
+        self._start()
+
+    def _start(self):
+        self._pid = fork.current_pid()
+        self._items = deque()
+        self._cond = Condition()
+        self._busy = 0
+
+        self._threads = [Thread(target=self._work) for i in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __call__(self, item):
+        self.submit(item)
+
+    @property
+    def pending(self):
+        """
+        The number of items waiting or being handled. Items in a batch count
+        individually.
+        """
+        return len(self._items) + self._busy
+
+    def submit(self, item, block=False):
+        """
+        Queues an item for the handler.
+
+        :param bool block: If `True`, wait for room in the queue whatever the
+            overflow policy, so that nothing is dropped.
+
+        :returns: `False` if the item was dropped.
+        :rtype: bool
+
+        """
+        if self._pid != fork.current_pid():
+            self._restart()
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Dispatcher is closed.")
+
+            if len(self._items) >= self.max_pending:
+                if block:
+                    while len(self._items) >= self.max_pending:
+                        self._cond.wait()
+                elif self.overflow == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == self.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.max_pending:
+                        self._cond.wait()
+
+            self._items.append(item)
+            self._cond.notify_all()
+
+        return True
+
+    def _restart(self):
+        # Our workers didn't survive a fork. Anything they were holding
+        # belongs to the parent.
+        with fork.lock:
+            if self._pid != fork.current_pid():
+                self._start()
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued item has been handled.
+
+        :param float timeout: The maximum number of seconds to wait (optional).
+
+        :returns: `True` if everything was handled in time.
+        :rtype: bool
+
+        """
+        deadline = (time.time() + timeout) if (timeout is not None) else None
+
+        with self._cond:
+            while self.pending > 0:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+            return (self.pending == 0)
+
+    def close(self, timeout=None):
+        """
+        Handles everything that's queued and stops the workers.
+
+        :param float timeout: The maximum number of seconds to wait for the
+            queue to drain (optional).
+
+        """
+        self.flush(timeout)
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join(1)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while (len(self._items) == 0) and (not self._closed):
+                    self._cond.wait()
+
+                if len(self._items) == 0:
+                    break
+
+                if self.batch_size is None:
+                    count = 1
+                    work = self._items.popleft()
+                else:
+                    count = min(self.batch_size, len(self._items))
+                    work = [self._items.popleft() for i in range(count)]
+
+                self._busy += count
+                self._cond.notify_all()
+
+            try:
+                self.handler(work)
+            except Exception as e:
+                logger.warning("Exception in dispatched handler {0!r}: {1}".format(self.handler, e))
+            finally:
+                with self._cond:
+                    self._busy -= count
+                    self._cond.notify_all()
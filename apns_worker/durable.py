@@ -0,0 +1,698 @@
+"""
+A notification queue that survives restarts.
+
+:class:`~apns_worker.queue.NotificationQueue` only lives in memory, so a
+deploy or a crash in the middle of a large campaign loses everything that
+hasn't been sent, and the whole backlog has to fit in memory at once.
+:class:`~apns_worker.durable.DurableNotificationQueue` writes every
+notification to an append-only log of memory-mapped segment files before
+queueing it, and records how far into the log everything has been
+acknowledged. When it's opened again, it replays whatever hadn't been
+acknowledged. Pass `queue_path` to :class:`~apns_worker.ApnsManager` to use
+it::
+
+    apns = ApnsManager(key_path, cert_path, queue_path='/var/spool/apns')
+
+Only a limited number of notifications are held in memory. The rest wait
+only in the log, with nothing but their message's delivery progress kept in
+memory, and are read back as the queue drains. Notifications read back from
+the log belong to a message rebuilt from it, so errors for them are reported
+with that message rather than the one you sent. Delivery futures and reports
+are unaffected.
+
+A notification is acknowledged once it's presumed delivered (according to
+the grace period), rejected or expired. Delivery is at least once: anything
+written but not yet acknowledged when the process stops is sent again.
+Delivery futures and reports don't survive a restart.
+
+By default the log is written through the operating system's page cache,
+which protects against the process dying but not the machine. Pass
+`sync=True` to flush each batch of writes to disk, at a considerable cost in
+throughput.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from collections import deque
+import itertools
+from itertools import repeat
+import logging
+import mmap
+import os
+import os.path
+import struct
+from zlib import crc32
+
+from six.moves import map, range, zip
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .apns import _Delivery, _EncodedMessage
+from .queue import NotificationQueue, QueuedNotification, _monotonic
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The default size of each segment file, in bytes.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+_record_header = struct.Struct('!II')
+_record_body = struct.Struct('!IBBH')
+_acked = struct.Struct('!Q')
+
+_HAS_EXPIRATION = 1
+_HAS_PRIORITY = 2
+
+
+class DurableNotificationQueue(NotificationQueue):
+    """
+    A :class:`~apns_worker.queue.NotificationQueue` backed by a
+    :class:`~apns_worker.durable.SegmentLog`.
+
+    :param str path: The directory for the log. It's created if necessary,
+        and only one queue may use it at a time.
+    :param grace: As for :class:`~apns_worker.queue.NotificationQueue`.
+    :param int memory_limit: The number of unclaimed notifications to hold in
+        memory. More are loaded from the log, up to
+        :attr:`~apns_worker.durable.DurableNotificationQueue.load_batch` at a
+        time, when the queue falls to half of this.
+    :param int segment_size: The size of each segment file, in bytes.
+    :param bool sync: If `True`, flush the log to disk after each write.
+
+    Other keyword arguments are passed to
+    :class:`~apns_worker.queue.NotificationQueue`. Unacknowledged
+    notifications in the log are queued immediately.
+
+    """
+    def __init__(self, path, grace, memory_limit=100000, segment_size=SEGMENT_SIZE, sync=False, **kwargs):
+        self._log = SegmentLog(path, segment_size, sync)
+        self._memory_limit = memory_limit
+
+        # Runs of notifications that are only in the log so far, oldest first.
+        self._spilled = deque()
+        self._spilled_count = 0
+
+        # Set when errors on one connection send its notifications back ahead
+        # of newer ones still claimed by another, so that the oldest pending
+        # notification is no longer at the front.
+        self._reordered = False
+        self._rescan_at = 0
+
+        super(DurableNotificationQueue, self).__init__(grace, **kwargs)
+
+        self.metrics.gauge('spilled_depth', "Notifications waiting in the log to be loaded.",
+                           lambda: self._spilled_count)
+
+        self._replay()
+
+    @property
+    def log(self):
+        """ Our :class:`~apns_worker.durable.SegmentLog`. """
+        return self._log
+
+    #: The most notifications to read back from the log at once. Reading
+    #: happens in :meth:`claim` with the queue lock held, so this bounds how
+    #: long senders and the backend may have to wait for it.
+    load_batch = 1000
+
+    #: The least number of seconds between searches for the oldest pending
+    #: notification, while the queue is out of order.
+    rescan_interval = 1.0
+
+    def claim(self, channel=None):
+        if (self._spilled_count > 0) and (len(self._unclaimed) <= self._memory_limit // 2):
+            with self._backend.queue_lock():
+                self._load_spilled()
+
+        return super(DurableNotificationQueue, self).claim(channel)
+
+    def unclaim_from(self, notification, channel=None, interrupted=False):
+        restored = super(DurableNotificationQueue, self).unclaim_from(notification, channel, interrupted)
+
+        if (restored > 0) and (channel is not None):
+            with self._backend.queue_lock():
+                self._reordered = True
+
+        return restored
+
+    def backtrack(self, ident, status=None, channel=None):
+        notification = super(DurableNotificationQueue, self).backtrack(ident, status, channel)
+
+        with self._backend.queue_lock():
+            if channel is not None:
+                self._reordered = True
+            self._acknowledge()
+
+        return notification
+
+    def has_unclaimed(self):
+        with self._backend.queue_lock():
+            has_unclaimed = (len(self._unclaimed) > 0) or (self._spilled_count > 0)
+
+        return has_unclaimed
+
+    def unclaimed_count(self):
+        with self._backend.queue_lock():
+            count = len(self._unclaimed) + self._spilled_count
+
+        return count
+
+    def close(self):
+        """ Closes the log. The queue can't be used after this. """
+        with self._backend.queue_lock():
+            self._log.close()
+
+    #
+    # Internal
+    #
+
+    def _len(self):
+        return len(self._claimed) + len(self._unclaimed) + self._spilled_count
+
+    def _enqueue(self, message, idents, count, start, stop, queued):
+        seq = self._log.append(_records(message, start, start + count))
+
+        if len(self._spilled) == 0:
+            loaded = max(min(count, self._memory_limit - len(self._unclaimed)), 0)
+        else:
+            loaded = 0
+
+        if loaded > 0:
+            self._unclaimed.extend(map(
+                LoggedNotification, message.notifications(idents, start, start + loaded), queued, itertools.count(seq)
+            ))
+
+        if loaded < count:
+            # We only keep the delivery progress, so the message itself can
+            # be freed.
+            self._spilled.append(_SpilledRun(message._delivery, seq + loaded, count - loaded, next(queued)))
+            self._spilled_count += count - loaded
+
+    def _load_spilled(self):
+        """
+        Must be called with the lock held.
+
+        Reads up to `load_batch` spilled notifications back from the log.
+
+        """
+        room = min(self._memory_limit - len(self._unclaimed), self.load_batch)
+
+        while (room > 0) and (len(self._spilled) > 0):
+            run = self._spilled[0]
+            loaded = min(room, run.count)
+            idents = self._reserve_idents(loaded)
+
+            for seq, message in _group_records(self._log.read(run.seq, loaded)):
+                message._delivery = run.delivery
+                self._unclaimed.extend(map(
+                    LoggedNotification, message.notifications(idents), repeat(run.queued), itertools.count(seq)
+                ))
+
+            run.seq += loaded
+            run.count -= loaded
+            room -= loaded
+            self._spilled_count -= loaded
+
+            if run.count == 0:
+                self._spilled.popleft()
+
+    def _drop_expired(self):
+        before = len(self._unclaimed)
+        super(DurableNotificationQueue, self)._drop_expired()
+        if len(self._unclaimed) < before:
+            self._acknowledge()
+
+    def _drop_exhausted(self):
+        before = len(self._unclaimed)
+        super(DurableNotificationQueue, self)._drop_exhausted()
+        if len(self._unclaimed) < before:
+            self._acknowledge()
+
+    def _purge_expired(self, _now):
+        before = len(self._claimed)
+        delay = super(DurableNotificationQueue, self)._purge_expired(_now)
+        if (len(self._claimed) < before) or self._reordered:
+            self._acknowledge()
+
+        return delay
+
+    def _acknowledge(self):
+        """
+        Must be called with the lock held.
+
+        Everything before the oldest notification still in the queue is
+        finished with, one way or another.
+
+        """
+        if (len(self._claimed) == 0) and (len(self._unclaimed) == 0):
+            self._reordered = False
+
+        if not self._reordered:
+            self._log.ack(self._first_pending_seq())
+        elif _monotonic() >= self._rescan_at:
+            # Acknowledging late is always safe, so we don't search on every
+            # call. Purging tries again until the queue is back in order.
+            self._log.ack(self._oldest_pending_seq())
+            self._rescan_at = _monotonic() + self.rescan_interval
+
+    def _first_pending_seq(self):
+        """
+        Must be called with the lock held.
+
+        Returns the sequence number of the first notification in the queue.
+        This is the oldest unless the queue is out of order.
+
+        """
+        for queue in [self._claimed, self._unclaimed]:
+            for queued in queue:
+                seq = getattr(queued, 'seq', None)
+                if seq is not None:
+                    return seq
+
+        return self._next_unloaded_seq()
+
+    def _oldest_pending_seq(self):
+        """
+        Must be called with the lock held.
+
+        Searches the whole queue for the oldest notification, and notes
+        whether the queue is back in order.
+
+        """
+        oldest = self._next_unloaded_seq()
+        previous = -1
+        ordered = True
+
+        for queued in itertools.chain(self._claimed, self._unclaimed):
+            seq = getattr(queued, 'seq', None)
+            if seq is not None:
+                oldest = min(oldest, seq)
+                ordered = ordered and (seq > previous)
+                previous = seq
+
+        self._reordered = not ordered
+
+        return oldest
+
+    def _next_unloaded_seq(self):
+        """
+        Must be called with the lock held.
+
+        Spilled notifications are always newer than those in memory.
+
+        """
+        if len(self._spilled) > 0:
+            return self._spilled[0].seq
+
+        return self._log.next_seq
+
+    def _replay(self):
+        """
+        Queues the unacknowledged records in the log. They're read as they're
+        needed, like any other spilled notifications.
+
+        """
+        first = self._log.acked
+        count = max(self._log.next_seq - first, 0)
+
+        if count > 0:
+            # Nobody is waiting on these, but the queue tracks delivery all the
+            # same.
+            delivery = _Delivery()
+            delivery.expected = count
+
+            with self._backend.queue_lock():
+                self._spilled.append(_SpilledRun(delivery, first, count, _monotonic()))
+                self._spilled_count += count
+
+                self.metrics.appended.inc(count)
+                self._load_spilled()
+
+            logger.info("Replaying {0} unacknowledged notifications from {1}.".format(self._len(), self._log.path))
+
+
+class LoggedNotification(QueuedNotification):
+    """ A queued notification with its position in the log. """
+    __slots__ = ['seq']
+
+    def __init__(self, notification, queued, seq):
+        super(LoggedNotification, self).__init__(notification, queued)
+        self.seq = seq
+
+
+class _SpilledRun(object):
+    """
+    `count` notifications in the log, starting at `seq`, and the delivery
+    progress of the message that they belong to.
+
+    """
+    __slots__ = ['delivery', 'seq', 'count', 'queued']
+
+    def __init__(self, delivery, seq, count, queued):
+        self.delivery = delivery
+        self.seq = seq
+        self.count = count
+        self.queued = queued
+
+
+class SegmentLog(object):
+    """
+    An append-only log of notification records in memory-mapped segment
+    files.
+
+    Each record has a sequence number, counting from zero when the log is
+    created. Records are appended to the newest segment until it's full.
+    Segments are named after their first sequence number and deleted once
+    every record in them has been acknowledged. Each record carries a CRC,
+    so a record torn by a crash is discarded, along with anything after it.
+
+    :param str path: The directory for the segments.
+    :param int segment_size: The size of each segment file, in bytes.
+    :param bool sync: If `True`, flush to disk after each append and
+        acknowledgement.
+
+    .. attribute:: acked
+
+        Every record before this sequence number has been acknowledged.
+
+    .. attribute:: next_seq
+
+        The sequence number of the next record to be appended.
+
+    """
+    def __init__(self, path, segment_size=SEGMENT_SIZE, sync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._lock_file = _lock(os.path.join(path, 'lock'))
+        self._ack_file, self._ack_map = _map(os.path.join(path, 'acked'), _acked.size)
+        self.acked = _acked.unpack_from(self._ack_map)[0]
+
+        names = sorted(name for name in os.listdir(path) if name.endswith('.log'))
+        self._segments = [_Segment(os.path.join(path, name), int(name[:-4])) for name in names]
+        if len(self._segments) == 0:
+            self._segments.append(self._new_segment(self.acked))
+
+        last = self._segments[-1]
+        self.next_seq = last.first_seq + last.count
+
+        # Where the last read stopped: (seq, segment, offset).
+        self._cursor = None
+
+        self._reclaim()
+
+    def append(self, records):
+        """
+        Appends records.
+
+        :param records: `(encoded_token, encoded_payload, expiration,
+            priority)` tuples. `expiration` and `priority` may be `None`.
+
+        :returns: The sequence number of the first record.
+        :rtype: int
+
+        :raises ValueError: If a record is too large for a segment. The
+            records before it are still appended.
+
+        """
+        first = self.next_seq
+        segment = self._segments[-1]
+        touched = [segment]
+        chunk = []
+        end = segment.end
+
+        for encoded_token, encoded_payload, expiration, priority in records:
+            flags = 0
+            if expiration is not None:
+                flags |= _HAS_EXPIRATION
+            if priority is not None:
+                flags |= _HAS_PRIORITY
+            body = b''.join([
+                _record_body.pack(expiration or 0, priority or 0, flags, len(encoded_token)), encoded_token, encoded_payload
+            ])
+            record = _record_header.pack(len(body), crc32(body) & 0xffffffff) + body
+
+            if end + len(record) > segment.size:
+                if len(record) > self.segment_size:
+                    segment.write(chunk)
+                    raise ValueError("A {0} byte record won't fit in a segment.".format(len(body)))
+
+                segment.write(chunk)
+                segment = self._new_segment(self.next_seq)
+                self._segments.append(segment)
+                touched.append(segment)
+                chunk = []
+                end = segment.end
+
+            chunk.append(record)
+            end += len(record)
+            self.next_seq += 1
+
+        segment.write(chunk)
+
+        if self.sync:
+            for segment in touched:
+                segment.flush()
+
+        return first
+
+    def ack(self, seq):
+        """ Records that everything before `seq` has been acknowledged. """
+        if seq > self.acked:
+            self.acked = seq
+            _acked.pack_into(self._ack_map, 0, seq)
+            if self.sync:
+                self._ack_map.flush()
+
+            self._reclaim()
+
+    def replay(self):
+        """
+        Yields the unacknowledged records, oldest first.
+
+        :returns: `(seq, encoded_token, encoded_payload, expiration,
+            priority)` tuples.
+
+        """
+        return self.read(self.acked, max(self.next_seq - self.acked, 0))
+
+    def read(self, seq, count):
+        """
+        Yields `count` records, starting with `seq`.
+
+        Reading on from where the previous read stopped doesn't have to search
+        for the first record.
+
+        :returns: `(seq, encoded_token, encoded_payload, expiration,
+            priority)` tuples.
+
+        :raises ValueError: If a record isn't in the log.
+
+        """
+        stop = seq + count
+
+        while seq < stop:
+            segment, offset = self._seek(seq)
+            for body, offset in segment.records(offset, min(stop, segment.first_seq + segment.count) - seq):
+                expiration, priority, flags, token_size = _record_body.unpack_from(body)
+                payload_start = _record_body.size + token_size
+                record = (
+                    seq, body[_record_body.size:payload_start], body[payload_start:],
+                    expiration if (flags & _HAS_EXPIRATION) else None,
+                    priority if (flags & _HAS_PRIORITY) else None,
+                )
+                seq += 1
+                self._cursor = (seq, segment, offset)
+
+                yield record
+
+    @property
+    def segments(self):
+        """ The number of segment files. """
+        return len(self._segments)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+        self._ack_map.close()
+        self._ack_file.close()
+        self._lock_file.close()
+
+    def _seek(self, seq):
+        """ Returns the segment holding a record and the record's offset. """
+        if (self._cursor is not None) and (self._cursor[0] == seq):
+            _, segment, offset = self._cursor
+            if seq < segment.first_seq + segment.count:
+                return segment, offset
+
+        for segment in self._segments:
+            if segment.first_seq <= seq < segment.first_seq + segment.count:
+                return segment, segment.offset(seq - segment.first_seq)
+
+        raise ValueError("Record {0} isn't in the log.".format(seq))
+
+    def _new_segment(self, first_seq):
+        return _Segment(os.path.join(self.path, '{0:020d}.log'.format(first_seq)), first_seq, self.segment_size)
+
+    def _reclaim(self):
+        """ Deletes fully acknowledged segments, other than the newest. """
+        while (len(self._segments) > 1) and (self._segments[0].first_seq + self._segments[0].count <= self.acked):
+            segment = self._segments.pop(0)
+            segment.close()
+            os.unlink(segment.path)
+
+
+class _Segment(object):
+    """ A single memory-mapped segment file. """
+    def __init__(self, path, first_seq, size=None):
+        self.path = path
+        self.first_seq = first_seq
+
+        self._file, self._map = _map(path, size)
+        self.size = len(self._map)
+        self.count, self.end = self._scan()
+
+    def _scan(self):
+        """ Finds the end of the valid records. """
+        mapped = self._map
+        offset = 0
+        records = 0
+
+        while offset + _record_header.size <= self.size:
+            length, crc = _record_header.unpack_from(mapped, offset)
+            start = offset + _record_header.size
+            if (length == 0) or (start + length > self.size):
+                break
+
+            if (crc32(mapped[start:start + length]) & 0xffffffff) != crc:
+                logger.warning("Discarding a torn record at offset {0} of {1}.".format(offset, self.path))
+                mapped[offset:] = b'\0' * (self.size - offset)
+                break
+
+            offset = start + length
+            records += 1
+
+        return records, offset
+
+    def offset(self, index):
+        """ Returns the offset of a record, counting from zero. """
+        mapped = self._map
+        offset = 0
+
+        for i in range(index):
+            length, _ = _record_header.unpack_from(mapped, offset)
+            offset += _record_header.size + length
+
+        return offset
+
+    def records(self, offset, count):
+        """ Yields `(body, end)` for `count` records from `offset`. """
+        mapped = self._map
+
+        for i in range(count):
+            length, _ = _record_header.unpack_from(mapped, offset)
+            start = offset + _record_header.size
+            offset = start + length
+            yield mapped[start:offset], offset
+
+    def write(self, records):
+        """ Writes encoded records at the end. The caller makes sure they fit. """
+        data = b''.join(records)
+        end = self.end + len(data)
+
+        self._map[self.end:end] = data
+        self.end = end
+        self.count += len(records)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _map(path, size=None):
+    """
+    Opens and maps a file, creating it with `size` zero bytes if necessary.
+    Existing files are mapped at their current size.
+
+    """
+    f = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+    if (size is not None) and (os.fstat(f.fileno()).st_size < size):
+        f.truncate(size)
+
+    return f, mmap.mmap(f.fileno(), 0)
+
+
+def _lock(path):
+    """ Takes an exclusive lock on a file, where the platform supports it. """
+    f = open(path, 'a+b')
+
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            raise RuntimeError("{0} is in use by another queue.".format(os.path.dirname(path)))
+
+    return f
+
+
+def _records(message, start, stop):
+    """ Returns log records for some of a message's notifications. """
+    encoded_tokens = message._encoded_tokens[start:stop]
+    encoded_payloads = getattr(message, '_encoded_payloads', None)
+    if encoded_payloads is not None:
+        encoded_payloads = encoded_payloads[start:stop]
+    else:
+        encoded_payloads = repeat(message._encoded_payload)
+
+    return zip(encoded_tokens, encoded_payloads, repeat(message._encoded_expiration), repeat(message.priority))
+
+
+def _group_records(records):
+    """
+    Rebuilds messages from replayed records. Consecutive records with the
+    same expiration and priority become a single message.
+
+    Yields `(seq, message)` for each message.
+
+    """
+    first = key = None
+    tokens, payloads = [], []
+
+    for seq, encoded_token, encoded_payload, expiration, priority in records:
+        if ((expiration, priority) != key) or (first + len(tokens) != seq):
+            if len(tokens) > 0:
+                yield first, _encoded_message(tokens, payloads, key)
+            first, key = seq, (expiration, priority)
+            tokens, payloads = [], []
+
+        # Share identical payloads.
+        if (len(payloads) > 0) and (payloads[-1] == encoded_payload):
+            encoded_payload = payloads[-1]
+
+        tokens.append(encoded_token)
+        payloads.append(encoded_payload)
+
+    if len(tokens) > 0:
+        yield first, _encoded_message(tokens, payloads, key)
+
+
+def _encoded_message(tokens, payloads, key):
+    expiration, priority = key
+
+    if all(payload is payloads[0] for payload in payloads):
+        return _EncodedMessage(tokens, payloads[0], None, expiration, priority)
+    else:
+        return _EncodedMessage(tokens, None, payloads, expiration, priority)
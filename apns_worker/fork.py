@@ -0,0 +1,47 @@
+"""
+Detecting that we're running in a forked child.
+
+Pre-fork servers such as gunicorn and uWSGI often import the application, and
+create an :class:`~apns_worker.ApnsManager`, in a master process and then
+fork workers from it. Only the forking thread survives in a child, so the
+backend's threads are gone and any lock one of them held stays held forever.
+Objects that own threads compare the pid they started in with
+:func:`~apns_worker.fork.current_pid` and start over in a new process.
+
+Where :func:`os.register_at_fork` is available, the current pid is cached and
+updated in the child, so the check is an attribute lookup. Elsewhere it falls
+back to :func:`os.getpid`, which only catches forks made with :func:`os.fork`
+once something asks.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import os
+from threading import Lock
+
+
+_pid = os.getpid()
+
+#: Serializes starting and restarting after a fork. This is replaced in the
+#: child, so it's never inherited in a locked state.
+lock = Lock()
+
+
+def current_pid():
+    """ Returns the pid of the current process. """
+    if _at_fork:
+        return _pid
+
+    return os.getpid()
+
+
+def _after_fork_in_child():
+    global _pid, lock
+
+    _pid = os.getpid()
+    lock = Lock()
+
+
+_at_fork = hasattr(os, 'register_at_fork')
+
+if _at_fork:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,112 @@
+"""
+Grace period policies.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from collections import deque
+import math
+
+
+class AdaptiveGrace(object):
+    """
+    A grace period that tracks how long APNs actually takes to report errors.
+
+    Pass an instance of this as `message_grace` in place of a fixed number of
+    seconds. Every time APNs rejects a notification, the queue records the
+    delay between claiming the notification and receiving the error. Once
+    enough samples have been collected, the grace period becomes a high
+    percentile of the observed delays plus a safety margin, clamped to
+    `[minimum, maximum]`.
+
+    An error can arrive after its notification's grace period has passed and
+    the notification has been purged as delivered. The queue remembers the
+    claim times of the last `history` purged notifications so that these late
+    errors are still recorded and can raise the grace period. Errors later than
+    that are missed, so a burst of them may go unnoticed until the estimate
+    catches up. This biases the estimate downward, which is why a generous
+    `margin` and `maximum` are worthwhile.
+
+    Each :class:`~apns_worker.ApnsManager` needs its own instance.
+
+    :param float initial: Grace period in seconds to use until we have enough
+        samples.
+    :param float minimum: Lower bound on the grace period.
+    :param float maximum: Upper bound on the grace period.
+    :param float percentile: The percentile of observed delays to cover.
+    :param float margin: Seconds to add to the percentile.
+    :param int samples: Number of recent delays to retain.
+    :param int min_samples: Number of delays to observe before adapting.
+    :param int history: Number of purged notifications to remember, so that
+        errors arriving after the grace period are still recorded.
+
+    """
+    def __init__(self, initial=5, minimum=1, maximum=30, percentile=99, margin=1,
+                 samples=1000, min_samples=20, history=10000):
+        if not (minimum <= initial <= maximum):
+            raise ValueError("initial must be between minimum and maximum.")
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.history = history
+
+        self._delays = deque(maxlen=samples)
+        self._seconds = initial
+
+    @property
+    def seconds(self):
+        """ The current grace period in seconds. """
+        return self._seconds
+
+    def record(self, delay):
+        """
+        Records the delay between sending a notification and its rejection.
+
+        :param float delay: Delay in seconds.
+
+        """
+        self._delays.append(delay)
+
+        if len(self._delays) >= self.min_samples:
+            seconds = self.quantile(self.percentile) + self.margin
+            self._seconds = min(max(seconds, self.minimum), self.maximum)
+
+    def quantile(self, percentile):
+        """
+        Returns a percentile of the recorded delays.
+
+        :param float percentile: A number in [0, 100].
+
+        :returns: Seconds, or `None` if nothing has been recorded.
+        :rtype: float
+
+        """
+        delays = sorted(self._delays)
+        if len(delays) == 0:
+            return None
+
+        rank = int(math.ceil(len(delays) * percentile / 100.0)) - 1
+
+        return delays[min(max(rank, 0), len(delays) - 1)]
+
+    def distribution(self):
+        """
+        Summarizes the recorded delays.
+
+        :returns: A dictionary with `count`, `min`, `p50`, `p90`, `p99`, `max`
+            and the current `grace`.
+        :rtype: dict
+
+        """
+        return {
+            'count': len(self._delays),
+            'min': self.quantile(0),
+            'p50': self.quantile(50),
+            'p90': self.quantile(90),
+            'p99': self.quantile(99),
+            'max': self.quantile(100),
+            'grace': self._seconds,
+        }
@@ -0,0 +1,122 @@
+"""
+Instrumentation hooks for tracing and profiling.
+
+Every :class:`~apns_worker.ApnsManager` has a
+:class:`~apns_worker.hooks.Hooks` registry, available as
+:attr:`ApnsManager.hooks <apns_worker.ApnsManager.hooks>`. Register a function
+at any of the hook points to be told when things happen::
+
+    def on_error(status, ident, notification):
+        tracer.event('apns.error', status=status)
+
+    apns.hooks.register('response', on_error)
+
+A hook point without functions costs a single attribute check, so the hooks
+can stay compiled in. Exceptions raised by hooks are logged and otherwise
+ignored.
+
+======================  =====================================  ===============================
+Point                   Arguments                              Called
+======================  =====================================  ===============================
+``append``              `message`, `count`                     After queueing `count` of the
+                                                               message's notifications.
+``claim``               `notification`                         After a notification is claimed
+                                                               for writing.
+``backtrack``           `ident`, `status`, `notification`,     After an error or shutdown
+                        `resent`                               response rewinds the queue.
+                                                               `resent` notifications will be
+                                                               written again.
+``purge``               `count`                                After `count` notifications are
+                                                               released from the queue.
+``before_write``        `notification`                         Before a notification is written
+                                                               to the socket.
+``after_write``         `notification`                         After it's been written.
+``response``            `status`, `ident`, `notification`      When an error response arrives.
+``connect``             `connection`                           After a gateway connection
+                                                               opens.
+``close``               `connection`                           When it closes.
+======================  =====================================  ===============================
+
+The queue hooks (``append`` to ``purge``) are called with the queue lock held,
+so they must be quick and must not call back into the manager. The others are
+called from the backend's network threads.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import logging
+from threading import Lock
+
+
+logger = logging.getLogger(__name__)
+
+
+class Hooks(object):
+    """
+    A registry of instrumentation hooks.
+
+    Each hook point is an attribute that is `None` when nothing is registered
+    and a callable otherwise, so call sites are expected to look like this::
+
+        hook = hooks.claim
+        if hook is not None:
+            hook(notification)
+
+    """
+    POINTS = ('append', 'claim', 'backtrack', 'purge', 'before_write', 'after_write', 'response', 'connect', 'close')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._functions = dict((point, ()) for point in self.POINTS)
+
+        for point in self.POINTS:
+            setattr(self, point, None)
+
+    def register(self, point, func):
+        """
+        Adds a function to a hook point. Returns `func`.
+
+        :param str point: One of :attr:`POINTS`.
+        :param func: The function to call.
+
+        """
+        self._check_point(point)
+
+        with self._lock:
+            self._functions[point] = self._functions[point] + (func,)
+            setattr(self, point, _dispatcher(point, self._functions[point]))
+
+        return func
+
+    def unregister(self, point, func):
+        """
+        Removes a function from a hook point.
+
+        :raises ValueError: If `func` isn't registered there.
+
+        """
+        self._check_point(point)
+
+        with self._lock:
+            functions = list(self._functions[point])
+            functions.remove(func)
+            self._functions[point] = tuple(functions)
+            setattr(self, point, _dispatcher(point, self._functions[point]))
+
+    def _check_point(self, point):
+        if point not in self.POINTS:
+            raise ValueError("Unknown hook point {0!r}.".format(point))
+
+
+def _dispatcher(point, functions):
+    """ Returns a single callable for a hook point, or `None`. """
+    if len(functions) == 0:
+        return None
+
+    def dispatch(*args):
+        for func in functions:
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning("Exception in {0} hook {1!r}: {2}".format(point, func, e))
+
+    return dispatch
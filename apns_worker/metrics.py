@@ -0,0 +1,375 @@
+"""
+Counters, gauges and histograms for monitoring delivery.
+
+Every :class:`~apns_worker.ApnsManager` records into its own
+:class:`~apns_worker.metrics.Metrics`, available as
+:attr:`ApnsManager.metrics <apns_worker.ApnsManager.metrics>`. Take a
+:meth:`~apns_worker.metrics.Metrics.snapshot` whenever you like, or expose the
+Prometheus text format on a local port::
+
+    from apns_worker.metrics import start_http_server
+
+    start_http_server(apns.metrics, 9102)
+
+Recording never takes a lock of its own. Each instrument is updated either
+with the queue lock held or from a single thread, so the cost is a few
+attribute lookups and an addition. Snapshots are taken without locking, so
+related values may be very slightly out of step with each other.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from threading import Thread
+
+from six.moves import BaseHTTPServer
+
+
+#: Bucket bounds for durations, in seconds.
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#: Bucket bounds for counts.
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Counter(object):
+    """
+    A count that only goes up.
+
+    .. attribute:: value
+
+        The current count.
+
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class LabeledCounter(object):
+    """
+    A family of counters distinguished by the value of a single label.
+
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+
+    def inc(self, key, amount=1):
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        """ Returns a dictionary of counts by label value. """
+        return dict(self._values)
+
+
+class Gauge(object):
+    """
+    A value that's computed on demand.
+
+    :param func: A function of no arguments that returns the current value.
+        It will be called from whichever thread takes the snapshot.
+
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def snapshot(self):
+        return self.func()
+
+
+class Histogram(object):
+    """
+    A distribution of observed values in fixed buckets.
+
+    :param buckets: Upper bounds of the buckets, in increasing order. Values
+        above the last bound are counted, but not bucketed.
+
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def snapshot(self):
+        """ :rtype: :class:`~apns_worker.metrics.HistogramSnapshot` """
+        counts = list(self._counts)
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return HistogramSnapshot(total, self._sum, cumulative)
+
+
+class HistogramSnapshot(namedtuple('HistogramSnapshot', ['count', 'sum', 'buckets'])):
+    """
+    The state of a :class:`~apns_worker.metrics.Histogram` at one point in
+    time.
+
+    .. attribute:: count
+
+        The number of observations.
+
+    .. attribute:: sum
+
+        The sum of all observations.
+
+    .. attribute:: buckets
+
+        A list of `(upper_bound, count)` pairs. Counts are cumulative, so each
+        includes every observation less than or equal to its bound. The last
+        bound is infinity.
+
+    """
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket containing the `q` quantile.
+
+        :param float q: Between 0 and 1.
+
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        for bound, count in self.buckets:
+            if count >= rank:
+                return bound
+
+
+class Metrics(object):
+    """
+    A registry of instruments.
+
+    The standard instruments are attributes, so that hot paths can record
+    into them directly:
+
+    ======================  ==========  =========================================
+    Name                    Kind        Description
+    ======================  ==========  =========================================
+    ``appended``            counter     Notifications queued.
+    ``claimed``             counter     Notifications claimed for writing.
+    ``written``             counter     Notifications written to a socket.
+    ``resent``              counter     Notifications requeued by an error
+                                        response, to be written again.
+    ``errors``              counter     Notifications rejected by APNs, by
+                                        ``status``.
+    ``expired``             counter     Notifications dropped unsent because
+                                        their message expired.
+    ``purged``              counter     Notifications released after the grace
+                                        period or a later error.
+    ``exhausted``           counter     Notifications failed after too many
+                                        attempts.
+    ``connections``         counter     Gateway connections opened.
+    ``write_batch_size``    histogram   Notifications per socket write.
+    ``write_seconds``       histogram   Time spent in each socket write.
+    ``connect_seconds``     histogram   Time to open a TLS connection.
+    ``queue_wait_seconds``  histogram   Time from queueing to first claim.
+    ``retry_attempts``      histogram   The attempt number of each claim
+                                        after an interrupted attempt.
+    ======================  ==========  =========================================
+
+    The queue adds gauges for its depth (``claimed_depth`` and
+    ``unclaimed_depth``) and for the age of the oldest unclaimed notification
+    (``oldest_unclaimed_seconds``).
+
+    """
+    def __init__(self):
+        self._instruments = OrderedDict()
+
+        self.appended = self.counter('appended', "Notifications queued.")
+        self.claimed = self.counter('claimed', "Notifications claimed for writing.")
+        self.written = self.counter('written', "Notifications written to a socket.")
+        self.resent = self.counter('resent', "Notifications requeued by an error response.")
+        self.errors = self.counter('errors', "Notifications rejected by APNs.", label='status')
+        self.expired = self.counter('expired', "Notifications dropped unsent because their message expired.")
+        self.purged = self.counter('purged', "Notifications released after the grace period or a later error.")
+        self.exhausted = self.counter('exhausted', "Notifications failed after too many attempts.")
+        self.connections = self.counter('connections', "Gateway connections opened.")
+
+        self.write_batch_size = self.histogram('write_batch_size', "Notifications per socket write.", SIZE_BUCKETS)
+        self.write_seconds = self.histogram('write_seconds', "Time spent in each socket write.")
+        self.connect_seconds = self.histogram('connect_seconds', "Time to open a TLS connection.")
+        self.queue_wait_seconds = self.histogram('queue_wait_seconds', "Time from queueing to first claim.")
+        self.retry_attempts = self.histogram('retry_attempts', "The attempt number of each claim after an interrupted attempt.", SIZE_BUCKETS)
+
+    def counter(self, name, help, label=None):
+        """
+        Registers a counter.
+
+        :param str label: If given, the counter is a
+            :class:`~apns_worker.metrics.LabeledCounter` with this label.
+
+        """
+        if label is None:
+            counter = Counter(name, help)
+        else:
+            counter = LabeledCounter(name, help, label)
+
+        return self.register(counter)
+
+    def gauge(self, name, help, func):
+        """ Registers a :class:`~apns_worker.metrics.Gauge`. """
+        return self.register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        """ Registers a :class:`~apns_worker.metrics.Histogram`. """
+        return self.register(Histogram(name, help, buckets))
+
+    def register(self, instrument):
+        """ Adds an instrument, replacing any other with the same name. """
+        self._instruments[instrument.name] = instrument
+
+        return instrument
+
+    def __getitem__(self, name):
+        return self._instruments[name]
+
+    def __iter__(self):
+        return iter(list(self._instruments.values()))
+
+    def snapshot(self):
+        """
+        Returns the current value of every instrument, by name.
+
+        Counters and gauges are numbers, labeled counters are dictionaries and
+        histograms are :class:`~apns_worker.metrics.HistogramSnapshot`.
+
+        :rtype: :class:`~collections.OrderedDict`
+
+        """
+        return OrderedDict((instrument.name, instrument.snapshot()) for instrument in self)
+
+    def prometheus(self, prefix='apns_'):
+        """
+        Renders a snapshot in the Prometheus text exposition format.
+
+        :param str prefix: Prepended to each metric name.
+
+        """
+        return _render([((), self)], prefix)
+
+
+def render_prometheus(registries, label, prefix='apns_'):
+    """
+    Renders several registries as one Prometheus exposition, with a label to
+    tell them apart.
+
+    :param registries: `(label_value, metrics)` pairs.
+    :param str label: The name of the label that distinguishes them.
+    :param str prefix: Prepended to each metric name.
+
+    """
+    return _render([(((label, value),), metrics) for value, metrics in registries], prefix)
+
+
+def _render(registries, prefix):
+    # Each metric family must appear once, with all of its samples together.
+    families = OrderedDict()
+    for labels, metrics in registries:
+        for instrument in metrics:
+            families.setdefault(instrument.name, []).append((labels, instrument))
+
+    lines = []
+
+    for instruments in families.values():
+        instrument = instruments[0][1]
+        name = prefix + instrument.name
+        if instrument.kind == 'counter':
+            name += '_total'
+
+        lines.append('# HELP {0} {1}'.format(name, instrument.help))
+        lines.append('# TYPE {0} {1}'.format(name, instrument.kind))
+
+        for labels, instrument in instruments:
+            value = instrument.snapshot()
+
+            if isinstance(instrument, LabeledCounter):
+                for key, count in sorted(value.items()):
+                    lines.append(_sample(name, labels + ((instrument.label, key),), count))
+            elif instrument.kind == 'histogram':
+                for bound, count in value.buckets:
+                    lines.append(_sample(name + '_bucket', labels + (('le', _format_bound(bound)),), count))
+                lines.append(_sample(name + '_sum', labels, float(value.sum)))
+                lines.append(_sample(name + '_count', labels, value.count))
+            else:
+                lines.append(_sample(name, labels, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    if len(labels) > 0:
+        name = '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(*label) for label in labels))
+
+    return '{0} {1!r}'.format(name, value)
+
+
+def _format_bound(bound):
+    return '+Inf' if (bound == float('inf')) else repr(float(bound))
+
+
+def start_http_server(metrics, port, host='127.0.0.1', prefix='apns_'):
+    """
+    Serves :meth:`Metrics.prometheus() <apns_worker.metrics.Metrics.prometheus>`
+    over HTTP from a daemon thread.
+
+    :param metrics: The registry to serve, or anything else with a
+        compatible `prometheus(prefix)` method, such as a
+        :class:`~apns_worker.multi.MultiAppManager`.
+    :type metrics: :class:`~apns_worker.metrics.Metrics`
+    :param int port: The port to listen on. Pass 0 to pick a free one.
+    :param str host: The interface to listen on.
+
+    :returns: The server. Call its `shutdown()` method to stop it.
+    :rtype: :class:`BaseHTTPServer.HTTPServer`
+
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus(prefix).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
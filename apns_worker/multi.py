@@ -0,0 +1,242 @@
+"""
+Sending for several apps from one process.
+
+Each app has its own certificate, so it needs its own connections and, to
+keep one app's errors from rewinding another's notifications, its own queue.
+A :class:`~apns_worker.multi.MultiAppManager` keeps an
+:class:`~apns_worker.ApnsManager` per app, all driven by a single
+:class:`~apns_worker.backend.engine.Engine`. That's one thread for every app
+instead of two per app, and the engine takes turns between the queues, so a
+campaign for one app doesn't starve the others::
+
+    from apns_worker.multi import MultiAppManager
+
+    apns = MultiAppManager(error_handler=handle_error)
+    apns.register('com.example.news', news_key_path, news_cert_path)
+    apns.register('com.example.chat', chat_key_path, chat_cert_path, environment='sandbox')
+
+    apns.send_message('com.example.chat', Message(tokens, payload))
+
+Each app's queue records into its own
+:class:`~apns_worker.metrics.Metrics`. :meth:`MultiAppManager.prometheus`
+renders them all with an ``app`` label.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from .apns import ApnsManager, FlushResult
+from .metrics import render_prometheus
+
+
+class MultiAppManager(object):
+    """
+    Sends notifications for any number of apps over a shared engine.
+
+    :param engine: The engine to drive every app's connection. By default,
+        each manager gets an engine of its own.
+    :type engine: :class:`~apns_worker.backend.engine.Engine`
+
+    Like the engine, this requires Python 3.4 or later.
+
+    Any other keyword arguments are defaults for the
+    :class:`~apns_worker.ApnsManager` of each app, such as `message_grace`,
+    `error_handler` or `max_attempts`. They may also include a `scaler`, an
+    :class:`~apns_worker.scaling.AutoScaler` to vary the number of connections
+    for each app. Error handlers are called on the engine thread, where a slow
+    one holds up every app, so wrap them in a
+    :class:`~apns_worker.dispatch.Dispatcher`.
+
+    """
+    def __init__(self, engine=None, **defaults):
+        if engine is None:
+            # The engine needs the selectors module, so this isn't imported
+            # until it's needed.
+            from .backend.engine import Engine
+            engine = Engine()
+
+        self.engine = engine
+
+        self._defaults = defaults
+        self._apps = OrderedDict()
+        self._lock = Lock()
+
+    def register(self, app_id, key_path, cert_path, environment='production', **kwargs):
+        """
+        Adds an app.
+
+        :param app_id: Any hashable identifier, such as the bundle id.
+        :param str key_path: Path to the app's PEM-encoded APNs client key.
+        :param str cert_path: Path to the app's PEM-encoded APNs client
+            certificate.
+        :param environment: The APNs environment for this app.
+
+        Other keyword arguments override the defaults given to the
+        constructor.
+
+        :returns: The app's manager.
+        :rtype: :class:`~apns_worker.ApnsManager`
+
+        """
+        options = dict(self._defaults, **kwargs)
+        backend_options = dict(options.pop('backend_options', None) or {}, engine=self.engine)
+        scaler = options.pop('scaler', None)
+        if scaler is not None:
+            backend_options['scaler'] = scaler
+        options['backend_path'] = 'apns_worker.backend.engine.Backend'
+        options['backend_options'] = backend_options
+
+        with self._lock:
+            if app_id in self._apps:
+                raise ValueError("App {0!r} is already registered.".format(app_id))
+
+            manager = ApnsManager(key_path, cert_path, environment=environment, **options)
+            self._apps[app_id] = manager
+
+        return manager
+
+    def unregister(self, app_id, timeout=None):
+        """
+        Removes an app, after waiting for its queue to drain.
+
+        :param float timeout: The maximum number of seconds to wait
+            (optional). Anything still queued after that is dropped.
+
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        with self._lock:
+            manager = self._apps.pop(app_id)
+
+        result = manager.flush_messages(timeout)
+        manager._backend.stop()
+
+        return result
+
+    @property
+    def app_ids(self):
+        """ The ids of the registered apps, in the order they were added. """
+        return list(self._apps.keys())
+
+    def __getitem__(self, app_id):
+        """ Returns the :class:`~apns_worker.ApnsManager` for an app. """
+        return self._apps[app_id]
+
+    def __contains__(self, app_id):
+        return app_id in self._apps
+
+    #
+    # Client APIs
+    #
+
+    def send_aps(self, app_id, tokens, **kwargs):
+        """
+        Sends a standard notification to one app's devices.
+
+        See :meth:`ApnsManager.send_aps() <apns_worker.ApnsManager.send_aps>`.
+
+        """
+        return self[app_id].send_aps(tokens, **kwargs)
+
+    def send_message(self, app_id, message):
+        """
+        Queues a message for one app's devices.
+
+        See :meth:`ApnsManager.send_message()
+        <apns_worker.ApnsManager.send_message>`.
+
+        :raises KeyError: If the app isn't registered.
+
+        """
+        return self[app_id].send_message(message)
+
+    def send_messages(self, app_id, messages):
+        """
+        Queues a batch of messages for one app's devices.
+
+        See :meth:`ApnsManager.send_messages()
+        <apns_worker.ApnsManager.send_messages>`.
+
+        """
+        self[app_id].send_messages(messages)
+
+    def flush_messages(self, timeout=None):
+        """
+        Waits until every app's queue is empty.
+
+        :param float timeout: The maximum number of seconds to wait in total
+            (optional).
+
+        :returns: The number of notifications still queued, across all apps.
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        deadline = (time.time() + timeout) if (timeout is not None) else None
+        pending = 0
+
+        for manager in self._managers():
+            if deadline is not None:
+                result = manager.flush_messages(max(deadline - time.time(), 0))
+            else:
+                result = manager.flush_messages()
+            pending += result.pending
+
+        return FlushResult(pending)
+
+    def get_feedback(self, app_id, callback, batch_size=None, lazy=False):
+        """
+        Retrieves feedback for one app.
+
+        See :meth:`ApnsManager.get_feedback()
+        <apns_worker.ApnsManager.get_feedback>`.
+
+        """
+        return self[app_id].get_feedback(callback, batch_size=batch_size, lazy=lazy)
+
+    @property
+    def metrics(self):
+        """
+        Each app's :class:`~apns_worker.metrics.Metrics`, by app id.
+
+        :rtype: :class:`~collections.OrderedDict`
+
+        """
+        return OrderedDict((app_id, manager.metrics) for app_id, manager in self._items())
+
+    def prometheus(self, prefix='apns_'):
+        """
+        Renders every app's metrics in the Prometheus text exposition format,
+        with an ``app`` label. This is compatible with
+        :func:`~apns_worker.metrics.start_http_server`.
+
+        :param str prefix: Prepended to each metric name.
+
+        """
+        return render_prometheus(list(self.metrics.items()), 'app', prefix)
+
+    def close(self, timeout=None):
+        """
+        Waits for every queue to drain and stops the engine.
+
+        :param float timeout: The maximum number of seconds to wait for the
+            queues (optional).
+
+        :rtype: :class:`~apns_worker.FlushResult`
+
+        """
+        result = self.flush_messages(timeout)
+
+        for manager in self._managers():
+            manager._backend.stop()
+        self.engine.stop()
+
+        return result
+
+    def _items(self):
+        with self._lock:
+            return list(self._apps.items())
+
+    def _managers(self):
+        return [manager for _, manager in self._items()]
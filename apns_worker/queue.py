@@ -2,11 +2,17 @@ from __future__ import unicode_literals, absolute_import
 
 from collections import deque
 from datetime import timedelta
-from threading import RLock
+from itertools import chain, repeat
+from threading import Condition
+import time
 
 from six.moves import map, range
 
+from .data import ProbeNotification
 from .datetime import now
+from .grace import AdaptiveGrace
+from .hooks import Hooks
+from .metrics import Metrics
 
 
 class NotificationQueue(object):
@@ -19,35 +25,152 @@ class NotificationQueue(object):
     :meth:`~apns_worker.queue.NotificationQueue.backtrack` method can be used
     to rewind the queue to the first notification that failed.
 
-    :param int grace: Seconds to leave a claimed notification in the queue
-        before purging it.
+    :param grace: Seconds to leave a claimed notification in the queue before
+        purging it, or an :class:`~apns_worker.AdaptiveGrace` to derive this
+        from the observed delay of error responses.
+    :param window: An optional limit on unconfirmed (claimed) notifications.
+    :type window: :class:`~apns_worker.window.InFlightWindow`
+    :param int probe_interval: If given, a
+        :class:`~apns_worker.data.ProbeNotification` will be claimed after
+        every `probe_interval` notifications. The error response to the probe
+        confirms all notifications before it, so they can be released without
+        waiting for the grace period.
+    :param metrics: Where to record activity. A new registry is created if
+        this is omitted.
+    :type metrics: :class:`~apns_worker.metrics.Metrics`
+    :param hooks: Instrumentation hooks. A new registry is created if this is
+        omitted.
+    :type hooks: :class:`~apns_worker.hooks.Hooks`
+    :param int max_attempts: If given, a notification whose delivery has been
+        interrupted this many times will be failed with
+        :attr:`~apns_worker.Error.ERR_TOO_MANY_ATTEMPTS` instead of being
+        claimed again. An attempt is charged to the notifications resent after
+        a processing error or a shutdown, and to one that was partly written
+        when its connection dropped. Notifications resent after another
+        notification's error are not charged.
 
     """
-    def __init__(self, grace):
-        self._grace = grace
-
-        self._queue = deque()
-        self._next = 0
-        self._idents = _gen_identifiers()
+    def __init__(self, grace, window=None, probe_interval=None, metrics=None, hooks=None, max_attempts=None):
+        if isinstance(grace, AdaptiveGrace):
+            self._grace_policy = grace
+            self._grace = grace.seconds
+            # Idents and claim times of recently purged notifications, to
+            # sample errors that arrive after the grace period.
+            self._purged = deque(maxlen=grace.history)
+        else:
+            self._grace_policy = None
+            self._grace = grace
+            self._purged = None
+        self._window = window
+        self._probe_interval = probe_interval
+        self._max_attempts = max_attempts
+        self._since_probe = 0
+
+        # Claimed notifications in the order they were sent, followed by the
+        # notifications waiting to be sent.
+        self._claimed = deque()
+        self._unclaimed = deque()
+        self._claimed_bytes = 0
+        self._drain_waiters = 0
+        self._completed = []
+        self._exhausted = []
+        self._next_ident = 0
         self._backend = self.DummyBackend()
 
-        self._auto_purge_at = now() + timedelta(seconds=grace)
+        self._auto_purge_at = now() + timedelta(seconds=self._grace)
+
+        self.hooks = hooks if (hooks is not None) else Hooks()
+        self.metrics = metrics if (metrics is not None) else Metrics()
+        self.metrics.gauge('claimed_depth', "Notifications written and awaiting confirmation.",
+                           lambda: len(self._claimed))
+        self.metrics.gauge('unclaimed_depth', "Notifications waiting to be written.",
+                           lambda: len(self._unclaimed))
+        self.metrics.gauge('oldest_unclaimed_seconds', "Age of the oldest notification waiting to be written.",
+                           self._oldest_unclaimed_age)
 
-    def append(self, message):
+    def append(self, message, start=0, stop=None, expected=None):
         """
         Queues a message for delivery.
 
         :param message: A single message to queue for delivery.
         :type message: :class:`~apns_worker.Message`
 
+        :param int start: Index of the first token to queue.
+        :param int stop: Index after the last token to queue. Together with
+            `start`, this allows a large message to be queued in chunks.
+        :param int expected: The number of notifications that the delivery
+            future should wait for. This defaults to the number queued now.
+            When queueing in chunks, pass the total with the first chunk and 0
+            with the rest, or the future may resolve after the first chunk.
+
+        :returns: The message's delivery future.
+        :rtype: :class:`concurrent.futures.Future`
+
         """
+        count = len(range(*slice(start, stop).indices(len(message._encoded_tokens))))
+
+        if expected is None:
+            expected = count
+
         with self._backend.queue_lock():
-            self._queue.extend(map(QueuedNotification, message.notifications(self._idents)))
+            if expected > 0:
+                message._track(expected)
+            self._enqueue(message, self._reserve_idents(count), count, start, stop, repeat(_monotonic()))
+            self.metrics.appended.inc(count)
+            self._backend.queue_notify()
+
+            hook = self.hooks.append
+            if hook is not None:
+                hook(message, count)
+
+            if message._is_complete():
+                self._completed.append(message)
+
+        self._auto_purge()
+
+        return message.delivery()
+
+    def extend_messages(self, messages):
+        """
+        Queues a batch of messages for delivery.
+
+        This is equivalent to calling
+        :meth:`~apns_worker.queue.NotificationQueue.append` for each message,
+        but it only takes the lock and notifies the backend once, which is much
+        cheaper for many small messages. Delivery futures are not created; use
+        :meth:`~apns_worker.Message.delivery` if you need them.
+
+        :param messages: Messages to queue for delivery.
+        :type messages: iterable of :class:`~apns_worker.Message`
+
+        """
+        messages = list(messages)
+
+        with self._backend.queue_lock():
+            count = sum(len(message._encoded_tokens) for message in messages)
+            idents = self._reserve_idents(count)
+            enqueue = self._enqueue
+            queued = repeat(_monotonic())
+
+            for message in messages:
+                tokens = len(message._encoded_tokens)
+                message._track(tokens)
+                enqueue(message, idents, tokens, 0, None, queued)
+
+                if message._is_complete():
+                    self._completed.append(message)
+
+            self.metrics.appended.inc(count)
             self._backend.queue_notify()
 
+            hook = self.hooks.append
+            if hook is not None:
+                for message in messages:
+                    hook(message, len(message._encoded_tokens))
+
         self._auto_purge()
 
-    def claim(self):
+    def claim(self, channel=None):
         """
         Returns the next notification to be sent.
 
@@ -56,17 +179,52 @@ class NotificationQueue(object):
         :meth:`~apns_worker.queue.NotificationQueue.backtrack` or
         :meth:`~apns_worker.queue.NotificationQueue.unclaim`.
 
+        :param channel: Identifies the connection that will write the
+            notification, for backends that write one queue over several
+            connections. Errors on one connection only rewind the
+            notifications claimed for it.
+
         :rtype: :class:`~apns_worker.data.Notification`.
 
         """
         notification = None
 
         with self._backend.queue_lock():
-            if self._next < len(self._queue):
-                queued = self._queue[self._next]
-                queued.expires = now() + timedelta(seconds=self._grace)
+            self._drop_expired()
+            self._drop_exhausted()
+
+            if (len(self._unclaimed) > 0) and self._is_window_open():
+                self._maybe_insert_probe()
+                queued = self._unclaimed.popleft()
+                is_retry = (queued.claimed is not None)
+                queued.claimed = now()
+                queued.expires = queued.claimed + timedelta(seconds=self._grace)
+                queued.channel = channel
                 notification = queued.notification
-                self._next += 1
+                self._claimed.append(queued)
+
+                if not notification.is_probe:
+                    notification.message._record_sent()
+                    self.metrics.claimed.inc()
+                    if not is_retry:
+                        self.metrics.queue_wait_seconds.observe(_monotonic() - queued.queued)
+                    elif queued.attempts > 0:
+                        self.metrics.retry_attempts.observe(queued.attempts + 1)
+
+                if self._window is not None:
+                    self._claimed_bytes += notification.size
+
+                # Anyone waiting for the queue to drain now has an expiration
+                # to wait for.
+                if (len(self._claimed) == 1) and (self._drain_waiters > 0):
+                    self._backend.queue_notify()
+
+                hook = self.hooks.claim
+                if hook is not None:
+                    hook(notification)
+
+        self._report_exhausted()
+        self._resolve_completed()
 
         return notification
 
@@ -84,16 +242,71 @@ class NotificationQueue(object):
         with self._backend.queue_lock():
             success = False
 
-            if self._next > 0:
-                qn = self._queue[self._next - 1]
+            if len(self._claimed) > 0:
+                qn = self._claimed[-1]
                 if qn.notification == notification:
                     qn.expires = None
-                    self._next -= 1
+                    self._unclaimed.appendleft(self._claimed.pop())
                     success = True
 
+                    if not notification.is_probe:
+                        notification.message._record_unsent()
+
+                    if self._window is not None:
+                        self._claimed_bytes -= notification.size
+
             return success
 
-    def backtrack(self, ident):
+    def unclaim_from(self, notification, channel=None, interrupted=False):
+        """
+        Restores a claimed notification, and everything claimed after it, to
+        the front of the queue.
+
+        This is for notifications that were claimed but never written, such as
+        those still buffered when a connection closes.
+
+        :type notification: :class:`~apns_worker.data.Notification`
+        :param channel: If given, only notifications claimed for this channel
+            are restored.
+        :param bool interrupted: `True` if the connection dropped partway
+            through writing `notification`. This counts against its
+            `max_attempts`; the others were never written and are not charged.
+
+        :returns: The number of notifications restored.
+        :rtype: int
+
+        """
+        with self._backend.queue_lock():
+            kept = deque()
+            restored = []
+            found = False
+
+            for qn in self._claimed:
+                found = found or (qn.notification is notification)
+                if found and ((channel is None) or (qn.channel == channel)):
+                    restored.append(qn)
+                else:
+                    kept.append(qn)
+
+            if len(restored) > 0:
+                self._claimed = kept
+
+                if interrupted:
+                    restored[0].attempts += 1
+
+                for qn in restored:
+                    qn.expires = None
+                    if not qn.notification.is_probe:
+                        qn.notification.message._record_unsent()
+                    if self._window is not None:
+                        self._claimed_bytes -= qn.notification.size
+
+                self._unclaimed.extendleft(reversed(restored))
+                self._backend.queue_notify()
+
+        return len(restored)
+
+    def backtrack(self, ident, status=None, channel=None):
         """
         Returns claimed notifications to the queue.
 
@@ -103,38 +316,97 @@ class NotificationQueue(object):
 
         :param int ident: Ident of the first failed (or last successful)
             notification.
+        :param int status: The APNs status code if `ident` identifies a
+            notification that was rejected. `None` if it's merely the last
+            successful one, as in the case of a shutdown.
+        :param channel: If given, only notifications claimed for this channel
+            are affected. Others may have gone out on a different connection.
 
         :returns: The notification with the given ident, if found.
         :rtype: :class:`~apns_worker.data.Notification` or None.
 
         """
+        from .apns import Error
+
         notification = None
 
         with self._backend.queue_lock():
-            queue = self._queue
-            i = (self._next - 1) if (self._next > 0) else 0
-
-            # Try to find the failed notification. We'll stop if we hit the
-            # beginning of the queue.
-            while (i > 0) and (queue[i].notification.ident != ident):
-                i -= 1
-
-            if i < len(queue) and (queue[i].notification.ident == ident):
-                notification = queue[i].notification
-                i += 1
+            if channel is None:
+                queue = self._claimed
+            else:
+                queue = deque(qn for qn in self._claimed if qn.channel == channel)
+                others = deque(qn for qn in self._claimed if qn.channel != channel)
+            i = 0
+
+            # Try to find the failed notification, starting with the most
+            # recent. Iterating is cheap; indexing into a deque is not.
+            for k, qn in enumerate(reversed(queue)):
+                if qn.notification.ident == ident:
+                    notification = qn.notification
+                    claimed = qn.claimed
+                    i = len(queue) - k
+                    break
+
+            # Only a processing error or a shutdown counts as a failed attempt
+            # for the notifications being resent. Anything else is a problem
+            # with the notification at ident.
+            interrupted = (status is None) or (status == Error.ERR_PROCESSING)
+
+            # A rejected probe is a confirmation, not a failure.
+            if (notification is not None) and notification.is_probe:
+                status = None
+                interrupted = False
+
+            if (notification is not None) and (status is not None):
+                self._record_error_delay(claimed)
+                self.metrics.errors.inc(status)
+            elif (notification is None) and (status is not None):
+                self._record_late_error(ident)
 
             # Everything else either succeeded or failed permanently.
             for j in range(i):
-                queue.popleft()
+                qn = queue.popleft()
+                if (j == i - 1) and (notification is not None) and (status is not None):
+                    self._record_failed(qn.notification, status)
+                else:
+                    self._record_delivered(qn.notification)
+
+            if (notification is not None) and (status is not None):
+                self.metrics.purged.inc(i - 1)
+            else:
+                self.metrics.purged.inc(i)
 
-            # Reset all expirations.
+            # Everything after it goes back to the front of the line.
+            resent = len(queue)
+            self.metrics.resent.inc(resent)
             for item in queue:
                 item.expires = None
+                if interrupted:
+                    item.attempts += 1
+            self._unclaimed.extendleft(reversed(queue))
+            queue.clear()
 
-            self._next = 0
+            if channel is None:
+                self._claimed_bytes = 0
+            else:
+                self._claimed = others
+                self._claimed_bytes = sum(qn.notification.size for qn in others) if (self._window is not None) else 0
+            self._since_probe = 0
+
+            if self._window is not None:
+                if (notification is not None) and (status is not None):
+                    self._window.record_error()
+                else:
+                    self._window.record_success(i)
 
             self._backend.queue_notify()
 
+            hook = self.hooks.backtrack
+            if hook is not None:
+                hook(ident, status, notification, resent)
+
+        self._resolve_completed()
+
         return notification
 
     def purge_expired(self):
@@ -149,19 +421,78 @@ class NotificationQueue(object):
 
         """
         with self._backend.queue_lock():
-            _now = now()
-            is_expired = lambda qn: qn.is_claimed() and (qn.expires <= _now)
+            delay = self._purge_expired(now())
+
+        self._resolve_completed()
+
+        return max(delay, 1.0)
+
+    def idle_delay(self):
+        """
+        Purges expired notifications and returns the number of seconds until
+        the next one expires.
+
+        This is intended for idle workers, which should call it again after
+        the delay. Purging releases space in the in-flight window and resolves
+        delivery futures. If nothing has been claimed, the result is `None`,
+        meaning that there's nothing to wait for other than new notifications.
 
-            while (len(self._queue) > 0) and is_expired(self._queue[0]):
-                self._queue.popleft()
-                self._next -= 1
+        :rtype: float or None
 
-            if len(self._queue) > 0 and self._queue[0].is_claimed():
-                delay = (self._queue[0].expires - _now).total_seconds()
+        """
+        with self._backend.queue_lock():
+            delay = self._purge_expired(now())
+            if len(self._claimed) == 0:
+                delay = None
             else:
-                delay = self._grace
+                delay = max(delay, 0.01)
 
-        return max(delay, 1.0)
+        self._resolve_completed()
+
+        return delay
+
+    def wait_empty(self, timeout=None):
+        """
+        Blocks until the queue is empty.
+
+        Claimed notifications are purged as they expire. Other than that, this
+        sleeps until the queue signals a change, rather than polling.
+
+        :param float timeout: The maximum number of seconds to wait (optional).
+
+        :returns: The number of notifications still in the queue.
+        :rtype: int
+
+        """
+        if timeout is not None:
+            deadline = _monotonic() + timeout
+
+        with self._backend.queue_lock():
+            self._drain_waiters += 1
+            try:
+                delay = self._purge_expired(now())
+                while self._len() > 0:
+                    if timeout is not None:
+                        remaining = deadline - _monotonic()
+                        if remaining <= 0:
+                            break
+                        delay = min(delay, remaining)
+
+                    self._backend.queue_wait(max(delay, 0.001))
+                    delay = self._purge_expired(now())
+            finally:
+                self._drain_waiters -= 1
+
+            pending = self._len()
+
+        self._resolve_completed()
+
+        return pending
+
+    @property
+    def grace(self):
+        """ The current grace period in seconds. """
+        return self._grace
 
     def has_unclaimed(self):
         """
@@ -171,10 +502,40 @@ class NotificationQueue(object):
 
         """
         with self._backend.queue_lock():
-            has_unclaimed = (self._next < len(self._queue))
+            has_unclaimed = (len(self._unclaimed) > 0)
 
         return has_unclaimed
 
+    def can_claim(self):
+        """
+        Returns `True` if :meth:`~apns_worker.queue.NotificationQueue.claim`
+        is likely to return a notification: something is waiting and the
+        in-flight window is open.
+
+        Backends can check this with the queue lock held before waiting for
+        :meth:`~apns_worker.backend.base.Backend.queue_notify`, and then claim
+        without the lock.
+
+        :rtype: bool
+
+        """
+        with self._backend.queue_lock():
+            can_claim = self.has_unclaimed() and self._is_window_open()
+
+        return can_claim
+
+    def unclaimed_count(self):
+        """
+        Returns the number of notifications waiting to be claimed.
+
+        :rtype: int
+
+        """
+        with self._backend.queue_lock():
+            count = len(self._unclaimed)
+
+        return count
+
     def is_empty(self):
         """
         Returns `True` if the queue has no items.
@@ -187,7 +548,7 @@ class NotificationQueue(object):
 
         """
         with self._backend.queue_lock():
-            is_empty = (len(self._queue) == 0)
+            is_empty = (self._len() == 0)
 
         return is_empty
 
@@ -197,39 +558,256 @@ class NotificationQueue(object):
 
     class DummyBackend(object):
         def __init__(self):
-            self.lock = RLock()
+            self.lock = Condition()
 
         def queue_lock(self):
             return self.lock
 
         def queue_notify(self):
+            self.lock.notify_all()
+
+        def queue_wait(self, timeout):
+            self.lock.wait(timeout)
+
+        def delivery_error(self, error):
             pass
 
     def _set_backend(self, backend):
         self._backend = backend
 
+    def _len(self):
+        """ Must be called with the lock held. """
+        return len(self._claimed) + len(self._unclaimed)
+
+    def _enqueue(self, message, idents, count, start, stop, queued):
+        """
+        Must be called with the lock held.
+
+        Adds `count` of a message's notifications to the end of the line,
+        taking identifiers from `idents` and queue times from `queued`.
+
+        """
+        self._unclaimed.extend(map(QueuedNotification, message.notifications(idents, start, stop), queued))
+
+    def _oldest_unclaimed_age(self):
+        """ Safe to call without the lock. """
+        try:
+            queued = self._unclaimed[0].queued
+        except IndexError:
+            return 0
+
+        return _monotonic() - queued
+
+    def _reserve_idents(self, count):
+        """
+        Must be called with the lock held.
+
+        Returns an iterator over the next `count` 32-bit identifiers.
+
+        """
+        start = self._next_ident
+        stop = start + count
+
+        if stop <= 2 ** 32:
+            idents = iter(range(start, stop))
+        else:
+            idents = chain(range(start, 2 ** 32), range(0, stop - 2 ** 32))
+
+        self._next_ident = stop % (2 ** 32)
+
+        return idents
+
+    def _record_delivered(self, notification):
+        """ Must be called with the lock held. """
+        if (not notification.is_probe) and notification.message._record_delivered():
+            self._completed.append(notification.message)
+
+    def _record_failed(self, notification, status):
+        """ Must be called with the lock held. """
+        if notification.message._record_failed(status):
+            self._completed.append(notification.message)
+
+    def _resolve_completed(self):
+        """ Resolves delivery futures. Must be called without the lock. """
+        if len(self._completed) > 0:
+            with self._backend.queue_lock():
+                completed, self._completed = self._completed, []
+
+            for message in completed:
+                message._resolve()
+
+    def _drop_expired(self):
+        """
+        Must be called with the lock held.
+
+        Discards unclaimed notifications at the head of the line whose messages
+        have expired. APNs would discard them anyway.
+
+        """
+        queue = self._unclaimed
+        timestamp = None
+        expired = 0
+
+        while len(queue) > 0:
+            notification = queue[0].notification
+            if notification.is_probe or (notification.message._encoded_expiration is None):
+                break
+
+            if timestamp is None:
+                timestamp = int(time.time())
+            if not notification.is_expired(timestamp):
+                break
+
+            queue.popleft()
+            expired += 1
+            if notification.message._record_expired():
+                self._completed.append(notification.message)
+
+        if expired > 0:
+            self.metrics.expired.inc(expired)
+
+    def _drop_exhausted(self):
+        """
+        Must be called with the lock held.
+
+        Fails unclaimed notifications at the head of the line that have
+        already been claimed `max_attempts` times.
+
+        """
+        if self._max_attempts is None:
+            return
+
+        from .apns import Error
+
+        queue = self._unclaimed
+
+        while (len(queue) > 0) and (queue[0].attempts >= self._max_attempts):
+            notification = queue.popleft().notification
+            if not notification.is_probe:
+                self._record_failed(notification, Error.ERR_TOO_MANY_ATTEMPTS)
+                self._exhausted.append(notification)
+                self.metrics.exhausted.inc()
+
+    def _report_exhausted(self):
+        """ Reports exhausted notifications. Must be called without the lock. """
+        from .apns import Error
+
+        if len(self._exhausted) > 0:
+            with self._backend.queue_lock():
+                exhausted, self._exhausted = self._exhausted, []
+
+            for notification in exhausted:
+                self._backend.delivery_error(Error(Error.ERR_TOO_MANY_ATTEMPTS, notification.message, notification.token))
+
+    def _record_error_delay(self, claimed):
+        """ Must be called with the lock held. """
+        if (self._grace_policy is not None) and (claimed is not None):
+            self._grace_policy.record((now() - claimed).total_seconds())
+            self._grace = self._grace_policy.seconds
+
+    def _record_late_error(self, ident):
+        """
+        Must be called with the lock held.
+
+        Records the delay of an error for a notification that has already been
+        purged. It's too late to resend anything, but the grace period was
+        evidently too short.
+
+        """
+        if self._purged is not None:
+            for purged_ident, claimed in reversed(self._purged):
+                if purged_ident == ident:
+                    self._record_error_delay(claimed)
+                    break
+
+    def _maybe_insert_probe(self):
+        """ Must be called with the lock held. """
+        if self._probe_interval is not None:
+            if self._since_probe >= self._probe_interval:
+                probe = ProbeNotification(next(self._reserve_idents(1)))
+                self._unclaimed.appendleft(QueuedNotification(probe, _monotonic()))
+                self._since_probe = 0
+            else:
+                self._since_probe += 1
+
+    def _is_window_open(self):
+        """ Must be called with the lock held. """
+        if self._window is None:
+            return True
+
+        if not self._window.is_open(len(self._claimed), self._claimed_bytes):
+            # Confirm whatever we can and try again.
+            self._purge_expired(now())
+
+        return self._window.is_open(len(self._claimed), self._claimed_bytes)
+
+    def _purge_expired(self, _now):
+        """
+        Must be called with the lock held.
+
+        Returns the number of seconds until the next claimed notification
+        expires, without any lower bound.
+
+        """
+        queue = self._claimed
+        purged = 0
+
+        while (len(queue) > 0) and (queue[0].expires <= _now):
+            qn = queue.popleft()
+            purged += 1
+            self._record_delivered(qn.notification)
+
+            if self._purged is not None:
+                self._purged.append((qn.notification.ident, qn.claimed))
+
+            if self._window is not None:
+                self._claimed_bytes -= qn.notification.size
+
+        if purged > 0:
+            self.metrics.purged.inc(purged)
+
+            hook = self.hooks.purge
+            if hook is not None:
+                hook(purged)
+
+        if (purged > 0) and (self._window is not None):
+            self._window.record_success(purged)
+
+        # Wake up writers waiting on the window and anyone waiting to drain.
+        if (purged > 0) and ((self._window is not None) or (self._len() == 0)):
+            self._backend.queue_notify()
+
+        if len(queue) > 0:
+            delay = (queue[0].expires - _now).total_seconds()
+        else:
+            delay = self._grace
+
+        return delay
+
     def _auto_purge(self):
         _now = now()
 
         with self._backend.queue_lock():
             if _now > self._auto_purge_at:
-                delay = self.purge_expired()
+                delay = max(self._purge_expired(_now), 1.0)
                 self._auto_purge_at = _now + timedelta(seconds=delay)
 
+        self._resolve_completed()
+
 
-def _gen_identifiers():
-    """ Generates sequential 32-bit notification identifiers. """
-    while True:
-        for i in range(2 ** 32):
-            yield i
+_monotonic = getattr(time, 'monotonic', time.time)
 
 
 class QueuedNotification(object):
-    __slots__ = ['notification', 'expires']
+    __slots__ = ['notification', 'queued', 'attempts', 'claimed', 'expires', 'channel']
 
-    def __init__(self, notification):
+    def __init__(self, notification, queued):
         self.notification = notification
+        self.queued = queued
+        self.attempts = 0
+        self.claimed = None
         self.expires = None
+        self.channel = None
 
     def is_claimed(self):
         return (self.expires is not None)
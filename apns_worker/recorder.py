@@ -0,0 +1,105 @@
+"""
+A flight recorder of recently written notifications.
+
+When APNs rejects a notification, the error response only identifies that
+one notification, and the connection is gone. To see what led up to it, the
+threaded backend keeps the most recent writes to the gateway, across
+reconnections, in a :class:`~apns_worker.recorder.FlightRecorder`. Recording a
+write only stores a reference and a timestamp; nothing is formatted or hashed
+until the recorder is dumped.
+
+Use :meth:`ApnsManager.recent_writes() <apns_worker.ApnsManager.recent_writes>`
+to dump it on demand. It's also logged automatically when APNs reports a
+processing error (status 1) or an unknown error (255).
+"""
+from __future__ import unicode_literals, absolute_import
+
+from collections import deque, namedtuple
+from hashlib import sha1
+import time
+
+from six import python_2_unicode_compatible
+
+
+@python_2_unicode_compatible
+class FlightRecord(namedtuple('FlightRecord', ['timestamp', 'ident', 'token', 'size', 'payload_digest'])):
+    """
+    A notification that was written to APNs.
+
+    .. attribute:: timestamp
+
+        When it was written, in seconds since the epoch.
+
+    .. attribute:: ident
+
+        The notification identifier.
+
+    .. attribute:: token
+
+        The hex-encoded device token. This is empty for a probe.
+
+    .. attribute:: size
+
+        The size of the frame in bytes.
+
+    .. attribute:: payload_digest
+
+        The first 16 hex digits of the SHA-1 of the encoded payload, or `None`
+        for a probe. Notifications with the same payload have the same digest.
+
+    """
+    def __str__(self):
+        return "{0:.6f} {1} {2} {3} bytes payload {4}".format(
+            self.timestamp, self.ident, self.token or '(probe)', self.size, self.payload_digest
+        )
+
+
+class FlightRecorder(object):
+    """
+    A fixed-size ring buffer of recent writes.
+
+    :param int size: The number of writes to remember.
+
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, notification):
+        """
+        Records a write. This is safe to call from one thread while others
+        dump.
+
+        :type notification: :class:`~apns_worker.data.Notification`
+
+        """
+        self._entries.append((time.time(), notification))
+
+    def clear(self):
+        self._entries.clear()
+
+    def dump(self):
+        """
+        Returns the recorded writes, oldest first.
+
+        :rtype: list of :class:`~apns_worker.recorder.FlightRecord`
+
+        """
+        digests = {}
+        records = []
+
+        for timestamp, notification in list(self._entries):
+            payload = notification.encoded_payload
+            if payload is None:
+                digest = None
+            else:
+                digest = digests.get(id(payload))
+                if digest is None:
+                    digest = digests[id(payload)] = sha1(payload).hexdigest()[:16]
+
+            records.append(FlightRecord(timestamp, notification.ident, notification.token, notification.size, digest))
+
+        return records
@@ -0,0 +1,153 @@
+"""
+Deciding how many connections a queue should have.
+"""
+from __future__ import unicode_literals, absolute_import
+
+
+class AutoScaler(object):
+    """
+    Scales the number of connections writing one queue between a minimum and a
+    maximum.
+
+    One connection is plenty most of the time, but a campaign can queue far
+    more than one connection can write promptly. The scaler adds a connection
+    when there's a backlog: at least `min_depth` notifications waiting, which
+    would take more than `drain_seconds` to write at the current rate per
+    connection. The backlog has to last for `sustain` seconds, and connections
+    are added one at a time, at most once every `scale_up_interval` seconds, so
+    that a burst of new connections doesn't look like abuse to Apple.
+    Connections beyond the minimum are closed once they've had nothing to
+    write for `idle_timeout` seconds. A connection is only added while its
+    peers are busy and only removed once it's idle, which keeps the count from
+    flapping.
+
+    Scaling requires a backend that can write a queue over several
+    connections, such as :class:`apns_worker.backend.engine.Backend`, which
+    takes this as its `scaler` option. Each backend uses its own copy.
+
+    :param int min_connections: Connections to keep once they're open, even
+        when idle. With 0, the last connection is closed when it's idle and a
+        new one is opened when there's something to send.
+    :param int max_connections: The most connections to open.
+    :param int min_depth: The fewest unclaimed notifications that count as a
+        backlog.
+    :param float drain_seconds: How long the unclaimed notifications may take
+        to write before they count as a backlog.
+    :param float sustain: Seconds that a backlog must last before we add a
+        connection.
+    :param float scale_up_interval: The least number of seconds between adding
+        connections.
+    :param float idle_timeout: Seconds that a connection beyond the minimum
+        may go without writing before it's closed.
+
+    """
+    #: Seconds between samples of the write rate.
+    sample_interval = 1.0
+
+    def __init__(self, min_connections=1, max_connections=4, min_depth=1000, drain_seconds=2.0,
+                 sustain=5.0, scale_up_interval=10.0, idle_timeout=30.0):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1.")
+        if not (0 <= min_connections <= max_connections):
+            raise ValueError("min_connections must be between 0 and max_connections.")
+
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.min_depth = min_depth
+        self.drain_seconds = drain_seconds
+        self.sustain = sustain
+        self.scale_up_interval = scale_up_interval
+        self.idle_timeout = idle_timeout
+
+        self._rate = None
+        self._sampled_at = None
+        self._sampled_written = 0
+        self._backlog_since = None
+        self._scaled_up_at = None
+
+    @property
+    def rate(self):
+        """
+        The recent number of notifications written per second on each
+        connection, or `None` if we haven't measured it yet.
+
+        """
+        return self._rate
+
+    def record(self, now, written, connections):
+        """
+        Samples the write rate.
+
+        :param float now: The current monotonic time.
+        :param int written: The number of notifications written so far, in
+            total.
+        :param int connections: The number of open connections.
+
+        """
+        if self._sampled_at is None:
+            self._sampled_at = now
+            self._sampled_written = written
+            return
+
+        elapsed = now - self._sampled_at
+        if elapsed >= self.sample_interval:
+            if connections > 0:
+                rate = (written - self._sampled_written) / elapsed / connections
+                self._rate = rate if (self._rate is None) else (self._rate + rate) / 2
+
+            self._sampled_at = now
+            self._sampled_written = written
+
+    def should_add(self, now, connections, depth):
+        """
+        Returns `True` if another connection should be opened now.
+
+        :param float now: The current monotonic time.
+        :param int connections: The number of open connections.
+        :param int depth: The number of unclaimed notifications.
+
+        :rtype: bool
+
+        """
+        if connections >= self.max_connections:
+            self._backlog_since = None
+            return False
+
+        if connections < max(self.min_connections, 1):
+            return (depth > 0)
+
+        if not self._is_backlog(connections, depth):
+            self._backlog_since = None
+            return False
+
+        if self._backlog_since is None:
+            self._backlog_since = now
+
+        if now - self._backlog_since < self.sustain:
+            return False
+
+        if (self._scaled_up_at is not None) and (now - self._scaled_up_at < self.scale_up_interval):
+            return False
+
+        self._scaled_up_at = now
+
+        return True
+
+    def should_close(self, connections, idle):
+        """
+        Returns `True` if an idle connection should be closed.
+
+        :param int connections: The number of open connections.
+        :param float idle: Seconds since the connection last wrote anything.
+
+        :rtype: bool
+
+        """
+        return (connections > self.min_connections) and (idle >= self.idle_timeout)
+
+    def _is_backlog(self, connections, depth):
+        # If nothing is being written, more connections won't help.
+        if (depth < self.min_depth) or (not self._rate):
+            return False
+
+        return (depth / (self._rate * connections) > self.drain_seconds)
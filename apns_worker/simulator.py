@@ -0,0 +1,495 @@
+"""
+A local simulator for the APNs binary provider API.
+
+This speaks the legacy gateway protocol (command 2 frames and 6-byte error
+responses) and the feedback protocol over TLS, so that the library and the
+services built on it can be exercised and load-tested without talking to
+Apple. It uses a bundled self-signed certificate for `localhost` by default.
+The key is not a secret; never use it for anything else.
+
+Use :attr:`Simulator.environment` as the `environment` of an
+:class:`~apns_worker.ApnsManager`. The bundled certificate doubles as a client
+certificate::
+
+    from apns_worker import ApnsManager
+    from apns_worker.simulator import CERT_PATH, Simulator
+
+    with Simulator(latency=0.05, errors={bad_token: 8}) as simulator:
+        apns = ApnsManager(CERT_PATH, CERT_PATH, environment=simulator.environment)
+
+The simulator can also be run on its own::
+
+    python -m apns_worker.simulator --port 2195 --feedback-port 2196 --error 10=8
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+from binascii import hexlify, unhexlify
+from calendar import timegm
+from collections import namedtuple
+import logging
+import os.path
+import socket
+import ssl
+import struct
+from threading import Lock, Thread
+import time
+
+from six.moves import socketserver
+
+from .apns import Environment, Error
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Path to the bundled self-signed certificate and key.
+CERT_PATH = os.path.join(os.path.dirname(__file__), 'certs', 'simulator.pem')
+
+SHUTDOWN = 10
+
+
+class SimulatedNotification(namedtuple('SimulatedNotification', ['token', 'payload', 'ident', 'expiration', 'priority'])):
+    """
+    A notification received by the simulator.
+
+    .. attribute:: token
+
+        The hex-encoded device token.
+
+    .. attribute:: payload
+
+        The encoded payload (bytes).
+
+    .. attribute:: ident
+
+        The notification identifier, or `None`.
+
+    .. attribute:: expiration
+
+        The expiration timestamp, or `None`.
+
+    .. attribute:: priority
+
+        The priority, or `None`.
+
+    """
+
+
+class Simulator(object):
+    """
+    A simulated APNs gateway and feedback service.
+
+    The servers run on background threads between :meth:`start` and
+    :meth:`stop`. The simulator is also a context manager.
+
+    :param str host: The interface to listen on.
+    :param int gateway_port: The gateway port. The default of 0 picks a free
+        port.
+    :param int feedback_port: The feedback port.
+    :param str cert_path: Path to a PEM file with the server certificate and
+        key.
+
+    :param float latency: Seconds to wait before sending an error response.
+    :param float rate: The maximum number of notifications per second to
+        accept on each connection (optional). Clients will see partial writes
+        and back pressure when they exceed this.
+
+    :param dict errors: Statuses to return for particular notifications, keyed
+        by identifier (int) or hex-encoded token (str). This may be modified
+        while the simulator is running.
+
+    :param list feedback: Records for the feedback service to return. Each is
+        a :class:`~apns_worker.Feedback` or a `(token, timestamp)` tuple.
+
+    :param int max_payload: The largest payload to accept, in bytes.
+    :param bool record: If `True`, every accepted notification is kept in
+        :attr:`notifications`. Turn this off for long load tests.
+
+    """
+    def __init__(self, host='127.0.0.1', gateway_port=0, feedback_port=0, cert_path=CERT_PATH,
+                 latency=0, rate=None, errors=None, feedback=None, max_payload=2048, record=True):
+        self.host = host
+        self.cert_path = cert_path
+        self.latency = latency
+        self.rate = rate
+        self.errors = errors if (errors is not None) else {}
+        self.feedback = feedback if (feedback is not None) else []
+        self.max_payload = max_payload
+        self.record = record
+
+        #: Accepted notifications, if `record` is set.
+        self.notifications = []
+        #: `(notification, status)` pairs for rejected notifications.
+        self.rejected = []
+        #: The number of accepted notifications.
+        self.accepted = 0
+        #: The number of gateway connections so far.
+        self.connections = 0
+
+        self._ports = (gateway_port, feedback_port)
+        self._lock = Lock()
+        self._servers = []
+        self._handlers = set()
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def environment(self):
+        """
+        An :class:`~apns_worker.Environment` pointing to this simulator.
+
+        This is only available while the simulator is running.
+
+        """
+        gateway, feedback = (server.server_address[:2] for server in self._servers)
+
+        return Environment(gateway, feedback, self.cert_path)
+
+    def start(self):
+        """ Starts listening. """
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(self.cert_path)
+
+        self._stopping = False
+        self._servers = [
+            _TLSServer((self.host, self._ports[0]), GatewayHandler, self, context),
+            _TLSServer((self.host, self._ports[1]), FeedbackHandler, self, context),
+        ]
+
+        for server in self._servers:
+            thread = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1})
+            thread.daemon = True
+            thread.start()
+
+        logger.debug("Simulator listening on {0}.".format(self.environment))
+
+    def stop(self):
+        """ Closes all connections and stops listening. """
+        self._stopping = True
+
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def shutdown_connections(self):
+        """
+        Closes all gateway connections as if for maintenance.
+
+        Each client receives a shutdown response (status 10) with the
+        identifier of the last notification it sent.
+
+        """
+        with self._lock:
+            for handler in self._handlers:
+                handler.should_shutdown = True
+
+    def check(self, notification):
+        """
+        Returns the status code for a notification, or 0 if it's acceptable.
+
+        Override this to simulate other failures. Returning 10 (shutdown)
+        accepts the notification and then closes the connection with a
+        shutdown response.
+
+        :type notification: :class:`SimulatedNotification`
+        :rtype: int
+
+        """
+        if notification.token is None:
+            status = Error.ERR_NO_TOKEN
+        elif len(notification.token) != 64:
+            status = Error.ERR_TOKEN_SIZE
+        elif not notification.payload:
+            status = Error.ERR_NO_PAYLOAD
+        elif len(notification.payload) > self.max_payload:
+            status = Error.ERR_PAYLOAD_SIZE
+        else:
+            status = self.errors.get(notification.ident, 0) or self.errors.get(notification.token, 0)
+
+        return status
+
+    def feedback_data(self):
+        """ Encodes :attr:`feedback` for the wire. """
+        chunks = []
+
+        for record in self.feedback:
+            if hasattr(record, 'when'):
+                token, timestamp = record.token, timegm(record.when.utctimetuple())
+            else:
+                token, timestamp = record
+            encoded_token = unhexlify(token)
+
+            chunks.append(struct.pack('!IH', timestamp, len(encoded_token)) + encoded_token)
+
+        return b''.join(chunks)
+
+    def _accept(self, notification):
+        with self._lock:
+            self.accepted += 1
+            if self.record:
+                self.notifications.append(notification)
+
+    def _reject(self, notification, status):
+        with self._lock:
+            self.rejected.append((notification, status))
+
+    def _register(self, handler):
+        with self._lock:
+            self.connections += 1
+            self._handlers.add(handler)
+
+    def _unregister(self, handler):
+        with self._lock:
+            self._handlers.discard(handler)
+
+
+class _TLSServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler_cls, simulator, context):
+        socketserver.ThreadingTCPServer.__init__(self, address, handler_cls)
+
+        self.simulator = simulator
+        self.context = context
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+
+        # Send error responses as soon as they're written.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # The handshake happens on the handler's thread.
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+
+class GatewayHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a single gateway connection.
+
+    """
+    poll_interval = 0.1
+
+    _frame_header = struct.Struct('!BI')
+    _item_header = struct.Struct('!BH')
+
+    def setup(self):
+        self.simulator = self.server.simulator
+        self.should_shutdown = False
+        self.last_ident = 0
+
+    def handle(self):
+        simulator = self.simulator
+        sock = self.request
+
+        simulator._register(self)
+        try:
+            sock.settimeout(None)
+            sock.do_handshake()
+            sock.settimeout(self.poll_interval)
+            self.read_frames(sock)
+        except (socket.error, ssl.SSLError) as e:
+            logger.debug("Simulated gateway connection failed: {0}".format(e))
+        finally:
+            simulator._unregister(self)
+            _close(sock, self.poll_interval)
+
+    def read_frames(self, sock):
+        simulator = self.simulator
+        buf = bytearray()
+        received = 0
+        start = time.time()
+
+        while not simulator._stopping:
+            if self.should_shutdown:
+                self.respond(sock, SHUTDOWN, self.last_ident, latency=0)
+                break
+
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+
+            if len(data) == 0:
+                break
+            buf.extend(data)
+
+            offset = 0
+            while len(buf) - offset >= 5:
+                command, length = self._frame_header.unpack_from(buf, offset)
+                if command != 2:
+                    self.respond(sock, Error.ERR_PROCESSING, 0)
+                    return
+                if len(buf) - offset - 5 < length:
+                    break
+
+                notification = self.parse_frame(bytes(buf[offset + 5:offset + 5 + length]))
+                offset += 5 + length
+                received += 1
+
+                status = simulator.check(notification)
+                if status == SHUTDOWN:
+                    # Shutdown responses identify the last good notification.
+                    simulator._accept(notification)
+                    self.respond(sock, SHUTDOWN, notification.ident or 0)
+                    return
+                elif status:
+                    simulator._reject(notification, status)
+                    self.respond(sock, status, notification.ident or 0)
+                    return
+
+                simulator._accept(notification)
+                if notification.ident is not None:
+                    self.last_ident = notification.ident
+
+            del buf[:offset]
+
+            if simulator.rate:
+                delay = (received / float(simulator.rate)) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def parse_frame(self, frame):
+        """ Returns a :class:`SimulatedNotification`. """
+        items = {}
+        offset = 0
+
+        while offset + 3 <= len(frame):
+            item_id, length = self._item_header.unpack_from(frame, offset)
+            items[item_id] = frame[offset + 3:offset + 3 + length]
+            offset += 3 + length
+
+        token = items.get(1)
+        ident = items.get(3)
+        expiration = items.get(4)
+        priority = items.get(5)
+
+        return SimulatedNotification(
+            hexlify(token).decode('ascii') if (token is not None) else None,
+            items.get(2),
+            struct.unpack('!I', ident)[0] if (ident is not None) else None,
+            struct.unpack('!I', expiration)[0] if (expiration is not None) else None,
+            struct.unpack('!B', priority)[0] if (priority is not None) else None,
+        )
+
+    def respond(self, sock, status, ident, latency=None):
+        """ Sends an error response. The connection closes afterwards. """
+        if latency is None:
+            latency = self.simulator.latency
+        if latency > 0:
+            time.sleep(latency)
+
+        sock.settimeout(None)
+        sock.sendall(struct.pack('!BBI', 8, status, ident))
+        self.drain(sock)
+
+    def drain(self, sock, timeout=1):
+        """
+        Discards input until the client hangs up.
+
+        Closing a socket with unread data makes TCP reset the connection, which
+        can destroy the response before the client reads it. The TLS session
+        stays open until then: a client that gets close_notify can't write the
+        rest of its buffer, and may give up before reading the response.
+
+        """
+        sock.settimeout(self.poll_interval)
+        deadline = time.time() + timeout
+
+        while time.time() < deadline:
+            try:
+                if len(sock.recv(65536)) == 0:
+                    break
+            except socket.timeout:
+                pass
+            except ssl.SSLError:
+                break
+
+
+class FeedbackHandler(socketserver.BaseRequestHandler):
+    """
+    Sends the simulator's feedback records and closes the connection.
+
+    """
+    def handle(self):
+        sock = self.request
+
+        try:
+            sock.do_handshake()
+            sock.sendall(self.server.simulator.feedback_data())
+        except (socket.error, ssl.SSLError) as e:
+            logger.debug("Simulated feedback connection failed: {0}".format(e))
+        finally:
+            _close(sock, 1)
+
+
+def _close(sock, timeout):
+    """
+    Closes a TLS socket with close_notify, so the client sees a clean end of
+    stream instead of a truncated one.
+
+    """
+    try:
+        sock.settimeout(timeout)
+        sock.unwrap()
+    except (socket.error, ssl.SSLError, ValueError):
+        pass
+
+    sock.close()
+
+
+def _parse_error(spec):
+    """ Parses `KEY=STATUS`, where KEY is an identifier or a hex token. """
+    key, status = spec.split('=', 1)
+    if len(key) != 64:
+        key = int(key)
+
+    return key, int(status)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs a simulated APNs gateway and feedback service.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2195)
+    parser.add_argument('--feedback-port', type=int, default=2196)
+    parser.add_argument('--cert', default=CERT_PATH, help="PEM file with the server certificate and key.")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds to wait before sending an error.")
+    parser.add_argument('--rate', type=float, default=None, help="Notifications per second per connection.")
+    parser.add_argument('--error', action='append', default=[], type=_parse_error, metavar='KEY=STATUS',
+                        help="Reject a notification identifier or hex token with a status.")
+    parser.add_argument('--feedback', action='append', default=[], metavar='TOKEN',
+                        help="A hex token to report to the feedback service.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=(logging.DEBUG if args.verbose else logging.INFO))
+
+    now = int(time.time())
+    simulator = Simulator(
+        args.host, args.port, args.feedback_port, args.cert,
+        latency=args.latency, rate=args.rate, errors=dict(args.error),
+        feedback=[(token, now) for token in args.feedback], record=False,
+    )
+
+    with simulator:
+        print("Serving {0}".format(simulator.environment))
+        try:
+            while True:
+                time.sleep(10)
+                print("{0} accepted, {1} rejected, {2} connections".format(
+                    simulator.accepted, len(simulator.rejected), simulator.connections
+                ))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
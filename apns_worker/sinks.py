@@ -0,0 +1,203 @@
+"""
+Bulk destinations for feedback records.
+
+These are intended for use with :meth:`~apns_worker.ApnsManager.save_feedback`.
+Each sink receives records in batches, drops duplicate `(token, when)` pairs,
+and makes every batch durable before accepting the next one.
+"""
+from __future__ import unicode_literals, absolute_import
+
+from abc import ABCMeta, abstractmethod
+from calendar import timegm
+import csv
+import json
+import sqlite3
+
+from six import add_metaclass
+
+
+def _timestamp(record):
+    """ Seconds since the epoch for a Feedback or RawFeedback. """
+    timestamp = getattr(record, 'timestamp', None)
+    if timestamp is None:
+        timestamp = timegm(record.when.utctimetuple())
+
+    return timestamp
+
+
+def _encoded_token(record):
+    """ The binary token for a Feedback or RawFeedback. """
+    encoded_token = getattr(record, 'encoded_token', None)
+    if encoded_token is None:
+        encoded_token = bytes(bytearray.fromhex(record.token))
+
+    return encoded_token
+
+
+@add_metaclass(ABCMeta)
+class FeedbackSink(object):
+    """
+    Base class for feedback sinks.
+
+    :param int batch_size: Number of records to request per batch.
+
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.written = 0
+
+    def __call__(self, records):
+        self.write(records)
+
+    @abstractmethod
+    def write(self, records):
+        """
+        Override this.
+
+        Stores a batch of :class:`~apns_worker.Feedback` or
+        :class:`~apns_worker.RawFeedback` records.
+
+        """
+
+    def close(self):
+        """
+        Releases any resources held by the sink.
+
+        """
+
+
+class SQLiteFeedbackSink(FeedbackSink):
+    """
+    Stores feedback in a SQLite table.
+
+    The table has a hex `token` column and an integer `timestamp` column
+    (seconds since the epoch) with a primary key over both, so duplicates are
+    ignored. The table is created if necessary. A typical cleanup job would
+    attach this database and delete devices with a set-based query.
+
+    :param str path: Path to the database file.
+    :param str table: The table name.
+    :param int batch_size: Number of records per transaction.
+
+    """
+    def __init__(self, path, table='apns_feedback', batch_size=10000):
+        super(SQLiteFeedbackSink, self).__init__(batch_size)
+
+        self.path = path
+        self.table = table
+
+        self._db = None
+
+    def write(self, records):
+        db = self._connect()
+
+        with db:
+            cursor = db.executemany(
+                'INSERT OR IGNORE INTO "{0}" (token, timestamp) VALUES (?, ?)'.format(self.table),
+                ((record.token, _timestamp(record)) for record in records)
+            )
+
+        self.written += max(cursor.rowcount, 0)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS "{0}" ('
+                'token TEXT NOT NULL, '
+                'timestamp INTEGER NOT NULL, '
+                'PRIMARY KEY (token, timestamp))'.format(self.table)
+            )
+
+        return self._db
+
+
+class StreamFeedbackSink(FeedbackSink):
+    """
+    Base class for sinks that write to a text stream.
+
+    Pairs that have already been written are remembered in memory (about 100
+    bytes per record) in order to drop duplicates. The stream is flushed after
+    every batch and is not closed.
+
+    :param stream: A writable text stream.
+
+    """
+    def __init__(self, stream, batch_size=1000):
+        super(StreamFeedbackSink, self).__init__(batch_size)
+
+        self.stream = stream
+
+        self._seen = set()
+
+    def write(self, records):
+        seen = self._seen
+        fresh = []
+
+        for record in records:
+            key = (_encoded_token(record), _timestamp(record))
+            if key not in seen:
+                seen.add(key)
+                fresh.append(record)
+
+        self.write_records(fresh)
+        self.stream.flush()
+
+        self.written += len(fresh)
+
+    @abstractmethod
+    def write_records(self, records):
+        """
+        Override this.
+
+        Writes records that have not been seen before.
+
+        """
+
+
+class NDJSONFeedbackSink(StreamFeedbackSink):
+    """
+    Writes feedback as newline-delimited JSON.
+
+    Each line is an object with `token`, `timestamp` and `when` (ISO 8601,
+    UTC) keys.
+
+    """
+    def write_records(self, records):
+        self.stream.write(''.join(
+            json.dumps({
+                'token': record.token,
+                'timestamp': _timestamp(record),
+                'when': record.when.isoformat() + 'Z',
+            }, sort_keys=True) + '\n'
+            for record in records
+        ))
+
+
+class CSVFeedbackSink(StreamFeedbackSink):
+    """
+    Writes feedback as CSV with `token`, `timestamp` and `when` columns.
+
+    A header row is written before the first record.
+
+    """
+    def __init__(self, stream, batch_size=1000):
+        super(CSVFeedbackSink, self).__init__(stream, batch_size)
+
+        self._writer = csv.writer(stream)
+        self._header = False
+
+    def write_records(self, records):
+        if not self._header:
+            self._writer.writerow(['token', 'timestamp', 'when'])
+            self._header = True
+
+        self._writer.writerows(
+            [record.token, _timestamp(record), record.when.isoformat() + 'Z']
+            for record in records
+        )
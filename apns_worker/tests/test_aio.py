@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+
+from binascii import unhexlify
+from datetime import datetime
+import struct
+from threading import current_thread
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import asyncio
+    from apns_worker.aio import AsyncApnsManager
+except (ImportError, SyntaxError):
+    AsyncApnsManager = None
+
+from apns_worker import Message
+from apns_worker.tests.test_threaded_backend import BackendTestBase
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+@unittest.skipIf(AsyncApnsManager is None, "asyncio is not available.")
+class AsyncTestCase(BackendTestBase):
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+
+        self.loop = asyncio.new_event_loop()
+        self._aio = None
+
+    def tearDown(self):
+        self.loop.close()
+
+        super(AsyncTestCase, self).tearDown()
+
+    @property
+    def aio(self):
+        if self._aio is None:
+            self._aio = AsyncApnsManager(manager=self.apns, chunk_size=2, loop=self.loop)
+
+        return self._aio
+
+    def test_send_chunked(self):
+        msg = Message([_token1, _token2, _token3], {'aps': {'badge': 1}})
+        appends = []
+        append = self.apns._queue.append
+
+        def spy(message, start=0, stop=None, expected=None):
+            appends.append((start, stop))
+            return append(message, start, stop, expected)
+
+        self.apns._queue.append = spy
+        future = self.loop.run_until_complete(self.aio.send_message(msg))
+        self.loop.run_until_complete(self.aio.flush())
+
+        self.assertEqual(appends, [(0, 2), (2, 4)])
+        self.assertEqual(self.sent_tokens, [_token1, _token2, _token3])
+        self.assertEqual(self.loop.run_until_complete(future).delivered, 3)
+
+    def test_first_chunk_completes(self):
+        msg = Message([_token1, _token2, _token3, _token1], {}, expiration=datetime(2015, 1, 1))
+        append = self.apns._queue.append
+
+        def spy(message, start=0, stop=None, expected=None):
+            future = append(message, start, stop, expected)
+            # Let each chunk expire before the next is queued.
+            self.apns.flush_messages(timeout=2)
+            return future
+
+        self.apns._queue.append = spy
+        future = self.loop.run_until_complete(self.aio.send_message(msg))
+        report = self.loop.run_until_complete(asyncio.wait_for(future, 2))
+
+        self.assertEqual(report.expired, 4)
+
+    def test_off_loop(self):
+        threads = []
+        append = self.apns._queue.append
+
+        def spy(message, start=0, stop=None, expected=None):
+            threads.append(current_thread())
+            return append(message, start, stop, expected)
+
+        def build(*args):
+            threads.append(current_thread())
+            return Message(*args)
+
+        self.apns._queue.append = spy
+        with mock.patch('apns_worker.aio.Message', build):
+            self.loop.run_until_complete(self.aio.send_aps([_token1, _token2, _token3], badge=1))
+
+        self.assertEqual(len(threads), 3)
+        self.assertFalse(current_thread() in threads)
+
+    def test_send_aps(self):
+        self.loop.run_until_complete(self.aio.send_aps([_token1], badge=1))
+        result = self.loop.run_until_complete(self.aio.flush(timeout=5))
+
+        self.assertTrue(result.complete)
+        self.assertEqual(self.sent_frames[0].decoded, {'aps': {'badge': 1}})
+
+    def test_feedback(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2))
+        it = self.aio.feedback()
+        feedbacks = []
+
+        while True:
+            try:
+                feedbacks.append(self.loop.run_until_complete(it.__anext__()))
+            except StopAsyncIteration:  # noqa
+                break
+
+        self.assertEqual([f.token for f in feedbacks], [_token1, _token2])
+        self.assertEqual(feedbacks[0].when, datetime(2015, 9, 1))
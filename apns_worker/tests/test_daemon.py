@@ -0,0 +1,166 @@
+from __future__ import unicode_literals
+
+import logging
+import os.path
+import shutil
+import socket
+import tempfile
+from threading import Event
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from apns_worker import Message, TemplateMessage
+from apns_worker.daemon import ApnsClient, ClientHandler, SenderDaemon
+from apns_worker.simulator import CERT_PATH, Simulator
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Requires Unix domain sockets.")
+class DaemonTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(DaemonTestCase, cls).setUpClass()
+
+        logger = logging.getLogger('apns_worker')
+        logger.setLevel(logging.ERROR)
+
+    def setUp(self):
+        super(DaemonTestCase, self).setUp()
+
+        self.simulator = Simulator()
+        self.simulator.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'apns.sock')
+        self.daemon = SenderDaemon(
+            self.path, CERT_PATH, CERT_PATH, environment=self.simulator.environment, message_grace=0.2
+        )
+        self.daemon.start()
+
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.daemon.stop(timeout=1)
+        self.simulator.stop()
+        shutil.rmtree(self.tmpdir)
+
+        super(DaemonTestCase, self).tearDown()
+
+    def client(self):
+        errors = []
+        client = ApnsClient(self.path, error_handler=errors.append)
+        client.errors = errors
+        self.clients.append(client)
+
+        return client
+
+    def received_tokens(self):
+        return [notification.token for notification in self.simulator.notifications]
+
+    def test_send(self):
+        client = self.client()
+        report = client.send_aps([_token1, _token2], badge=1).result(timeout=5)
+
+        self.assertEqual(report.delivered, 2)
+        self.assertEqual(self.received_tokens(), [_token1, _token2])
+        self.assertEqual(self.simulator.notifications[0].payload, b'{"aps":{"badge":1}}')
+
+    def test_priority(self):
+        client = self.client()
+        client.send_message(Message([_token1], {}, priority=5)).result(timeout=5)
+
+        self.assertEqual(self.simulator.notifications[0].priority, 5)
+        self.assertEqual(self.simulator.notifications[0].expiration, None)
+
+    def test_template(self):
+        client = self.client()
+        message = TemplateMessage([_token1, _token2], {'name': '{name}'}, [{'name': 'a'}, {'name': 'bb'}])
+        client.send_message(message).result(timeout=5)
+
+        self.assertEqual([n.payload for n in self.simulator.notifications], [b'{"name":"a"}', b'{"name":"bb"}'])
+
+    def test_errors_routed(self):
+        self.simulator.errors[_token2] = 8
+        client1 = self.client()
+        client2 = self.client()
+
+        message = Message([_token1, _token2], {})
+        report = client1.send_message(message).result(timeout=5)
+        client2.send_message(Message([_token3], {})).result(timeout=5)
+
+        self.assertEqual(report.errors, {8: 1})
+        self.assertEqual(len(client1.errors), 1)
+        self.assertEqual(client1.errors[0].status, 8)
+        self.assertEqual(client1.errors[0].token, _token2)
+        self.assertTrue(client1.errors[0].message is message)
+        self.assertEqual(client2.errors, [])
+
+    def test_send_messages(self):
+        client = self.client()
+        client.send_messages([Message([_token1], {}), Message([_token2, _token3], {})])
+        result = client.flush_messages(timeout=5)
+
+        self.assertTrue(result.complete)
+        self.assertEqual(sorted(self.received_tokens()), [_token1, _token2, _token3])
+
+    def test_token_size(self):
+        client = self.client()
+
+        with self.assertRaises(ValueError):
+            client.send_messages([Message([_token1], {}), Message([_token2, 'abcd'], {})])
+        report = client.send_message(Message([_token3], {})).result(timeout=5)
+
+        self.assertEqual(report.delivered, 1)
+        self.assertEqual(self.received_tokens(), [_token3])
+
+    def test_lost_connection(self):
+        client = self.client()
+        self.simulator.latency = 0.5
+        self.simulator.errors[_token1] = 8
+        future = client.send_message(Message([_token1], {}))
+        while self.daemon.clients == 0:
+            time.sleep(0.01)
+
+        for handler in list(self.daemon._clients):
+            handler.disconnect()
+
+        self.assertTrue(isinstance(future.exception(timeout=5), socket.error))
+        self.assertEqual(client.flush_messages(timeout=1).pending, 0)
+
+    def test_slow_client(self):
+        unstuck = Event()
+        setup, write_replies = ClientHandler.setup, ClientHandler.write_replies
+
+        def first_setup(handler):
+            setup(handler)
+            # Only the first client stops reading.
+            handler.stuck = (self.daemon.clients == 0)
+
+        def stuck_write_replies(handler, frames):
+            if handler.stuck:
+                unstuck.wait(5)
+            write_replies(handler, frames)
+
+        with mock.patch.multiple(ClientHandler, setup=first_setup, write_replies=stuck_write_replies,
+                                 max_pending_replies=1):
+            slow = self.client()
+            futures = [slow.send_message(Message([_token1], {})) for i in range(4)]
+            while self.daemon.clients == 0:
+                time.sleep(0.01)
+            report = self.client().send_message(Message([_token2], {})).result(timeout=5)
+
+            self.assertEqual(report.delivered, 1)
+            self.assertTrue(isinstance(futures[-1].exception(timeout=5), socket.error))
+
+        unstuck.set()
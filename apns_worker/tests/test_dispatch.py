@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+import logging
+from threading import Event, Thread
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from apns_worker.dispatch import Dispatcher
+
+
+class DispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DispatcherTestCase, self).setUp()
+
+        self.handled = []
+        self.gate = Event()
+        self.gate.set()
+        self.dispatcher = None
+
+    def tearDown(self):
+        self.gate.set()
+        if self.dispatcher is not None:
+            self.dispatcher.close(timeout=1)
+
+        super(DispatcherTestCase, self).tearDown()
+
+    def handler(self, item):
+        self.gate.wait(5)
+        self.handled.append(item)
+
+    def dispatch(self, **kwargs):
+        self.dispatcher = Dispatcher(self.handler, **kwargs)
+
+        return self.dispatcher
+
+    def test_items(self):
+        dispatcher = self.dispatch()
+        for i in range(5):
+            dispatcher(i)
+
+        self.assertTrue(dispatcher.flush(timeout=1))
+        self.assertEqual(self.handled, [0, 1, 2, 3, 4])
+
+    def test_batches(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(batch_size=2)
+        self._hold(dispatcher)
+        for i in range(5):
+            dispatcher(i)
+        self.gate.set()
+
+        self.assertTrue(dispatcher.flush(timeout=1))
+        self.assertEqual(self.handled, [['held'], [0, 1], [2, 3], [4]])
+
+    def test_drop_oldest(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(max_pending=2)
+        self._fill(dispatcher)
+        self.gate.set()
+
+        dispatcher.flush(timeout=1)
+        self.assertEqual(self.handled, ['held', 2, 3])
+        self.assertEqual(dispatcher.dropped, 2)
+
+    def test_drop_newest(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(max_pending=2, overflow=Dispatcher.DROP_NEWEST)
+        self._fill(dispatcher)
+        self.gate.set()
+
+        dispatcher.flush(timeout=1)
+        self.assertEqual(self.handled, ['held', 0, 1])
+        self.assertEqual(dispatcher.dropped, 2)
+
+    def test_block(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(max_pending=2, overflow=Dispatcher.BLOCK)
+        thread = Thread(target=self._fill, args=(dispatcher,))
+        thread.start()
+        thread.join(0.1)
+
+        self.assertTrue(thread.is_alive())
+
+        self.gate.set()
+        thread.join(1)
+        dispatcher.flush(timeout=1)
+        self.assertEqual(self.handled, ['held', 0, 1, 2, 3])
+        self.assertEqual(dispatcher.dropped, 0)
+
+    def test_submit_block(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(max_pending=2)
+        self._hold(dispatcher)
+        thread = Thread(target=lambda: [dispatcher.submit(i, block=True) for i in range(4)])
+        thread.start()
+        thread.join(0.1)
+
+        self.assertTrue(thread.is_alive())
+
+        self.gate.set()
+        thread.join(1)
+        dispatcher.flush(timeout=1)
+        self.assertEqual(self.handled, ['held', 0, 1, 2, 3])
+        self.assertEqual(dispatcher.dropped, 0)
+
+    def test_pending_batch(self):
+        self.gate.clear()
+        dispatcher = self.dispatch(batch_size=10)
+        # Make sure the worker takes them as a single batch.
+        with dispatcher._cond:
+            for i in range(3):
+                dispatcher(i)
+        while len(dispatcher._items) > 0:
+            time.sleep(0.001)
+
+        self.assertEqual(dispatcher.pending, 3)
+
+    def test_flush_timeout(self):
+        self.gate.clear()
+        dispatcher = self.dispatch()
+        dispatcher(1)
+
+        self.assertFalse(dispatcher.flush(timeout=0.05))
+        self.assertEqual(dispatcher.pending, 1)
+
+    def test_exception(self):
+        dispatcher = self.dispatch()
+        dispatcher.handler = lambda item: 1 / item
+
+        logging.getLogger('apns_worker.dispatch').disabled = True
+        try:
+            dispatcher(0)
+            dispatcher(1)
+            self.assertTrue(dispatcher.flush(timeout=1))
+        finally:
+            logging.getLogger('apns_worker.dispatch').disabled = False
+
+    def test_closed(self):
+        dispatcher = self.dispatch()
+        dispatcher.close()
+
+        with self.assertRaises(RuntimeError):
+            dispatcher(1)
+
+    def test_overflow(self):
+        with self.assertRaises(ValueError):
+            Dispatcher(self.handler, overflow='explode')
+
+    def test_fork(self):
+        dispatcher = self.dispatch()
+        threads = dispatcher._threads
+
+        with mock.patch('apns_worker.fork.current_pid', lambda: -1):
+            dispatcher(1)
+            self.assertTrue(dispatcher.flush(timeout=1))
+
+        self.assertFalse(dispatcher._threads is threads)
+        self.assertEqual(self.handled, [1])
+
+    def _hold(self, dispatcher):
+        """ Gives the worker an item to block on. """
+        dispatcher('held')
+        while len(dispatcher._items) > 0:
+            time.sleep(0.001)
+
+    def _fill(self, dispatcher):
+        """ Holds the worker with one item and queues four more. """
+        self._hold(dispatcher)
+        for i in range(4):
+            dispatcher(i)
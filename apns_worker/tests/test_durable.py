@@ -0,0 +1,291 @@
+from __future__ import unicode_literals
+
+from binascii import unhexlify
+from datetime import datetime, timedelta
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from apns_worker.apns import Message, TemplateMessage, DeliveryReport, Error
+from apns_worker.durable import DurableNotificationQueue, SegmentLog
+from apns_worker.tests.test_queue import TestBackend
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+class SegmentLogTestCase(unittest.TestCase):
+    def setUp(self):
+        super(SegmentLogTestCase, self).setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.log = SegmentLog(self.path, segment_size=256)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.path)
+
+        super(SegmentLogTestCase, self).tearDown()
+
+    def reopen(self):
+        self.log.close()
+        self.log = SegmentLog(self.path, segment_size=256)
+
+    def records(self, count, payload=b'{}'):
+        return [(unhexlify('{0:064x}'.format(i)), payload, None, None) for i in range(count)]
+
+    def test_append(self):
+        self.assertEqual(self.log.append(self.records(2)), 0)
+        self.assertEqual(self.log.append([(unhexlify(_token1), b'{"a":1}', 1234, 10)]), 2)
+        self.reopen()
+
+        self.assertEqual(self.log.next_seq, 3)
+        self.assertEqual(list(self.log.replay())[-1], (2, unhexlify(_token1), b'{"a":1}', 1234, 10))
+
+    def test_ack(self):
+        self.log.append(self.records(3))
+        self.log.ack(2)
+        self.reopen()
+
+        self.assertEqual([record[0] for record in self.log.replay()], [2])
+
+    def test_segments(self):
+        # 50 bytes per record, so five to a segment.
+        self.log.append(self.records(12))
+        self.assertEqual(self.log.segments, 3)
+
+        self.log.ack(10)
+        self.assertEqual(self.log.segments, 1)
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.log')]), 1)
+
+        self.reopen()
+        self.assertEqual([record[0] for record in self.log.replay()], [10, 11])
+        self.assertEqual(self.log.append(self.records(1)), 12)
+
+    def test_read(self):
+        self.log.append(self.records(12))
+
+        self.assertEqual([record[0] for record in self.log.read(3, 4)], [3, 4, 5, 6])
+        self.assertEqual([record[0] for record in self.log.read(7, 5)], [7, 8, 9, 10, 11])
+        self.assertEqual(list(self.log.read(1, 1))[0][1], unhexlify('{0:064x}'.format(1)))
+
+        with self.assertRaises(ValueError):
+            list(self.log.read(11, 2))
+
+    def test_token_size(self):
+        tokens = [b'\x01' * 31, b'\x02' * 33, b'']
+        self.log.append([(token, b'{}', None, None) for token in tokens])
+        self.reopen()
+
+        self.assertEqual([record[1] for record in self.log.replay()], tokens)
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            self.log.append(self.records(1, b'x' * 256))
+
+    def test_torn_record(self):
+        self.log.append(self.records(3))
+        segment = self.log._segments[-1]
+        segment._map[segment.end - 1:segment.end] = b'\xff'
+        self.reopen()
+
+        self.assertEqual([record[0] for record in self.log.replay()], [0, 1])
+        self.assertEqual(self.log.append(self.records(1)), 2)
+
+    @unittest.skipIf(os.name != 'posix', "Requires flock.")
+    def test_locked(self):
+        with self.assertRaises(RuntimeError):
+            SegmentLog(self.path)
+
+
+class DurableQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DurableQueueTestCase, self).setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.queue = None
+        self.open()
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.path)
+
+        super(DurableQueueTestCase, self).tearDown()
+
+    def open(self, **kwargs):
+        if self.queue is not None:
+            self.queue.close()
+
+        self.queue = DurableNotificationQueue(self.path, grace=0, **kwargs)
+        self.backend = TestBackend(self.queue)
+
+    def drain(self):
+        tokens = []
+        notification = self.queue.claim()
+        while notification is not None:
+            tokens.append(notification.token)
+            notification = self.queue.claim()
+
+        return tokens
+
+    def test_acknowledge(self):
+        future = self.queue.append(Message([_token1, _token2, _token3], {}))
+        self.queue.claim()
+        self.queue.claim()
+        self.queue.purge_expired()
+
+        self.assertEqual(self.queue.log.acked, 2)
+
+        self.queue.claim()
+        self.queue.purge_expired()
+
+        self.assertEqual(self.queue.log.acked, 3)
+        self.assertEqual(future.result(0).delivered, 3)
+
+    def test_replay(self):
+        self.queue.append(Message([_token1, _token2], {'a': 1}, priority=5))
+        self.queue.append(Message([_token3], {'b': 2}))
+        self.queue.claim()
+        self.queue.purge_expired()
+        self.queue.claim()
+
+        self.open()
+
+        self.assertEqual(self.queue._len(), 2)
+        n2 = self.queue.claim()
+        n3 = self.queue.claim()
+        self.assertEqual((n2.token, n2.message.payload, n2.message.priority), (_token2, {'a': 1}, 5))
+        self.assertEqual((n3.token, n3.message.payload, n3.message.priority), (_token3, {'b': 2}, None))
+
+    def test_replay_template(self):
+        self.queue.append(TemplateMessage([_token1, _token2], {'n': '{n}'}, [{'n': 1}, {'n': 2}]))
+
+        self.open()
+
+        self.assertEqual([n.encoded_payload for n in [self.queue.claim(), self.queue.claim()]], [b'{"n":1}', b'{"n":2}'])
+
+    def test_replay_error(self):
+        self.queue.append(Message([_token1, _token2], {}))
+        self.open()
+
+        n1 = self.queue.claim()
+        self.queue.claim()
+        self.queue.backtrack(n1.ident, status=8)
+        self.queue.claim()
+        self.queue.purge_expired()
+
+        self.assertEqual(self.queue.log.acked, 2)
+        self.assertEqual(n1.message.report(), DeliveryReport(3, 1, 1, 0, {8: 1}))
+
+    def test_expired(self):
+        expired = datetime.utcnow() - timedelta(days=1)
+        self.queue.append(Message([_token1], {}, expiration=expired))
+        self.queue.append(Message([_token2], {}))
+
+        self.assertEqual(self.drain(), [_token2])
+        self.assertEqual(self.queue.log.acked, 1)
+
+    def test_exhausted(self):
+        self.open(max_attempts=1)
+        self.queue.append(Message([_token1], {}))
+        n1 = self.queue.claim()
+        self.queue.backtrack(n1.ident - 1)
+
+        self.assertTrue(self.queue.claim() is None)
+        self.assertEqual(self.backend.errors[0].status, Error.ERR_TOO_MANY_ATTEMPTS)
+        self.assertEqual(self.queue.log.acked, 1)
+
+    def test_spill(self):
+        self.open(memory_limit=2)
+        tokens = ['{0:064x}'.format(i) for i in range(7)]
+        self.queue.append(Message(tokens[:3], {}))
+        self.queue.extend_messages([Message(tokens[3:5], {}), Message(tokens[5:], {})])
+
+        self.assertEqual(len(self.queue._unclaimed), 2)
+        self.assertEqual(self.queue._len(), 7)
+        self.assertTrue(self.queue.has_unclaimed())
+        self.assertEqual(self.queue.metrics.snapshot()['spilled_depth'], 5)
+
+        self.assertEqual(self.drain(), tokens)
+        self.queue.purge_expired()
+
+        self.assertTrue(self.queue.is_empty())
+        self.assertEqual(self.queue.log.acked, 7)
+
+    def test_load_batch(self):
+        self.open(memory_limit=4)
+        self.queue.load_batch = 1
+        tokens = ['{0:064x}'.format(i) for i in range(8)]
+        self.queue.append(Message(tokens, {}))
+
+        claimed = [self.queue.claim().token for i in range(3)]
+
+        self.assertEqual((len(self.queue._unclaimed), self.queue._spilled_count), (2, 3))
+        self.assertEqual(claimed + self.drain(), tokens)
+
+    def test_backtrack_channels(self):
+        tokens = ['{0:064x}'.format(i) for i in range(20)]
+        self.queue.rescan_interval = 0
+        self.queue.append(Message(tokens, {}))
+        claimed = [self.queue.claim('a') for i in range(10)] + [self.queue.claim('b') for i in range(10)]
+
+        # 4 fails on a, and 5-9 go back ahead of b's 10-19.
+        self.queue.backtrack(claimed[4].ident, status=8, channel='a')
+        self.assertEqual(self.queue.log.acked, 5)
+
+        # 5 goes out on a, and 12 fails on b, so 13-19 go back ahead of 6-9.
+        n5 = self.queue.claim('a')
+        self.queue.backtrack(claimed[12].ident, status=8, channel='b')
+        self.assertEqual(self.queue.log.acked, 5)
+
+        # 13 goes out on a and is rewound after 5 is confirmed.
+        self.queue.claim('a')
+        self.queue.backtrack(n5.ident, channel='a')
+        self.assertEqual(self.queue.log.acked, 6)
+
+        # Everything from the oldest pending notification is replayed.
+        self.open()
+
+        self.assertEqual(self.drain(), tokens[6:])
+
+    def test_spill_releases_message(self):
+        self.open(memory_limit=2)
+        tokens = ['{0:064x}'.format(i) for i in range(5)]
+        future = self.queue.append(Message(tokens, {'a': 1}, priority=5))
+        ref = weakref.ref(self.queue._unclaimed[0].notification.message)
+
+        # Once the notifications loaded up front are gone, the rest only
+        # exist in the log.
+        received = [self.queue.claim().token, self.queue.claim().token]
+        self.queue.purge_expired()
+        gc.collect()
+
+        self.assertTrue(ref() is None)
+
+        notification = self.queue.claim()
+        self.assertEqual(notification.message.payload, {'a': 1})
+        self.assertEqual(notification.message.priority, 5)
+
+        received.append(notification.token)
+        received.extend(self.drain())
+        self.queue.purge_expired()
+
+        self.assertEqual(received, tokens)
+        self.assertEqual(future.result(0), DeliveryReport(5, 5, 0, 0, {}))
+
+    def test_spill_replay(self):
+        self.open(memory_limit=2)
+        tokens = ['{0:064x}'.format(i) for i in range(5)]
+        self.queue.append(Message(tokens, {}))
+        self.queue.claim()
+        self.queue.purge_expired()
+
+        self.open(memory_limit=2)
+
+        self.assertEqual(len(self.queue._unclaimed), 2)
+        self.assertEqual(self.drain(), tokens[1:])
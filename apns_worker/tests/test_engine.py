@@ -0,0 +1,402 @@
+from __future__ import unicode_literals
+
+import logging
+import shutil
+import socket
+import tempfile
+from time import sleep
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from apns_worker.backend.engine import Engine
+except ImportError:
+    Engine = None
+
+from apns_worker import ApnsManager, Environment, Message
+from apns_worker.multi import MultiAppManager
+from apns_worker.scaling import AutoScaler
+from apns_worker.simulator import CERT_PATH, Simulator
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+@unittest.skipIf(Engine is None, "selectors is not available.")
+class EngineTestCase(unittest.TestCase):
+    """
+    End-to-end tests of the engine backend against the simulator.
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(EngineTestCase, cls).setUpClass()
+
+        logger = logging.getLogger('apns_worker')
+        logger.setLevel(logging.ERROR)
+
+    def setUp(self):
+        super(EngineTestCase, self).setUp()
+
+        self.simulator = Simulator()
+        self.simulator.start()
+        self.engine = Engine()
+        self.errors = []
+
+    def tearDown(self):
+        self.engine.stop()
+        self.simulator.stop()
+
+        super(EngineTestCase, self).tearDown()
+
+    def manager(self, environment=None, scaler=None, message_grace=0.2, **kwargs):
+        return ApnsManager(
+            CERT_PATH, CERT_PATH, environment=(environment or self.simulator.environment),
+            backend_path='apns_worker.backend.engine.Backend',
+            backend_options={'engine': self.engine, 'scaler': scaler},
+            message_grace=message_grace, error_handler=self.errors.append, **kwargs
+        )
+
+    def received_tokens(self):
+        return [notification.token for notification in self.simulator.notifications]
+
+    def test_send(self):
+        apns = self.manager()
+
+        report = apns.send_message(Message([_token1, _token2, _token3], {'aps': {'badge': 1}})).result(timeout=5)
+
+        self.assertEqual(report.delivered, 3)
+        self.assertEqual(self.received_tokens(), [_token1, _token2, _token3])
+        self.assertEqual(apns.metrics.written.value, 3)
+        self.assertEqual(apns.metrics.connections.value, 1)
+
+    def test_error(self):
+        apns = self.manager()
+        self.simulator.errors[_token2] = 8
+
+        report = apns.send_message(Message([_token1, _token2, _token3] * 100, {})).result(timeout=5)
+
+        self.assertEqual((report.delivered, report.failed), (200, 100))
+        self.assertEqual({error.token for error in self.errors}, {_token2})
+        self.assertEqual(self.received_tokens(), [_token1, _token3] * 100)
+        self.assertEqual([record.token for record in apns.recent_writes()][-1], _token3)
+
+    def test_shared_thread(self):
+        apps = [self.manager() for i in range(3)]
+
+        futures = [apns.send_message(Message([_token1] * 10, {})) for apns in apps]
+
+        self.assertEqual([future.result(timeout=5).delivered for future in futures], [10, 10, 10])
+        self.assertEqual(len(self.engine.backends), 3)
+        self.assertEqual(self.simulator.connections, 3)
+
+    def test_stop(self):
+        apns = self.manager()
+        apns.send_message(Message([_token1], {})).result(timeout=5)
+
+        apns._backend.stop()
+        apns._queue.append(Message([_token2], {}))
+        sleep(0.1)
+
+        self.assertEqual(self.engine.backends, [])
+        self.assertEqual(self.received_tokens(), [_token1])
+        self.assertEqual(apns._queue._len(), 1)
+
+    def test_wake_while_draining(self):
+        engine = Engine()
+        wakeup, engine._waker = socket.socketpair()
+        self.addCleanup(wakeup.close)
+        self.addCleanup(engine._waker.close)
+        wakeup.setblocking(False)
+
+        # Another thread wakes the engine while it's draining.
+        def recv(bufsize):
+            engine.wake()
+            return wakeup.recv(bufsize)
+
+        engine._wakeup = mock.Mock(recv=recv)
+        engine.wake()
+        engine._drain_wakeup()
+        engine.wake()
+
+        self.assertEqual(wakeup.recv(4096), b'\0')
+
+    def test_reconnect_backoff(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        address = listener.getsockname()
+        listener.close()
+
+        apns = self.manager(environment=Environment(address, address, None))
+        apns.send_message(Message([_token1], {}))
+        sleep(0.5)
+
+        # 0.1 + 0.2 seconds of backoff, and then we're still waiting.
+        self.assertEqual(apns._backend._failures, 3)
+        self.assertEqual(apns.metrics.written.value, 0)
+        self.assertEqual(apns._queue._len(), 1)
+
+    def test_restart_after_fork(self):
+        apns = self.manager()
+        apns.send_message(Message([_token1], {})).result(timeout=5)
+        old_thread = self.engine._thread
+
+        with mock.patch('apns_worker.fork.current_pid', lambda: -1):
+            apns.send_message(Message([_token2], {})).result(timeout=5)
+            self.assertFalse(self.engine._thread is old_thread)
+            self.engine.stop()
+
+        self.assertEqual(self.received_tokens(), [_token1, _token2])
+
+    def test_scale_up_and_down(self):
+        tokens = ['{0:064x}'.format(i + 1) for i in range(10000)]
+        self.simulator.rate = 4000
+        scaler = AutoScaler(1, 2, min_depth=100, drain_seconds=0.1, sustain=0.1, scale_up_interval=0.1, idle_timeout=0.2)
+        scaler.sample_interval = 0.1
+        apns = self.manager(scaler=scaler)
+
+        apns.send_message(Message(tokens, {}))
+        self.wait_for(lambda: self.simulator.accepted == len(tokens))
+        self.wait_for(lambda: apns.metrics['open_connections'].snapshot() == 1)
+
+        self.assertEqual(apns.metrics.connections.value, 2)
+        self.assertEqual(apns.metrics['open_connections'].snapshot(), 1)
+
+    def test_errors_per_connection(self):
+        tokens = ['{0:064x}'.format(i + 1) for i in range(3000)]
+        self.simulator.rate = 5000
+        for token in tokens[500::1000]:
+            self.simulator.errors[token] = 8
+        # The simulator reads slowly, so leave time for the errors.
+        apns = self.manager(scaler=AutoScaler(2, 2), message_grace=3)
+
+        report = apns.send_message(Message(tokens, {})).result(timeout=10)
+
+        # Each connection only rewinds what it wrote, so nothing arrives twice.
+        self.assertEqual((report.delivered, report.failed), (2997, 3))
+        self.assertEqual(sorted(self.received_tokens()), sorted(set(tokens) - set(tokens[500::1000])))
+
+    def test_durable_queue(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        tokens = ['{0:064x}'.format(i + 1) for i in range(2000)]
+        self.simulator.rate = 5000
+        for token in tokens[500::1000]:
+            self.simulator.errors[token] = 8
+        apns = self.manager(scaler=AutoScaler(2, 2), message_grace=3, queue_path=path)
+        self.addCleanup(apns._queue.close)
+
+        report = apns.send_message(Message(tokens, {})).result(timeout=10)
+
+        self.assertEqual((report.delivered, report.failed), (1998, 2))
+        self.assertEqual(sorted(self.received_tokens()), sorted(set(tokens) - set(tokens[500::1000])))
+        self.assertEqual(apns._queue.log.acked, 2000)
+
+    def wait_for(self, condition, timeout=10):
+        for i in range(int(timeout / 0.05)):
+            if condition():
+                break
+            sleep(0.05)
+
+
+@unittest.skipIf(Engine is None, "selectors is not available.")
+class SchedulingTestCase(unittest.TestCase):
+    """
+    Turn-taking between queues, without any sockets.
+
+    """
+    class FakeBackend(object):
+        def __init__(self, name, pending, turns):
+            self.name = name
+            self.pending = pending
+            self.turns = turns
+
+        def _ready(self, engine, now):
+            return self.pending > 0
+
+        def _take_turn(self, quantum, high_water):
+            count = min(quantum, self.pending)
+            self.pending -= count
+            self.turns.append((self.name, count))
+
+            return (count == quantum)
+
+        def _service(self, engine, now):
+            return None
+
+    def test_round_robin(self):
+        engine = Engine()
+        engine.quantum = 10
+        turns = []
+        engine._backends = [self.FakeBackend('a', 35, turns), self.FakeBackend('b', 5, turns), self.FakeBackend('c', 20, turns)]
+
+        engine._service()
+
+        self.assertEqual(turns, [
+            ('b', 5), ('c', 10), ('a', 10),
+            ('c', 10), ('a', 10),
+            ('c', 0), ('a', 10),
+            ('a', 5),
+        ])
+
+    def test_rotation(self):
+        engine = Engine()
+        turns = []
+        engine._backends = [self.FakeBackend(name, 1, turns) for name in 'abc']
+
+        engine._service()
+        for backend in engine._backends:
+            backend.pending = 1
+        engine._service()
+
+        self.assertEqual(turns, [('b', 1), ('c', 1), ('a', 1), ('c', 1), ('a', 1), ('b', 1)])
+
+
+class AutoScalerTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AutoScalerTestCase, self).setUp()
+
+        self.scaler = AutoScaler(1, 3, min_depth=100, drain_seconds=1, sustain=5, scale_up_interval=10, idle_timeout=30)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            AutoScaler(2, 1)
+        with self.assertRaises(ValueError):
+            AutoScaler(0, 0)
+
+    def test_first_connection(self):
+        self.assertFalse(self.scaler.should_add(0, 0, 0))
+        self.assertTrue(self.scaler.should_add(0, 0, 1))
+
+    def test_rate(self):
+        self.scaler.record(0, 0, 1)
+        self.scaler.record(2, 200, 2)
+        self.scaler.record(3, 400, 2)
+
+        self.assertEqual(self.scaler.rate, 75)
+
+    def test_sustained_backlog(self):
+        self.scaler.record(0, 0, 1)
+        self.scaler.record(1, 100, 1)
+
+        self.assertFalse(self.scaler.should_add(1, 1, 500))
+        self.assertFalse(self.scaler.should_add(5, 1, 500))
+        self.assertTrue(self.scaler.should_add(6, 1, 500))
+
+        # Limited in rate.
+        self.assertFalse(self.scaler.should_add(12, 2, 500))
+        self.assertTrue(self.scaler.should_add(16, 2, 500))
+
+        self.assertFalse(self.scaler.should_add(100, 3, 500))
+
+    def test_interrupted_backlog(self):
+        self.scaler.record(0, 0, 1)
+        self.scaler.record(1, 100, 1)
+
+        self.scaler.should_add(1, 1, 500)
+        self.scaler.should_add(4, 1, 50)
+        self.scaler.should_add(5, 1, 500)
+
+        self.assertFalse(self.scaler.should_add(9, 1, 500))
+        self.assertTrue(self.scaler.should_add(10, 1, 500))
+
+    def test_keeping_up(self):
+        self.scaler.record(0, 0, 1)
+        self.scaler.record(1, 1000, 1)
+
+        self.scaler.should_add(1, 1, 500)
+
+        self.assertFalse(self.scaler.should_add(10, 1, 500))
+
+    def test_not_writing(self):
+        self.scaler.should_add(0, 1, 500)
+
+        self.assertFalse(self.scaler.should_add(10, 1, 500))
+
+    def test_should_close(self):
+        self.assertFalse(self.scaler.should_close(1, 60))
+        self.assertFalse(self.scaler.should_close(2, 20))
+        self.assertTrue(self.scaler.should_close(2, 30))
+
+
+@unittest.skipIf(Engine is None, "selectors is not available.")
+class MultiAppManagerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(MultiAppManagerTestCase, cls).setUpClass()
+
+        logger = logging.getLogger('apns_worker')
+        logger.setLevel(logging.ERROR)
+
+    def setUp(self):
+        super(MultiAppManagerTestCase, self).setUp()
+
+        self.simulator = Simulator()
+        self.simulator.start()
+        self.errors = []
+
+        self.apns = MultiAppManager(message_grace=0.2, error_handler=self.errors.append)
+        for app_id in ['news', 'chat']:
+            self.apns.register(app_id, CERT_PATH, CERT_PATH, environment=self.simulator.environment)
+
+    def tearDown(self):
+        self.apns.close(timeout=1)
+        self.simulator.stop()
+
+        super(MultiAppManagerTestCase, self).tearDown()
+
+    def test_routing(self):
+        self.simulator.errors[_token2] = 8
+
+        self.apns.send_message('news', Message([_token1, _token2], {}))
+        self.apns.send_messages('chat', [Message([_token3], {})])
+        result = self.apns.flush_messages(timeout=5)
+
+        self.assertEqual(result.pending, 0)
+        self.assertEqual(self.apns.metrics['news'].appended.value, 2)
+        self.assertEqual(self.apns.metrics['chat'].appended.value, 1)
+        self.assertEqual(self.apns.metrics['news'].errors.snapshot(), {8: 1})
+        self.assertEqual([error.token for error in self.errors], [_token2])
+        self.assertEqual(sorted(self.received_tokens()), [_token1, _token3])
+        self.assertEqual(len(self.apns.engine.backends), 2)
+
+    def test_unknown_app(self):
+        with self.assertRaises(KeyError):
+            self.apns.send_aps('mail', [_token1], alert="Hi")
+
+    def test_duplicate_app(self):
+        with self.assertRaises(ValueError):
+            self.apns.register('news', CERT_PATH, CERT_PATH)
+
+    def test_unregister(self):
+        self.apns.send_message('chat', Message([_token1], {}))
+
+        result = self.apns.unregister('chat', timeout=5)
+
+        self.assertEqual(result.pending, 0)
+        self.assertEqual(self.apns.app_ids, ['news'])
+        self.assertFalse('chat' in self.apns)
+        self.assertEqual(len(self.apns.engine.backends), 1)
+
+    def test_prometheus(self):
+        self.apns.send_message('chat', Message([_token1], {}))
+
+        text = self.apns.prometheus()
+
+        self.assertIn(
+            '# TYPE apns_appended_total counter\n'
+            'apns_appended_total{app="news"} 0\n'
+            'apns_appended_total{app="chat"} 1\n',
+            text
+        )
+        self.assertEqual(text.count('# TYPE apns_queue_wait_seconds histogram'), 1)
+        self.assertIn('apns_queue_wait_seconds_bucket{app="chat",le="+Inf"}', text)
+
+    def received_tokens(self):
+        return [notification.token for notification in self.simulator.notifications]
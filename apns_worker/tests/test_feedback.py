@@ -7,7 +7,7 @@ from datetime import datetime, timedelta
 from struct import pack
 import unittest
 
-from apns_worker.apns import Feedback
+from apns_worker.apns import Feedback, FeedbackParser, RawFeedback
 
 
 _token1 = '1ba97ad1311307c189696e2369c89fa83d652611a6e3c7370881289e45668fd3'
@@ -76,3 +76,70 @@ class FeedbackTestCase(unittest.TestCase):
         self.assertEqual(f2.token, _token2)
         self.assertEqual(f2.when, self._when + timedelta(seconds=1))
         self.assertEqual(remainder, b'')
+
+
+class FeedbackParserTestCase(unittest.TestCase):
+    _when = datetime(2015, 9, 1)
+    _timestamp = int((_when - datetime(1970, 1, 1)).total_seconds())
+
+    def test_parse_empty(self):
+        parser = FeedbackParser()
+
+        self.assertEqual(parser.parse(), [])
+        self.assertEqual(len(parser), 0)
+
+    def test_parse_partial(self):
+        parser = FeedbackParser()
+        parser.feed(pack('!IH30s', self._timestamp, 32, unhexlify(_token1)))
+
+        self.assertEqual(parser.parse(), [])
+        self.assertEqual(len(parser), 36)
+
+    def test_parse_split(self):
+        buf = pack(
+            '!IH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2)
+        )
+        parser = FeedbackParser()
+
+        parser.feed(buf[:50])
+        first = parser.parse()
+        parser.feed(buf[50:])
+        second = parser.parse()
+
+        self.assertEqual(first, [Feedback(_token1, self._when)])
+        self.assertEqual(second, [Feedback(_token2, self._when + timedelta(seconds=1))])
+        self.assertEqual(len(parser), 0)
+
+    def test_parse_leftovers(self):
+        parser = FeedbackParser(compact_at=1000)
+        parser.feed(pack('!IH32sI', self._timestamp, 32, unhexlify(_token1), 0x01020304))
+
+        records = parser.parse()
+
+        self.assertEqual(records, [Feedback(_token1, self._when)])
+        self.assertEqual(len(parser), 4)
+        self.assertEqual(parser._offset, 38)
+
+    def test_compact(self):
+        parser = FeedbackParser(compact_at=38)
+        parser.feed(pack('!IH32sI', self._timestamp, 32, unhexlify(_token1), 0x01020304))
+
+        parser.parse()
+
+        self.assertEqual(parser._offset, 0)
+        self.assertEqual(bytes(parser._buf), b'\x01\x02\x03\x04')
+
+    def test_lazy(self):
+        parser = FeedbackParser(lazy=True)
+        parser.feed(pack('!IH32s', self._timestamp, 32, unhexlify(_token1)))
+
+        record = parser.parse()[0]
+
+        self.assertTrue(isinstance(record, RawFeedback))
+        self.assertEqual(record.encoded_token, unhexlify(_token1))
+        self.assertEqual(record.timestamp, self._timestamp)
+        self.assertEqual(record.token, _token1)
+        self.assertEqual(record.when, self._when)
+        self.assertEqual(record.decode(), Feedback(_token1, self._when))
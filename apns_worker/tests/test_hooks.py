@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+
+import logging
+import unittest
+
+from apns_worker.apns import Message
+from apns_worker.hooks import Hooks
+from apns_worker.queue import NotificationQueue
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+class HooksTestCase(unittest.TestCase):
+    def setUp(self):
+        super(HooksTestCase, self).setUp()
+
+        self.hooks = Hooks()
+        self.queue = NotificationQueue(grace=0, hooks=self.hooks)
+        self.calls = []
+
+    def record(self, point):
+        def hook(*args):
+            self.calls.append((point,) + args)
+
+        return self.hooks.register(point, hook)
+
+    def test_empty(self):
+        self.assertTrue(all(getattr(self.hooks, point) is None for point in Hooks.POINTS))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.hooks.register('nope', lambda: None)
+
+    def test_unregister(self):
+        hook = self.record('claim')
+        self.hooks.unregister('claim', hook)
+
+        self.assertEqual(self.hooks.claim, None)
+        with self.assertRaises(ValueError):
+            self.hooks.unregister('claim', hook)
+
+    def test_queue(self):
+        for point in ['append', 'claim', 'backtrack', 'purge']:
+            self.record(point)
+
+        message = Message([_token1, _token2, _token3], {})
+        self.queue.append(message)
+        n1 = self.queue.claim()
+        n2 = self.queue.claim()
+        self.queue.backtrack(n2.ident, status=8)
+
+        self.assertEqual(self.calls, [
+            ('append', message, 3),
+            ('claim', n1),
+            ('claim', n2),
+            ('backtrack', n2.ident, 8, n2, 0),
+        ])
+
+        self.queue.claim()
+        self.queue.purge_expired()
+
+        self.assertEqual(self.calls[-1], ('purge', 1))
+
+    def test_several(self):
+        self.record('claim')
+        self.record('claim')
+
+        self.queue.append(Message([_token1], {}))
+        notification = self.queue.claim()
+
+        self.assertEqual(self.calls, [('claim', notification), ('claim', notification)])
+
+    def test_exception(self):
+        def broken(notification):
+            raise Exception("Oops")
+
+        self.hooks.register('claim', broken)
+        self.record('claim')
+
+        self.queue.append(Message([_token1], {}))
+        logging.getLogger('apns_worker.hooks').disabled = True
+        try:
+            notification = self.queue.claim()
+        finally:
+            logging.getLogger('apns_worker.hooks').disabled = False
+
+        self.assertEqual(self.calls, [('claim', notification)])
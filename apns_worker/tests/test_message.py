@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 from datetime import datetime
 import unittest
 
-from apns_worker.apns import Message
+from apns_worker.apns import Message, TemplateMessage
 
 
 _token1 = '1ba97ad1311307c189696e2369c89fa83d652611a6e3c7370881289e45668fd3'
@@ -66,3 +66,64 @@ class MessageTestCase(unittest.TestCase):
                 b'\x02\x00\x00\x00D\x01\x00 L#\xf0B\x05\x0fH\xda5\x0c\xb1\x07\x9da\x18\x9c\xf7\xa4|\xb8\xdf\x08t)\xc0\xb2\xdae"l\xbe\xcc\x02\x00\x13{"aps":{"badge":1}}\x04\x00\x04T\xa4\x8e\x00\x05\x00\x01\x05',
             ]
         )
+
+
+class TemplateMessageTestCase(unittest.TestCase):
+    template = {
+        'aps': {'alert': 'Hi {name}, your order {{#{order:05d}}} shipped', 'badge': '{badge}'},
+        'order': '{order}',
+        'tags': ['static', '{name}', 3],
+    }
+
+    values = [
+        {'name': 'Ümlaut "quoted"', 'order': 42, 'badge': 1},
+        {'name': 'Bob', 'order': 7, 'badge': None},
+    ]
+
+    def test_render(self):
+        msg = TemplateMessage([_token1, _token2], self.template, self.values)
+
+        self.assertEqual(msg.payload_for(0), {
+            'aps': {'alert': 'Hi Ümlaut "quoted", your order {#00042} shipped', 'badge': 1},
+            'order': 42,
+            'tags': ['static', 'Ümlaut "quoted"', 3],
+        })
+
+    def test_identical_frames(self):
+        msg = TemplateMessage([_token1, _token2], self.template, self.values,
+                              expiration=datetime(2015, 1, 1), priority=5)
+        frames = [notif.frame() for notif in msg.notifications()]
+
+        expected = [
+            notif.frame()
+            for i, token in enumerate([_token1, _token2])
+            for notif in Message([token], msg.payload_for(i), expiration=datetime(2015, 1, 1), priority=5).notifications()
+        ]
+
+        self.assertEqual(frames, expected)
+
+    def test_slice(self):
+        msg = TemplateMessage([_token1, _token2], self.template, self.values)
+        notifs = list(msg.notifications(start=1))
+
+        self.assertEqual(len(notifs), 1)
+        self.assertEqual(notifs[0].encoded_payload, Message([_token2], msg.payload_for(1))._encoded_payload)
+        self.assertEqual(notifs[0].size, len(notifs[0].frame()))
+
+    def test_static(self):
+        msg = TemplateMessage([_token1], {'aps': {'alert': '{{literal}}'}}, [{}])
+        notif = next(msg.notifications())
+
+        self.assertEqual(notif.encoded_payload, b'{"aps":{"alert":"{literal}"}}')
+
+    def test_missing_value(self):
+        with self.assertRaises(KeyError):
+            TemplateMessage([_token1], self.template, [{'name': 'Bob'}])
+
+    def test_wrong_count(self):
+        with self.assertRaises(ValueError):
+            TemplateMessage([_token1, _token2], self.template, self.values[:1])
+
+    def test_marker_collision(self):
+        with self.assertRaises(ValueError):
+            TemplateMessage([_token1], {'a': '{x}', 'b': '\ue0000\ue001'}, [{'x': 1}])
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from six.moves.urllib.request import urlopen
+
+from apns_worker.apns import Message
+from apns_worker.metrics import Metrics, Histogram, start_http_server
+from apns_worker.queue import NotificationQueue
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_snapshot(self):
+        histogram = Histogram('test', "Test.", [1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+
+        self.assertEqual(snapshot.count, 4)
+        self.assertEqual(snapshot.sum, 56.5)
+        self.assertEqual(snapshot.buckets, [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(snapshot.quantile(0.5), 1)
+        self.assertEqual(snapshot.quantile(0.75), 10)
+
+    def test_empty(self):
+        self.assertEqual(Histogram('test', "Test.", [1]).snapshot().quantile(0.5), None)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+
+        self.metrics = Metrics()
+        self.queue = NotificationQueue(grace=10, metrics=self.metrics)
+
+    def test_queue(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+        self.queue.claim()
+        self.queue.claim()
+
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual(snapshot['appended'], 3)
+        self.assertEqual(snapshot['claimed'], 2)
+        self.assertEqual(snapshot['claimed_depth'], 2)
+        self.assertEqual(snapshot['unclaimed_depth'], 1)
+        self.assertTrue(snapshot['oldest_unclaimed_seconds'] >= 0)
+        self.assertEqual(snapshot['queue_wait_seconds'].count, 2)
+
+    def test_backtrack(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+        n1 = self.queue.claim()
+        self.queue.claim()
+        self.queue.claim()
+
+        self.queue.backtrack(n1.ident + 1, status=8)
+        self.queue.claim()
+
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual(snapshot['errors'], {8: 1})
+        self.assertEqual(snapshot['purged'], 1)
+        self.assertEqual(snapshot['resent'], 1)
+        self.assertEqual(snapshot['claimed'], 4)
+        self.assertEqual(snapshot['queue_wait_seconds'].count, 3)
+
+    def test_prometheus(self):
+        self.queue.append(Message([_token1], {}))
+        self.queue.backtrack(self.queue.claim().ident, status=8)
+
+        text = self.metrics.prometheus()
+
+        self.assertIn('# TYPE apns_appended_total counter\napns_appended_total 1\n', text)
+        self.assertIn('apns_errors_total{status="8"} 1\n', text)
+        self.assertIn('# TYPE apns_unclaimed_depth gauge\napns_unclaimed_depth 0\n', text)
+        self.assertIn('apns_queue_wait_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('apns_queue_wait_seconds_count 1\n', text)
+
+    def test_http_server(self):
+        server = start_http_server(self.metrics, 0)
+        try:
+            response = urlopen('http://127.0.0.1:{0}/metrics'.format(server.server_address[1]), timeout=5)
+            body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(body, self.metrics.prometheus())
@@ -3,13 +3,16 @@
 from __future__ import unicode_literals
 
 from datetime import datetime, timedelta
-from threading import Condition
+from threading import Condition, Timer
+from time import time
 import unittest
 
-from apns_worker.apns import Message
+from apns_worker.apns import Message, DeliveryReport, Error
 from apns_worker.backend.base import Backend
 from apns_worker.datetime import Now
+from apns_worker.grace import AdaptiveGrace
 from apns_worker.queue import NotificationQueue
+from apns_worker.window import InFlightWindow
 
 
 _token1 = '1111111111111111111111111111111111111111111111111111111111111111'
@@ -17,6 +20,11 @@ _token2 = '2222222222222222222222222222222222222222222222222222222222222222'
 _token3 = '3333333333333333333333333333333333333333333333333333333333333333'
 
 
+def _items(queue):
+    """ All queued notifications, claimed first. """
+    return list(queue._claimed) + list(queue._unclaimed)
+
+
 class QueueTestCase(unittest.TestCase):
     def setUp(self):
         super(QueueTestCase, self).setUp()
@@ -35,9 +43,25 @@ class QueueTestCase(unittest.TestCase):
 
         self.queue.append(message)
 
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertTrue(all(item.expires is None for item in self.queue._queue))
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertTrue(all(item.expires is None for item in _items(self.queue)))
+        self.assertEqual(self.backend.notifies, 1)
+
+    def test_extend_messages(self):
+        messages = [Message([_token1, _token2], {}), Message([_token3], {})]
+
+        self.queue.extend_messages(messages)
+
+        self.assertEqual([item.notification.ident for item in _items(self.queue)], [0, 1, 2])
         self.assertEqual(self.backend.notifies, 1)
+        self.assertEqual(messages[1].report().sent, 0)
+
+    def test_ident_wrap(self):
+        self.queue._next_ident = 2 ** 32 - 1
+
+        self.queue.append(Message([_token1, _token2], {}))
+
+        self.assertEqual([item.notification.ident for item in _items(self.queue)], [2 ** 32 - 1, 0])
 
     def test_claim_empty(self):
         notif = self.queue.claim()
@@ -51,10 +75,10 @@ class QueueTestCase(unittest.TestCase):
         notif = self.queue.claim()
 
         self.assertTrue(notif is not None)
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 1)
-        self.assertTrue(self.queue._queue[0].expires is not None)
-        self.assertTrue(self.queue._queue[1].expires is None)
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 1)
+        self.assertTrue(_items(self.queue)[0].expires is not None)
+        self.assertTrue(_items(self.queue)[1].expires is None)
 
     def test_claim_all(self):
         message = Message([_token1, _token2], {})
@@ -65,17 +89,17 @@ class QueueTestCase(unittest.TestCase):
         notif = self.queue.claim()
 
         self.assertTrue(notif is None)
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 2)
-        self.assertTrue(all(item.expires is not None for item in self.queue._queue))
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 2)
+        self.assertTrue(all(item.expires is not None for item in _items(self.queue)))
 
     def test_unclaim_empty(self):
         message = Message([_token1, _token2], {})
         ok = self.queue.unclaim(next(message.notifications()))
 
         self.assertFalse(ok)
-        self.assertEqual(len(self.queue._queue), 0)
-        self.assertEqual(self.queue._next, 0)
+        self.assertEqual(len(_items(self.queue)), 0)
+        self.assertEqual(len(self.queue._claimed), 0)
 
     def test_unclaim_last(self):
         message = Message([_token1, _token2], {})
@@ -86,8 +110,8 @@ class QueueTestCase(unittest.TestCase):
         ok = self.queue.unclaim(notif)
 
         self.assertTrue(ok)
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 1)
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 1)
 
     def test_unclaim_invalid(self):
         message = Message([_token1, _token2], {})
@@ -98,14 +122,14 @@ class QueueTestCase(unittest.TestCase):
         ok = self.queue.unclaim(notif)
 
         self.assertFalse(ok)
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 2)
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 2)
 
     def test_backtrack_empty(self):
         self.queue.backtrack(0)
 
-        self.assertEqual(len(self.queue._queue), 0)
-        self.assertEqual(self.queue._next, 0)
+        self.assertEqual(len(_items(self.queue)), 0)
+        self.assertEqual(len(self.queue._claimed), 0)
 
     def test_backtrack_all(self):
         message = Message([_token1, _token2, _token3], {})
@@ -115,11 +139,49 @@ class QueueTestCase(unittest.TestCase):
         self.queue.claim()
         self.queue.backtrack(0)
 
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 0)
-        self.assertTrue(all(item.expires is None for item in self.queue._queue))
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 0)
+        self.assertTrue(all(item.expires is None for item in _items(self.queue)))
         self.assertEqual(self.backend.notifies, 2)
 
+    def test_backtrack_channel(self):
+        message = Message([_token1, _token2, _token3, _token1, _token2], {})
+
+        self.queue.append(message)
+        self.queue.claim(channel='a')
+        b1 = self.queue.claim(channel='b')
+        a2 = self.queue.claim(channel='a')
+        b2 = self.queue.claim(channel='b')
+        a3 = self.queue.claim(channel='a')
+        self.queue.backtrack(a2.ident, status=8, channel='a')
+
+        self.assertEqual([item.notification for item in self.queue._claimed], [b1, b2])
+        self.assertEqual([item.notification for item in self.queue._unclaimed], [a3])
+        self.assertEqual(message.report().failed, 1)
+        self.assertEqual(message.report().delivered, 1)
+
+    def test_unclaim_from(self):
+        message = Message([_token1, _token2, _token3, _token1], {})
+
+        self.queue.append(message)
+        self.queue.claim(channel='a')
+        b1 = self.queue.claim(channel='b')
+        a2 = self.queue.claim(channel='a')
+        b2 = self.queue.claim(channel='b')
+        restored = self.queue.unclaim_from(b1, channel='b')
+
+        self.assertEqual(restored, 2)
+        self.assertEqual([item.channel for item in self.queue._claimed], ['a', 'a'])
+        self.assertEqual([item.notification for item in self.queue._unclaimed], [b1, b2])
+        self.assertEqual(self.queue.claim(), b1)
+        self.assertEqual(self.queue._claimed[1].notification, a2)
+
+    def test_unclaim_from_unknown(self):
+        message = Message([_token1], {})
+
+        self.assertEqual(self.queue.unclaim_from(next(message.notifications())), 0)
+        self.assertEqual(self.queue.unclaimed_count(), 0)
+
     def test_purge_none(self):
         message = Message([_token1, _token2, _token3], {})
 
@@ -128,8 +190,8 @@ class QueueTestCase(unittest.TestCase):
         self.queue.claim()
         delay = self.queue.purge_expired()
 
-        self.assertEqual(len(self.queue._queue), 3)
-        self.assertEqual(self.queue._next, 2)
+        self.assertEqual(len(_items(self.queue)), 3)
+        self.assertEqual(len(self.queue._claimed), 2)
         self.assertLessEqual(delay, self.queue._grace)
 
     def test_purge(self):
@@ -145,8 +207,8 @@ class QueueTestCase(unittest.TestCase):
         with Now(start + timedelta(seconds=self.queue._grace + 1)):
             delay = self.queue.purge_expired()
 
-        self.assertEqual(len(self.queue._queue), 2)
-        self.assertEqual(self.queue._next, 1)
+        self.assertEqual(len(_items(self.queue)), 2)
+        self.assertEqual(len(self.queue._claimed), 1)
         self.assertLessEqual(delay, self.queue._grace)
 
     def test_purge_all(self):
@@ -162,8 +224,8 @@ class QueueTestCase(unittest.TestCase):
         with Now(start + timedelta(seconds=self.queue._grace + 6)):
             delay = self.queue.purge_expired()
 
-        self.assertEqual(len(self.queue._queue), 0)
-        self.assertEqual(self.queue._next, 0)
+        self.assertEqual(len(_items(self.queue)), 0)
+        self.assertEqual(len(self.queue._claimed), 0)
         self.assertEqual(delay, self.queue._grace)
 
     def test_auto_purge(self):
@@ -177,8 +239,40 @@ class QueueTestCase(unittest.TestCase):
         with Now(start + timedelta(seconds=self.queue._grace + 1)):
             self.queue.append(Message([_token2], {}))
 
-        self.assertEqual(len(self.queue._queue), 1)
-        self.assertEqual(self.queue._next, 0)
+        self.assertEqual(len(_items(self.queue)), 1)
+        self.assertEqual(len(self.queue._claimed), 0)
+
+    def test_wait_empty_timeout(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+        self.queue.claim()
+
+        pending = self.queue.wait_empty(timeout=0.05)
+
+        self.assertEqual(pending, 3)
+
+    def test_wait_empty(self):
+        queue = NotificationQueue(grace=0.05)
+        TestBackend(queue)
+        queue.append(Message([_token1, _token2], {}))
+        queue.claim()
+        queue.claim()
+
+        start = time()
+        pending = queue.wait_empty(timeout=5)
+
+        self.assertEqual(pending, 0)
+        self.assertLess(time() - start, 0.5)
+
+    def test_wait_empty_backtrack(self):
+        queue = NotificationQueue(grace=60)
+        TestBackend(queue)
+        queue.append(Message([_token1], {}))
+        notif = queue.claim()
+        Timer(0.05, queue.backtrack, [notif.ident, 8]).start()
+
+        pending = queue.wait_empty(timeout=5)
+
+        self.assertEqual(pending, 0)
 
     def test_is_empty_new(self):
         self.assertTrue(self.queue.is_empty())
@@ -191,6 +285,340 @@ class QueueTestCase(unittest.TestCase):
         self.assertFalse(self.queue.is_empty())
 
 
+class DeliveryTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DeliveryTestCase, self).setUp()
+
+        self.queue = NotificationQueue(grace=10)
+        self.backend = TestBackend(self.queue)
+
+    def test_delivered(self):
+        start = datetime(2015, 1, 1)
+        future = self.queue.append(Message([_token1, _token2], {}))
+
+        with Now(start):
+            self.queue.claim()
+            self.queue.claim()
+        self.assertFalse(future.done())
+
+        with Now(start + timedelta(seconds=11)):
+            self.queue.purge_expired()
+
+        self.assertEqual(future.result(0), DeliveryReport(2, 2, 0, 0, {}))
+
+    def test_failed(self):
+        start = datetime(2015, 1, 1)
+        message = Message([_token1, _token2, _token3], {})
+        future = self.queue.append(message)
+
+        with Now(start):
+            self.queue.claim()
+            notif = self.queue.claim()
+            self.queue.claim()
+            self.queue.backtrack(notif.ident, status=8)
+
+        self.assertEqual(message.report(), DeliveryReport(3, 1, 1, 0, {8: 1}))
+
+        with Now(start):
+            self.queue.claim()
+        with Now(start + timedelta(seconds=11)):
+            self.queue.purge_expired()
+
+        self.assertEqual(future.result(0), DeliveryReport(4, 2, 1, 0, {8: 1}))
+
+    def test_unclaim(self):
+        message = Message([_token1], {})
+        self.queue.append(message)
+
+        self.queue.unclaim(self.queue.claim())
+
+        self.assertEqual(message.report().sent, 0)
+
+    def test_expired(self):
+        future = self.queue.append(Message([_token1, _token2], {}, expiration=datetime(2015, 1, 1)))
+
+        notif = self.queue.claim()
+
+        self.assertTrue(notif is None)
+        self.assertTrue(self.queue.is_empty())
+        self.assertEqual(future.result(0), DeliveryReport(0, 0, 0, 2, {}))
+
+    def test_lazy_future(self):
+        message = Message([_token1], {})
+        self.queue.extend_messages([message])
+        self.queue.backtrack(self.queue.claim().ident, status=8)
+
+        self.assertEqual(message._delivery._future, None)
+        self.assertEqual(message.delivery().result(0), DeliveryReport(1, 0, 1, 0, {8: 1}))
+
+    def test_resend(self):
+        message = Message([_token1], {})
+        first = self.queue.append(message)
+        self.queue.backtrack(self.queue.claim().ident, status=8)
+        second = self.queue.append(message)
+
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertEqual(message.report(), DeliveryReport(0, 0, 0, 0, {}))
+
+    def test_max_attempts(self):
+        self.queue = NotificationQueue(grace=10, max_attempts=2)
+        self.backend = TestBackend(self.queue)
+        message = Message([_token1, _token2], {})
+        future = self.queue.append(message)
+
+        # The connection drops twice with both notifications in flight.
+        for i in range(2):
+            n1 = self.queue.claim()
+            self.queue.claim()
+            self.queue.backtrack(n1.ident - 1)
+
+        self.assertTrue(self.queue.claim() is None)
+        self.assertTrue(self.queue.is_empty())
+        self.assertEqual(future.result(0), DeliveryReport(4, 0, 2, 0, {Error.ERR_TOO_MANY_ATTEMPTS: 2}))
+        self.assertEqual([(error.status, error.token) for error in self.backend.errors], [
+            (Error.ERR_TOO_MANY_ATTEMPTS, _token1), (Error.ERR_TOO_MANY_ATTEMPTS, _token2),
+        ])
+        self.assertEqual(self.queue.metrics.exhausted.value, 2)
+        self.assertEqual(self.queue.metrics.retry_attempts.snapshot().count, 2)
+
+    def test_rejections_are_free(self):
+        self.queue = NotificationQueue(grace=10, max_attempts=1)
+        self.backend = TestBackend(self.queue)
+        tokens = [_token1, _token2, _token3]
+        self.queue.append(Message(tokens * 2, {}))
+
+        # Each bad token sends the notifications behind it around again.
+        for i in range(3):
+            bad = self.queue.claim()
+            while self.queue.claim() is not None:
+                pass
+            self.queue.backtrack(bad.ident, status=Error.ERR_TOKEN_INVAL)
+
+        while self.queue.claim() is not None:
+            pass
+        self.queue.purge_expired()
+
+        self.assertEqual(self.queue.metrics.exhausted.value, 0)
+        self.assertEqual(self.backend.errors, [])
+        self.assertEqual(self.queue.metrics.retry_attempts.snapshot().count, 0)
+        self.assertEqual(self.queue._len(), 3)
+
+    def test_processing_error_charges(self):
+        self.queue = NotificationQueue(grace=10, max_attempts=1)
+        self.backend = TestBackend(self.queue)
+        self.queue.append(Message([_token1, _token2], {}))
+
+        n1 = self.queue.claim()
+        self.queue.claim()
+        self.queue.backtrack(n1.ident, status=Error.ERR_PROCESSING)
+
+        self.assertTrue(self.queue.claim() is None)
+        self.assertEqual([(error.status, error.token) for error in self.backend.errors], [
+            (Error.ERR_TOO_MANY_ATTEMPTS, _token2),
+        ])
+
+    def test_unclaim_is_free(self):
+        self.queue = NotificationQueue(grace=10, max_attempts=1)
+        self.backend = TestBackend(self.queue)
+        self.queue.append(Message([_token1, _token2], {}))
+
+        for i in range(3):
+            n1 = self.queue.claim()
+            self.queue.claim()
+            self.queue.unclaim_from(n1)
+
+        n1 = self.queue.claim()
+        self.queue.claim()
+        self.queue.unclaim_from(n1, interrupted=True)
+
+        self.assertEqual(self.queue.claim().token, _token2)
+        self.assertEqual([(error.status, error.token) for error in self.backend.errors], [
+            (Error.ERR_TOO_MANY_ATTEMPTS, _token1),
+        ])
+
+
+class WindowTestCase(unittest.TestCase):
+    def setUp(self):
+        super(WindowTestCase, self).setUp()
+
+        self.window = InFlightWindow(max_count=2, adaptive=True, min_count=1)
+        self.queue = NotificationQueue(grace=10, window=self.window)
+        self.backend = TestBackend(self.queue)
+
+    def test_claim_limit(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+
+        self.assertTrue(self.queue.claim() is not None)
+        self.assertTrue(self.queue.claim() is not None)
+        self.assertTrue(self.queue.claim() is None)
+        self.assertTrue(self.queue.has_unclaimed())
+        self.assertTrue(self.queue.idle_delay() is not None)
+
+    def test_reopen_after_purge(self):
+        start = datetime(2015, 1, 1)
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+
+        with Now(start):
+            self.queue.claim()
+            self.queue.claim()
+
+        with Now(start + timedelta(seconds=11)):
+            notif = self.queue.claim()
+
+        self.assertEqual(notif.token, _token3)
+        self.assertEqual(len(_items(self.queue)), 1)
+
+    def test_not_throttled(self):
+        self.queue.append(Message([_token1], {}))
+
+        self.assertEqual(self.queue.idle_delay(), None)
+
+    def test_byte_limit(self):
+        window = InFlightWindow(max_bytes=60)
+        queue = NotificationQueue(grace=10, window=window)
+        TestBackend(queue)
+        queue.append(Message([_token1, _token2], {'aps': {'badge': 1}}))
+
+        notif = queue.claim()
+
+        self.assertEqual(notif.size, len(notif.frame()))
+        self.assertTrue(queue.claim() is None)
+
+    def test_adapt_on_error(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+        self.queue.claim()
+        notif = self.queue.claim()
+        self.queue.backtrack(notif.ident, status=8)
+
+        self.assertEqual(self.window.count_limit, 1)
+
+    def test_adapt_on_shutdown(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+        notif = self.queue.claim()
+        self.queue.backtrack(notif.ident)
+
+        self.assertEqual(self.window.count_limit, 2)
+
+
+class ProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ProbeTestCase, self).setUp()
+
+        self.queue = NotificationQueue(grace=10, probe_interval=2)
+        self.backend = TestBackend(self.queue)
+
+    def test_insert_probe(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+
+        notifs = [self.queue.claim() for i in range(4)]
+
+        self.assertEqual([n.is_probe for n in notifs], [False, False, True, False])
+        self.assertEqual(len(_items(self.queue)), 4)
+        self.assertTrue(self.queue.claim() is None)
+
+    def test_probe_confirms(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+
+        notifs = [self.queue.claim() for i in range(4)]
+        notification = self.queue.backtrack(notifs[2].ident, status=8)
+
+        self.assertTrue(notification.is_probe)
+        self.assertEqual(len(_items(self.queue)), 1)
+        self.assertEqual(len(self.queue._claimed), 0)
+        self.assertEqual(self.queue.claim().token, _token3)
+
+    def test_probe_frame(self):
+        self.queue.append(Message([_token1, _token2, _token3], {}))
+
+        probe = [self.queue.claim() for i in range(3)][-1]
+
+        self.assertEqual(probe.frame(), b'\x02\x00\x00\x00\x0f\x01\x00\x00\x02\x00\x02{}\x03\x00\x04\x00\x00\x00\x03')
+        self.assertEqual(probe.size, 20)
+
+
+class AdaptiveGraceTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AdaptiveGraceTestCase, self).setUp()
+
+        self.grace = AdaptiveGrace(initial=10, minimum=2, maximum=20, percentile=90, margin=1, min_samples=2)
+        self.queue = NotificationQueue(grace=self.grace)
+        self.backend = TestBackend(self.queue)
+
+    def test_initial(self):
+        self.assertEqual(self.queue.grace, 10)
+        self.assertEqual(self.grace.distribution()['count'], 0)
+
+    def test_record_errors(self):
+        start = datetime(2015, 1, 1)
+
+        for delay in [1, 3]:
+            self.queue.append(Message([_token1], {}))
+            with Now(start):
+                notif = self.queue.claim()
+            with Now(start + timedelta(seconds=delay)):
+                self.queue.backtrack(notif.ident, status=8)
+
+        self.assertEqual(self.queue.grace, 4)
+        self.assertEqual(self.grace.distribution()['max'], 3)
+
+    def test_record_late_errors(self):
+        start = datetime(2015, 1, 1)
+
+        for delay in [12, 14]:
+            self.queue.append(Message([_token1], {}))
+            with Now(start):
+                notif = self.queue.claim()
+            with Now(start + timedelta(seconds=11)):
+                self.queue.purge_expired()
+            with Now(start + timedelta(seconds=delay)):
+                self.queue.backtrack(notif.ident, status=8)
+
+        self.assertEqual(self.grace.distribution()['count'], 2)
+        self.assertEqual(self.queue.grace, 15)
+
+    def test_ignore_unknown_errors(self):
+        self.queue.append(Message([_token1], {}))
+        self.queue.claim()
+        self.queue.backtrack(12345, status=8)
+
+        self.assertEqual(self.grace.distribution()['count'], 0)
+
+    def test_ignore_shutdown(self):
+        self.queue.append(Message([_token1], {}))
+        notif = self.queue.claim()
+        self.queue.backtrack(notif.ident)
+
+        self.assertEqual(self.grace.distribution()['count'], 0)
+
+    def test_bounds(self):
+        for delay in [0.1, 0.2, 0.3]:
+            self.grace.record(delay)
+        self.assertEqual(self.grace.seconds, 2)
+
+        for delay in [60, 60, 60]:
+            self.grace.record(delay)
+        self.assertEqual(self.grace.seconds, 20)
+
+    def test_new_grace_applies(self):
+        start = datetime(2015, 1, 1)
+        self.grace.record(1)
+        self.grace.record(1)
+        self.queue.append(Message([_token1], {}))
+        self.queue.append(Message([_token2], {}))
+
+        with Now(start):
+            notif = self.queue.claim()
+        with Now(start + timedelta(seconds=1)):
+            self.queue.backtrack(notif.ident, status=8)
+            self.queue.claim()
+        with Now(start + timedelta(seconds=4)):
+            self.queue.purge_expired()
+
+        self.assertEqual(self.queue.grace, 2)
+        self.assertTrue(self.queue.is_empty())
+
+
 class TestBackend(Backend):
     def __init__(self, queue):
         self.lock = Condition()
@@ -198,6 +626,7 @@ class TestBackend(Backend):
 
         # Statistics
         self.notifies = 0
+        self.errors = []
 
     def start(self):
         pass
@@ -218,3 +647,6 @@ class TestBackend(Backend):
 
     def sleep(self):
         pass
+
+    def delivery_error(self, error):
+        self.errors.append(error)
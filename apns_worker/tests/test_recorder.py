@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from apns_worker.apns import Message
+from apns_worker.data import ProbeNotification
+from apns_worker.recorder import FlightRecorder
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+class FlightRecorderTestCase(unittest.TestCase):
+    def test_ring(self):
+        recorder = FlightRecorder(size=2)
+        for notification in Message([_token1, _token2, _token3], {}).notifications(iter([1, 2, 3])):
+            recorder.record(notification)
+
+        records = recorder.dump()
+
+        self.assertEqual(len(recorder), 2)
+        self.assertEqual([(record.ident, record.token) for record in records], [(2, _token2), (3, _token3)])
+        self.assertEqual(records[0].payload_digest, records[1].payload_digest)
+        self.assertEqual(len(records[0].payload_digest), 16)
+        self.assertTrue(records[0].timestamp <= records[1].timestamp)
+
+    def test_probe(self):
+        recorder = FlightRecorder()
+        recorder.record(ProbeNotification(7))
+
+        record = recorder.dump()[0]
+
+        self.assertEqual((record.ident, record.token, record.payload_digest), (7, '', None))
+        self.assertIn('(probe)', str(record))
@@ -0,0 +1,184 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+from functools import partial
+import logging
+import shutil
+import tempfile
+from time import sleep
+import unittest
+
+from apns_worker import ApnsManager, Environment, Message
+from apns_worker.dispatch import Dispatcher
+from apns_worker.simulator import CERT_PATH, Simulator
+
+
+_token1 = '1111111111111111111111111111111111111111111111111111111111111111'
+_token2 = '2222222222222222222222222222222222222222222222222222222222222222'
+_token3 = '3333333333333333333333333333333333333333333333333333333333333333'
+
+
+class SimulatorTestCase(unittest.TestCase):
+    """
+    End-to-end tests against the simulator over real TLS sockets.
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(SimulatorTestCase, cls).setUpClass()
+
+        logger = logging.getLogger('apns_worker')
+        logger.setLevel(logging.WARNING)
+
+    def setUp(self):
+        super(SimulatorTestCase, self).setUp()
+
+        self.simulator = Simulator()
+        self.simulator.start()
+
+        self.errors = []
+        self._apns = None
+
+    def tearDown(self):
+        if self._apns is not None:
+            self._apns._backend.stop()
+        self.simulator.stop()
+
+        super(SimulatorTestCase, self).tearDown()
+
+    @property
+    def apns(self):
+        if self._apns is None:
+            self._apns = self.manager()
+
+        return self._apns
+
+    def manager(self, **kwargs):
+        return ApnsManager(
+            CERT_PATH, CERT_PATH, environment=self.simulator.environment,
+            message_grace=0.2, error_handler=self.errors.append, **kwargs
+        )
+
+    def record_call(self, calls, point, *args):
+        calls.append(point)
+
+    def received_tokens(self):
+        return [notification.token for notification in self.simulator.notifications]
+
+    def test_send(self):
+        future = self.apns.send_message(Message([_token1, _token2, _token3], {'aps': {'badge': 1}}, priority=5))
+        report = future.result(timeout=5)
+
+        self.assertEqual(report.delivered, 3)
+        self.assertEqual(self.received_tokens(), [_token1, _token2, _token3])
+        self.assertEqual(self.simulator.notifications[0].payload, b'{"aps":{"badge":1}}')
+        self.assertEqual(self.simulator.notifications[0].priority, 5)
+
+    def test_error(self):
+        self.simulator.errors[_token2] = 8
+
+        future = self.apns.send_message(Message([_token1, _token2, _token3], {}))
+        report = future.result(timeout=5)
+
+        self.assertEqual((report.delivered, report.failed), (2, 1))
+        self.assertEqual([(error.status, error.token) for error in self.errors], [(8, _token2)])
+        self.assertEqual(self.received_tokens(), [_token1, _token3])
+        self.assertEqual(self.apns.metrics.errors.snapshot(), {8: 1})
+        self.assertEqual(self.apns.metrics.connections.value, 2)
+        self.assertEqual([record.token for record in self.apns.recent_writes()[:2]], [_token1, _token2])
+
+    def test_unverified(self):
+        environment = self.simulator.environment._replace(ca_certs=None)
+        apns = ApnsManager(CERT_PATH, CERT_PATH, environment=environment, message_grace=0.2)
+        try:
+            report = apns.send_message(Message([_token1], {})).result(timeout=5)
+        finally:
+            apns._backend.stop()
+
+        self.assertEqual(report.delivered, 1)
+        self.assertEqual(self.received_tokens(), [_token1])
+
+    def test_apple_unverified(self):
+        self.assertIsNone(Environment.get('production').ca_certs)
+        self.assertIsNone(Environment.get('sandbox').ca_certs)
+
+    def test_hooks(self):
+        calls = []
+        for point in ['before_write', 'after_write', 'response', 'connect', 'close']:
+            self.apns.hooks.register(point, partial(self.record_call, calls, point))
+        self.simulator.errors[_token2] = 8
+
+        self.apns.send_message(Message([_token1, _token2], {})).result(timeout=5)
+
+        # The socket is opened by the first write.
+        self.assertEqual(calls[:3], ['before_write', 'connect', 'after_write'])
+        self.assertEqual(calls.count('after_write'), 2)
+        self.assertEqual(calls.count('response'), 1)
+        self.assertIn('close', calls)
+
+    def test_dispatched_errors(self):
+        batches = []
+        dispatcher = Dispatcher(batches.append, batch_size=10)
+        self._apns = ApnsManager(
+            CERT_PATH, CERT_PATH, environment=self.simulator.environment,
+            message_grace=0.2, error_handler=dispatcher
+        )
+        self.simulator.errors[_token2] = 8
+
+        self.apns.send_message(Message([_token1, _token2, _token3], {})).result(timeout=5)
+        dispatcher.close(timeout=5)
+
+        self.assertEqual([[error.token for error in batch] for batch in batches], [[_token2]])
+        self.assertEqual(self.apns.metrics.snapshot()['error_dispatch_dropped'], 0)
+
+    def test_durable_queue(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self._apns = self.manager(queue_path=path)
+        self.addCleanup(self._apns._queue.close)
+        self.simulator.errors[_token2] = 8
+
+        report = self.apns.send_message(Message([_token1, _token2, _token3], {})).result(timeout=5)
+
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(self.received_tokens(), [_token1, _token3])
+        self.assertEqual(self.apns._queue.log.acked, 3)
+
+    def test_shutdown(self):
+        self.apns.send_message(Message([_token1], {})).result(timeout=5)
+        self.simulator.shutdown_connections()
+        sleep(0.3)
+        self.apns.send_message(Message([_token2], {})).result(timeout=5)
+
+        self.assertEqual(self.received_tokens(), [_token1, _token2])
+        self.assertEqual(self.simulator.connections, 2)
+        self.assertEqual(self.errors, [])
+
+    def test_shutdown_response(self):
+        self.simulator.errors[_token2] = 10
+
+        report = self.apns.send_message(Message([_token1, _token2, _token3], {})).result(timeout=5)
+
+        self.assertEqual(report.delivered, 3)
+        self.assertEqual(self.received_tokens(), [_token1, _token2, _token3])
+        self.assertEqual(self.simulator.connections, 2)
+        self.assertEqual(self.errors, [])
+
+    def test_probe(self):
+        self._apns = self.manager(probe_interval=2)
+
+        self.apns.send_message(Message([_token1, _token2, _token3], {})).result(timeout=5)
+
+        self.assertEqual(self.received_tokens(), [_token1, _token2, _token3])
+        self.assertEqual([status for _, status in self.simulator.rejected], [5])
+        self.assertEqual(self.errors, [])
+
+    def test_feedback(self):
+        self.simulator.feedback = [(_token1, 1441065600), (_token2, 1441065601)]
+
+        records = []
+        count = self.apns.get_feedback(records.append).result(timeout=5)
+
+        self.assertEqual(count, 2)
+        self.assertEqual([record.token for record in records], [_token1, _token2])
+        self.assertEqual(records[0].when, datetime(2015, 9, 1))
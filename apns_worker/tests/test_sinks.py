@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from binascii import unhexlify
+from datetime import datetime, timedelta
+import json
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import six
+
+from apns_worker.apns import Feedback, RawFeedback
+from apns_worker.sinks import SQLiteFeedbackSink, NDJSONFeedbackSink, CSVFeedbackSink
+
+
+_token1 = '1ba97ad1311307c189696e2369c89fa83d652611a6e3c7370881289e45668fd3'
+_token2 = '4c23f042050f48da350cb1079d61189cf7a47cb8df087429c0b2da65226cbecc'
+
+
+class SinkTestCase(unittest.TestCase):
+    _when = datetime(2015, 9, 1)
+    _timestamp = int((_when - datetime(1970, 1, 1)).total_seconds())
+
+    def setUp(self):
+        super(SinkTestCase, self).setUp()
+
+        self.records = [
+            RawFeedback(unhexlify(_token1), self._timestamp),
+            Feedback(_token1, self._when),
+            Feedback(_token2, self._when + timedelta(seconds=1)),
+        ]
+
+    def test_sqlite(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'feedback.db')
+            sink = SQLiteFeedbackSink(path)
+            sink.write(self.records[:2])
+            sink.write(self.records[1:])
+            sink.close()
+
+            db = sqlite3.connect(path)
+            rows = db.execute('SELECT token, timestamp FROM apns_feedback ORDER BY token').fetchall()
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(rows, [(_token1, self._timestamp), (_token2, self._timestamp + 1)])
+        self.assertEqual(sink.written, 2)
+
+    def test_ndjson(self):
+        stream = six.StringIO()
+        sink = NDJSONFeedbackSink(stream)
+        sink.write(self.records)
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+
+        self.assertEqual(lines, [
+            {'token': _token1, 'timestamp': self._timestamp, 'when': '2015-09-01T00:00:00Z'},
+            {'token': _token2, 'timestamp': self._timestamp + 1, 'when': '2015-09-01T00:00:01Z'},
+        ])
+        self.assertEqual(sink.written, 2)
+
+    def test_csv(self):
+        stream = six.StringIO()
+        sink = CSVFeedbackSink(stream)
+        sink.write(self.records[:1])
+        sink.write(self.records[1:])
+
+        self.assertEqual(stream.getvalue().splitlines(), [
+            'token,timestamp,when',
+            '{0},{1},2015-09-01T00:00:00Z'.format(_token1, self._timestamp),
+            '{0},{1},2015-09-01T00:00:01Z'.format(_token2, self._timestamp + 1),
+        ])
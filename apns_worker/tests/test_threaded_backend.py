@@ -6,9 +6,10 @@ from datetime import datetime, timedelta
 from itertools import takewhile, repeat
 import json
 import logging
+import os
 import socket
 import struct
-from threading import Condition
+from threading import Condition, Event, Thread
 from time import sleep
 import unittest
 
@@ -20,7 +21,9 @@ except ImportError:
 import six
 
 from apns_worker import ApnsManager, Message
+from apns_worker.dispatch import Dispatcher
 from apns_worker.backend.threaded import Connection
+from apns_worker.sinks import NDJSONFeedbackSink
 
 
 _token1 = '1111111111111111111111111111111111111111111111111111111111111111'
@@ -28,20 +31,20 @@ _token2 = '2222222222222222222222222222222222222222222222222222222222222222'
 _token3 = '3333333333333333333333333333333333333333333333333333333333333333'
 
 
-class BackendTestCase(unittest.TestCase):
+class BackendTestBase(unittest.TestCase):
     _when = datetime(2015, 9, 1)
     _timestamp = int((_when - datetime(1970, 1, 1)).total_seconds())
 
     @classmethod
     def setUpClass(cls):
-        super(BackendTestCase, cls).setUpClass()
+        super(BackendTestBase, cls).setUpClass()
 
         logger = logging.getLogger('apns_worker')
         logger.setLevel(logging.WARNING)
         logger.addHandler(logging.StreamHandler())
 
     def setUp(self):
-        super(BackendTestCase, self).setUp()
+        super(BackendTestBase, self).setUp()
 
         self._connection_patch = mock.patch('apns_worker.backend.threaded._new_connection', self.new_connection)
         self._connection_patch.start()
@@ -60,11 +63,117 @@ class BackendTestCase(unittest.TestCase):
         self._connection_patch.stop()
         del self._connection_patch
 
-        super(BackendTestCase, self).tearDown()
+        super(BackendTestBase, self).tearDown()
 
+    #
+    # Hooks
+    #
+
+    def new_connection(self, *args, **kwargs):
+        connection = TestConnection(self, self.connection_inbuf)
+        self.connections.append(connection)
+
+        return connection
+
+    def handle_error(self, error):
+        self.apns_error = error
+
+    def handle_feedback(self, feedback):
+        self.feedbacks.append(feedback)
+
+    #
+    # State
+    #
+
+    @property
+    def apns(self):
+        if self._apns is None:
+            self._apns = ApnsManager(
+                'key-path', 'cert-path',
+                backend_path='apns_worker.backend.threaded.Backend',
+                message_grace=0.5, error_handler=self.handle_error
+            )
+
+        return self._apns
+
+    @property
+    def connection(self):
+        return self.connections[-1] if len(self.connections) > 0 else None
+
+    @property
+    def connections_opened(self):
+        return len([c for c in self.connections if c.is_opened])
+
+    @property
+    def connections_closed(self):
+        return len([c for c in self.connections if c.is_closed])
+
+    @property
+    def sent_tokens(self):
+        """ Tokens of send frames, in order. """
+        return [frame.token for frame in self.sent_frames]
+
+    @property
+    def sent_idents(self):
+        """ Idents of sent frames, in order. """
+        return [frame.ident for frame in self.sent_frames]
+
+    @property
+    def sent_frames(self):
+        """ All sent frames, in order. """
+        return [frame for connection in self.connections for frame in connection.sent_frames]
+
+
+class BackendTestCase(BackendTestBase):
     def test_wait_for_notification(self):
         self.assertFalse(self.apns._backend.thread.connection.is_opened)
 
+    def test_lazy_start(self):
+        self._apns = ApnsManager('key-path', 'cert-path', message_grace=0.5, lazy_start=True)
+
+        self.assertEqual(self.apns._backend.thread, None)
+
+        self.apns.send_message(Message([_token1], {}))
+        sleep(0.1)
+
+        self.assertTrue(self.apns._backend.thread.is_alive())
+        self.assertEqual(self.sent_tokens, [_token1])
+
+    def test_restart_after_fork(self):
+        old_backend = self.apns._backend
+        old_queue = self.apns._queue
+        old_backend.stop()
+        self.apns.send_message(Message([_token1], {}))
+
+        with mock.patch('apns_worker.fork.current_pid', lambda: -1):
+            self.apns.send_message(Message([_token2], {}))
+            sleep(0.1)
+
+        self.assertFalse(self.apns._backend is old_backend)
+        self.assertEqual(old_queue._len(), 1)
+        self.assertEqual(self.sent_tokens, [_token2])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "Requires os.fork.")
+    def test_fork(self):
+        self.apns.send_message(Message([_token1], {}))
+        sleep(0.1)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.apns.send_message(Message([_token2], {}))
+                sleep(0.1)
+                if self.sent_tokens == [_token1, _token2] and len(self.connections) == 2:
+                    status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.sent_tokens, [_token1])
+
     def test_send_aps(self):
         kwargs = {
             'alert': 'Alert!',
@@ -103,6 +212,15 @@ class BackendTestCase(unittest.TestCase):
 
         self.assertEqual(self.sent_tokens, [_token1, _token2])
 
+    def test_send_messages(self):
+        messages = [Message([token], {'aps': {'badge': 1}}) for token in [_token1, _token2, _token3]]
+        self.apns.send_messages(messages)
+
+        sleep(0.1)
+
+        self.assertEqual(self.sent_tokens, [_token1, _token2, _token3])
+        self.assertEqual(messages[0].delivery().result(timeout=1).delivered, 1)
+
     def test_reject_last(self):
         msg = Message([_token1, _token2], {'aps': {'badge': 1}})
         self.apns.send_message(msg)
@@ -133,6 +251,40 @@ class BackendTestCase(unittest.TestCase):
         self.assertEqual(self.sent_tokens, [_token1, _token2, _token3, _token3])
         self.assertEqual(self.apns_error.status, 1)
 
+    def test_delivery_future(self):
+        msg = Message([_token1, _token2, _token3], {'aps': {'badge': 1}})
+        future = self.apns.send_message(msg)
+
+        sleep(0.1)
+
+        self.connection.set_inbuf(struct.pack('!BBI', 8, 8, self.sent_frames[-2].ident))
+
+        report = future.result(timeout=1)
+
+        self.assertEqual(report.sent, 4)
+        self.assertEqual(report.delivered, 2)
+        self.assertEqual(report.errors, {8: 1})
+
+    def test_callbacks_without_lock(self):
+        lock = self.apns._backend.queue_lock()
+        unlocked = []
+
+        def acquire(acquired):
+            with lock:
+                acquired.set()
+
+        def callback(future):
+            acquired = Event()
+            Thread(target=acquire, args=(acquired,)).start()
+            unlocked.append(acquired.wait(1))
+
+        msg = Message([_token1], {}, expiration=datetime(2015, 1, 1))
+        self.apns.send_message(Message([_token2], {}))
+        self.apns.send_message(msg).add_done_callback(callback)
+        self.apns.flush_messages(timeout=2)
+
+        self.assertEqual(unlocked, [True])
+
     def test_reject_unknown(self):
         msg = Message([_token1, _token2, _token3], {'aps': {'badge': 1}})
         self.apns.send_message(msg)
@@ -163,6 +315,54 @@ class BackendTestCase(unittest.TestCase):
         self.assertEqual(self.sent_tokens, [_token1, _token2, _token3, _token3])
         self.assertEqual(self.apns_error, None)
 
+    def test_requeue_exhausted(self):
+        requeued = []
+
+        def requeue(error):
+            sleep(0.1)
+            requeued.append(error.token)
+            self.apns.send_message(Message([error.token], {}))
+
+        dispatcher = Dispatcher(requeue, max_pending=1, overflow=Dispatcher.BLOCK)
+        self._apns = ApnsManager(
+            'key-path', 'cert-path', message_grace=0.5, max_attempts=1, error_handler=dispatcher
+        )
+
+        tokens = [_token1, _token2, _token3, _token1, _token2]
+        self.apns.send_message(Message(tokens, {'aps': {'badge': 1}}))
+
+        sleep(0.1)
+
+        # Everything after the first is exhausted by the shutdown, which is
+        # more than the dispatcher will hold.
+        self.connection.set_inbuf(struct.pack('!BBI', 8, 10, self.sent_frames[0].ident))
+
+        sleep(1)
+
+        self.assertEqual(requeued, tokens[1:])
+        self.assertEqual(self.sent_tokens, tokens + tokens[1:])
+
+    def test_probe(self):
+        self._apns = ApnsManager(
+            'key-path', 'cert-path', message_grace=60, probe_interval=2,
+            error_handler=self.handle_error
+        )
+        msg = Message([_token1, _token2, _token3], {'aps': {'badge': 1}})
+        self.apns.send_message(msg)
+
+        sleep(0.1)
+
+        self.assertEqual(self.sent_tokens, [_token1, _token2, '', _token3])
+
+        self.connection.set_inbuf(struct.pack('!BBI', 8, 2, self.sent_frames[2].ident))
+
+        sleep(0.1)
+
+        self.assertEqual(self.connections_opened, 2)
+        self.assertEqual(self.sent_tokens, [_token1, _token2, '', _token3, _token3])
+        self.assertEqual(self.apns._queue._len(), 1)
+        self.assertEqual(self.apns_error, None)
+
     def test_read_exc(self):
         msg = Message([_token1], {'aps': {'badge': 1}})
         self.apns.send_message(msg)
@@ -197,9 +397,16 @@ class BackendTestCase(unittest.TestCase):
 
     def test_flush(self):
         self.apns.send_aps([_token1], badge=1)
-        self.apns.flush_messages()
+        result = self.apns.flush_messages()
 
         self.assertTrue(self.apns._queue.is_empty())
+        self.assertTrue(result.complete)
+
+    def test_flush_timeout(self):
+        self.apns.send_aps([_token1], badge=1)
+        result = self.apns.flush_messages(timeout=0.01)
+
+        self.assertEqual(result.pending, 1)
 
     def test_feedback_empty(self):
         self.connection_inbuf = b''
@@ -253,63 +460,87 @@ class BackendTestCase(unittest.TestCase):
         self.assertEqual(self.feedbacks[1].token, _token2)
         self.assertEqual(self.feedbacks[1].when, self._when + timedelta(seconds=1))
 
-    #
-    # Hooks
-    #
+    def test_feedback_batched(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2),
+            self._timestamp + 2, 32, unhexlify(_token3))
+        self.apns.get_feedback(self.handle_feedback, batch_size=2)
 
-    def new_connection(self, *args, **kwargs):
-        connection = TestConnection(self, self.connection_inbuf)
-        self.connections.append(connection)
+        sleep(0.1)
 
-        return connection
+        self.assertEqual(len(self.feedbacks), 2)
+        self.assertEqual([f.token for f in self.feedbacks[0]], [_token1, _token2])
+        self.assertEqual([f.token for f in self.feedbacks[1]], [_token3])
 
-    def handle_error(self, error):
-        self.apns_error = error
+    def test_feedback_lazy(self):
+        self.connection_inbuf = struct.pack('!IH32s', self._timestamp, 32, unhexlify(_token1))
+        self.apns.get_feedback(self.handle_feedback, lazy=True)
 
-    def handle_feedback(self, feedback):
-        self.feedbacks.append(feedback)
+        sleep(0.1)
 
-    #
-    # State
-    #
+        self.assertEqual(len(self.feedbacks), 1)
+        self.assertEqual(self.feedbacks[0].encoded_token, unhexlify(_token1))
+        self.assertEqual(self.feedbacks[0].when, self._when)
 
-    @property
-    def apns(self):
-        if self._apns is None:
-            self._apns = ApnsManager(
-                'key-path', 'cert-path',
-                backend_path='apns_worker.backend.threaded.Backend',
-                message_grace=0.1, error_handler=self.handle_error
-            )
+    def test_feedback_future(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2))
+        future = self.apns.get_feedback(self.handle_feedback)
 
-        return self._apns
+        self.assertEqual(future.result(timeout=1), 2)
+        self.assertEqual(len(self.feedbacks), 2)
 
-    @property
-    def connection(self):
-        return self.connections[-1] if len(self.connections) > 0 else None
+    def test_feedback_future_error(self):
+        self.connection_inbuf = struct.pack('!IH32s', self._timestamp, 32, unhexlify(_token1))
+        future = self.apns.get_feedback(lambda feedback: 1 / 0)
 
-    @property
-    def connections_opened(self):
-        return len([c for c in self.connections if c.is_opened])
+        self.assertTrue(isinstance(future.exception(timeout=1), ZeroDivisionError))
 
-    @property
-    def connections_closed(self):
-        return len([c for c in self.connections if c.is_closed])
+    def test_feedback_dispatcher(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2),
+            self._timestamp + 2, 32, unhexlify(_token3))
 
-    @property
-    def sent_tokens(self):
-        """ Tokens of send frames, in order. """
-        return [frame.token for frame in self.sent_frames]
+        def handle_slowly(feedback):
+            sleep(0.02)
+            self.handle_feedback(feedback)
 
-    @property
-    def sent_idents(self):
-        """ Idents of sent frames, in order. """
-        return [frame.ident for frame in self.sent_frames]
+        dispatcher = Dispatcher(handle_slowly, max_pending=1)
+        self.addCleanup(dispatcher.close)
+        future = self.apns.get_feedback(dispatcher)
 
-    @property
-    def sent_frames(self):
-        """ All sent frames, in order. """
-        return [frame for connection in self.connections for frame in connection.sent_frames]
+        self.assertEqual(future.result(timeout=1), 3)
+        self.assertEqual([f.token for f in self.feedbacks], [_token1, _token2, _token3])
+        self.assertEqual(dispatcher.dropped, 0)
+
+    def test_iter_feedback(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2))
+
+        feedbacks = list(self.apns.iter_feedback())
+
+        self.assertEqual([f.token for f in feedbacks], [_token1, _token2])
+
+    def test_save_feedback(self):
+        self.connection_inbuf = struct.pack(
+            '!IH32sIH32sIH32s',
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp, 32, unhexlify(_token1),
+            self._timestamp + 1, 32, unhexlify(_token2))
+        stream = six.StringIO()
+
+        count = self.apns.save_feedback(NDJSONFeedbackSink(stream, batch_size=2)).result(timeout=1)
+
+        self.assertEqual(count, 3)
+        self.assertEqual([json.loads(line)['token'] for line in stream.getvalue().splitlines()], [_token1, _token2])
 
 
 class TestConnection(Connection):
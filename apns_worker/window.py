@@ -0,0 +1,72 @@
+"""
+Flow control for unconfirmed notifications.
+"""
+from __future__ import unicode_literals, absolute_import
+
+
+class InFlightWindow(object):
+    """
+    Limits the number of unconfirmed notifications on a connection.
+
+    APNs only reports failures, so everything written since the last known-good
+    point is subject to being resent if an error comes back. Bounding the
+    amount of unconfirmed data on the wire bounds the cost of recovering from
+    an error, at the expense of some peak throughput. A notification is
+    considered confirmed once it has been purged from the queue (either after
+    the grace period or by a subsequent error further along).
+
+    Each :class:`~apns_worker.ApnsManager` needs its own instance.
+
+    :param int max_count: The maximum number of unconfirmed notifications
+        (optional).
+    :param int max_bytes: The maximum number of unconfirmed bytes (optional).
+    :param bool adaptive: If `True`, the count limit will be halved every time
+        APNs reports an error and will grow back towards `max_count` as
+        notifications are confirmed. This requires `max_count`.
+    :param int min_count: The smallest limit that adaptation will shrink to.
+
+    """
+    def __init__(self, max_count=None, max_bytes=None, adaptive=False, min_count=100):
+        if adaptive and (max_count is None):
+            raise ValueError("An adaptive window requires max_count.")
+
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.adaptive = adaptive
+        self.min_count = min(min_count, max_count) if (max_count is not None) else min_count
+
+        self._count_limit = max_count
+
+    @property
+    def count_limit(self):
+        """ The current limit on unconfirmed notifications. """
+        return self._count_limit
+
+    def is_open(self, count, nbytes):
+        """
+        Returns `True` if another notification may be claimed.
+
+        :param int count: Number of currently unconfirmed notifications.
+        :param int nbytes: Number of currently unconfirmed bytes.
+
+        :rtype: bool
+
+        """
+        if (self._count_limit is not None) and (count >= self._count_limit):
+            return False
+
+        # Always allow at least one notification, whatever its size.
+        if (self.max_bytes is not None) and (count > 0) and (nbytes >= self.max_bytes):
+            return False
+
+        return True
+
+    def record_error(self):
+        """ APNs rejected a notification. """
+        if self.adaptive:
+            self._count_limit = max(self._count_limit // 2, self.min_count)
+
+    def record_success(self, count):
+        """ Some number of notifications were confirmed. """
+        if self.adaptive and (count > 0):
+            self._count_limit = min(self._count_limit + count, self.max_count)
@@ -0,0 +1,6 @@
+"""
+Benchmarks for apns-worker.
+
+Each module can be run directly, e.g. ``python -m benchmarks.feedback``. These
+are not part of the installed package.
+"""
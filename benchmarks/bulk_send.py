@@ -0,0 +1,70 @@
+"""
+Per-message overhead of queueing many small messages.
+
+Compares one :meth:`~apns_worker.queue.NotificationQueue.append` per message
+with a single :meth:`~apns_worker.queue.NotificationQueue.extend_messages`.
+Messages are built up front, so this only measures queueing.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+import os
+from binascii import hexlify
+import time
+
+from apns_worker.apns import Message
+from apns_worker.queue import NotificationQueue
+
+
+def build_messages(count):
+    return [
+        Message([hexlify(os.urandom(32)).decode('ascii')], {'aps': {'alert': "Hi user {0}".format(i)}})
+        for i in range(count)
+    ]
+
+
+def append_each(queue, messages):
+    for message in messages:
+        queue.append(message)
+
+
+def extend_all(queue, messages):
+    queue.extend_messages(messages)
+
+
+def extend_batches(queue, messages, size=1000):
+    for i in range(0, len(messages), size):
+        queue.extend_messages(messages[i:i + size])
+
+
+def run(name, func, count, repeat):
+    best = None
+
+    for i in range(repeat):
+        messages = build_messages(count)
+        queue = NotificationQueue(grace=5)
+
+        start = time.time()
+        func(queue, messages)
+        elapsed = time.time() - start
+
+        best = elapsed if (best is None) else min(best, elapsed)
+
+    print("{0:<24} {1:>8.2f} us/message".format(name, best / count * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{0:,d} single-token messages, best of {1}".format(args.messages, args.repeat))
+
+    run('append', append_each, args.messages, args.repeat)
+    run('extend_messages(all)', extend_all, args.messages, args.repeat)
+    run('extend_messages(1000)', extend_batches, args.messages, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+End-to-end throughput and latency.
+
+Runs :class:`~apns_worker.ApnsManager` against :mod:`apns_worker.simulator`
+over real TLS connections and reports, for each case:
+
+- notifications per second, from the first send until the simulator has
+  accepted everything;
+- p50 and p99 latency from queueing a message to the simulator reading each
+  of its notifications;
+- client CPU time per 1,000 notifications;
+- peak client RSS.
+
+The simulator runs in its own process and each case runs in a fresh client
+process, so CPU and memory figures only cover the library. Results can be
+saved as JSON and compared against a saved baseline::
+
+    python -m benchmarks.e2e --output baseline.json
+    python -m benchmarks.e2e --baseline baseline.json
+
+The comparison exits with status 1 if any metric regressed by more than the
+threshold.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+from collections import OrderedDict
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+from threading import Thread
+import time
+
+
+PAYLOADS = OrderedDict([
+    ('small', {'aps': {'badge': 1}}),
+    ('256B', {'aps': {'alert': 'x' * 228}}),
+    ('2KB', {'aps': {'alert': 'x' * 2020}}),
+])
+
+BASE_CASE = OrderedDict([('payload', 'small'), ('fanout', 1), ('producers', 1), ('connections', 1)])
+
+CASES = OrderedDict([
+    ('base', {}),
+    ('payload-256B', {'payload': '256B'}),
+    ('payload-2KB', {'payload': '2KB'}),
+    ('fanout-100k', {'fanout': 100000}),
+    ('producers-4', {'producers': 4}),
+    ('connections-4', {'connections': 4}),
+    ('producers-4-connections-4', {'producers': 4, 'connections': 4}),
+])
+
+# Metric name -> True if higher is better.
+METRICS = OrderedDict([
+    ('notifications_per_sec', True),
+    ('latency_p50_ms', False),
+    ('latency_p99_ms', False),
+    ('cpu_ms_per_1k', False),
+    ('peak_rss_mb', False),
+])
+
+
+def token(index):
+    return '{0:064x}'.format(index + 1)
+
+
+#
+# Simulator process
+#
+
+def serve(pipe):
+    """ Runs a simulator that timestamps every notification it accepts. """
+    from apns_worker.simulator import Simulator
+
+    class TimingSimulator(Simulator):
+        def __init__(self, *args, **kwargs):
+            super(TimingSimulator, self).__init__(*args, **kwargs)
+            self.arrivals = {}
+
+        def check(self, notification):
+            status = super(TimingSimulator, self).check(notification)
+            if status == 0:
+                self.arrivals[notification.token] = time.time()
+
+            return status
+
+    simulator = TimingSimulator(record=False)
+    simulator.start()
+    pipe.send(tuple(simulator.environment))
+
+    while True:
+        command = pipe.recv()
+        if command is None:
+            break
+
+        expected, timeout = command
+        deadline = time.time() + timeout
+        while (len(simulator.arrivals) < expected) and (time.time() < deadline):
+            time.sleep(0.005)
+
+        pipe.send(simulator.arrivals)
+        simulator.arrivals = {}
+
+    simulator.stop()
+
+
+#
+# Client process
+#
+
+def run_case(environment, params, count, inbox, outbox):
+    """ Sends `count` notifications and reports the results to `outbox`. """
+    from apns_worker import ApnsManager, Environment, Message
+    from apns_worker.simulator import CERT_PATH
+
+    environment = Environment(*environment)
+    payload = PAYLOADS[params['payload']]
+    fanout = min(params['fanout'], count)
+
+    messages = [
+        Message([token(i) for i in range(start, min(start + fanout, count))], payload)
+        for start in range(0, count, fanout)
+    ]
+    queued_at = [None] * len(messages)
+
+    managers = [
+        ApnsManager(CERT_PATH, CERT_PATH, environment=environment, message_grace=5)
+        for i in range(params['connections'])
+    ]
+
+    def produce(worker):
+        for i in range(worker, len(messages), params['producers']):
+            queued_at[i] = time.time()
+            managers[i % len(managers)].send_message(messages[i])
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    producers = [Thread(target=produce, args=(worker,)) for worker in range(params['producers'])]
+    for thread in producers:
+        thread.start()
+    for thread in producers:
+        thread.join()
+
+    # The parent collects the simulator's timestamps once everything is queued.
+    outbox.put('sent')
+    arrivals = inbox.get()
+
+    elapsed = max(arrivals.values()) - start if arrivals else float('nan')
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+
+    for manager in managers:
+        manager._backend.stop()
+
+    latencies = sorted(
+        arrivals[token(i)] - queued_at[i // fanout]
+        for i in range(count) if token(i) in arrivals
+    )
+
+    outbox.put(OrderedDict([
+        ('params', params),
+        ('count', count),
+        ('received', len(arrivals)),
+        ('notifications_per_sec', len(arrivals) / elapsed),
+        ('latency_p50_ms', percentile(latencies, 50) * 1000),
+        ('latency_p99_ms', percentile(latencies, 99) * 1000),
+        ('cpu_ms_per_1k', cpu * 1000 / (count / 1000.0)),
+        ('peak_rss_mb', end_usage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)),
+    ]))
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+#
+# Harness
+#
+
+def run(cases, count, repeat, timeout):
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child,))
+    server.start()
+    environment = parent.recv()
+
+    results = OrderedDict()
+    try:
+        for name, overrides in cases.items():
+            params = OrderedDict(BASE_CASE)
+            params.update(overrides)
+
+            runs = []
+            for i in range(repeat):
+                to_client = multiprocessing.Queue()
+                from_client = multiprocessing.Queue()
+                client = multiprocessing.Process(target=run_case, args=(environment, params, count, to_client, from_client))
+                client.start()
+
+                from_client.get()  # Everything has been queued.
+                parent.send((count, timeout))
+                to_client.put(parent.recv())
+
+                runs.append(from_client.get())
+                client.join()
+
+            results[name] = combine(runs)
+            report(name, results[name])
+    finally:
+        parent.send(None)
+        server.join()
+
+    return results
+
+
+def combine(runs):
+    """ Takes the median of each metric across runs. """
+    result = OrderedDict(runs[0])
+    result['received'] = min(run['received'] for run in runs)
+    for metric in METRICS:
+        result[metric] = percentile(sorted(run[metric] for run in runs), 50)
+
+    return result
+
+
+def report(name, result):
+    print("{0:<28} {1:>10,.0f}/s  p50 {2:>8.2f} ms  p99 {3:>8.2f} ms  {4:>7.1f} ms CPU/1k  {5:>6.1f} MB".format(
+        name, result['notifications_per_sec'], result['latency_p50_ms'], result['latency_p99_ms'],
+        result['cpu_ms_per_1k'], result['peak_rss_mb'],
+    ))
+    if result['received'] < result['count']:
+        print("    only {0:,d} of {1:,d} notifications arrived".format(result['received'], result['count']))
+
+
+def compare(results, baseline, threshold):
+    """ Prints changes against a baseline. Returns the number of regressions. """
+    regressions = 0
+
+    print("\nChanges from baseline (threshold {0:.0%}):".format(threshold))
+    for name, result in results.items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+
+        changes = []
+        for metric, higher_is_better in METRICS.items():
+            old, new = base.get(metric), result[metric]
+            if not old:
+                continue
+
+            change = (new - old) / float(old)
+            regressed = (change < -threshold) if higher_is_better else (change > threshold)
+            regressions += int(regressed)
+            changes.append("{0} {1:+.1%}{2}".format(metric, change, " REGRESSION" if regressed else ""))
+
+        print("{0:<28} {1}".format(name, ", ".join(changes)))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000, help="Notifications per case.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case. Each metric is the median.")
+    parser.add_argument('--case', action='append', choices=list(CASES), help="Run only these cases.")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for each case.")
+    parser.add_argument('--output', help="Save results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare with results saved by --output.")
+    parser.add_argument('--threshold', type=float, default=0.15, help="Relative change that counts as a regression.")
+    args = parser.parse_args()
+
+    cases = OrderedDict((name, CASES[name]) for name in (args.case or CASES))
+
+    print("{0:,d} notifications per case, median of {1}".format(args.count, args.repeat))
+    results = run(cases, args.count, args.repeat, args.timeout)
+
+    document = OrderedDict([
+        ('meta', OrderedDict([
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('count', args.count),
+            ('repeat', args.repeat),
+        ])),
+        ('cases', results),
+    ])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
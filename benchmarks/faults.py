@@ -0,0 +1,226 @@
+"""
+Recovery from APNs errors.
+
+Sends notifications through :class:`~apns_worker.ApnsManager` to
+:mod:`apns_worker.simulator` while the simulator rejects a share of the tokens
+as invalid (status 8) and closes connections for maintenance (status 10) at a
+configurable rate. Every error costs a reconnect and a resend of whatever was
+written after the failed notification, so this measures how well
+:meth:`~apns_worker.queue.NotificationQueue.backtrack` and the read thread
+recover:
+
+- goodput: valid notifications accepted per second;
+- amplification: notifications written per token, counting resends;
+- reconnects: gateway connections beyond the first;
+- time to recover: p50 and p99 from each error response to the next
+  notification the simulator accepts.
+
+Invalid tokens are chosen up front, so a resent invalid token fails again, as
+it would in production. Shutdowns are random per notification. Both are
+seeded, so runs are repeatable::
+
+    python -m benchmarks.faults
+    python -m benchmarks.faults --invalid-rate 0.005 --shutdown-rate 0.0001
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+from collections import OrderedDict
+import json
+import multiprocessing
+import random
+import time
+
+
+PAYLOAD = {'aps': {'badge': 1}}
+
+# Name -> (invalid token rate, shutdown rate).
+CASES = OrderedDict([
+    ('clean', (0, 0)),
+    ('invalid-0.1%', (0.001, 0)),
+    ('invalid-1%', (0.01, 0)),
+    ('shutdown-0.01%', (0, 0.0001)),
+    ('shutdown-0.1%', (0, 0.001)),
+    ('mixed', (0.001, 0.0001)),
+])
+
+
+def token(index):
+    return '{0:064x}'.format(index + 1)
+
+
+#
+# Simulator process
+#
+
+def serve(pipe, errors, shutdown_rate, seed):
+    """ Runs a simulator that injects faults and times recovery. """
+    from apns_worker.simulator import SHUTDOWN, Simulator
+
+    class FaultSimulator(Simulator):
+        def __init__(self, *args, **kwargs):
+            super(FaultSimulator, self).__init__(*args, **kwargs)
+            self.random = random.Random(seed)
+            self.frames = 0
+            self.delivered = set()
+            self.finished = None
+            self.recoveries = []
+            self._failed_at = None
+
+        def check(self, notification):
+            status = super(FaultSimulator, self).check(notification)
+            if (status == 0) and (self.random.random() < shutdown_rate):
+                status = SHUTDOWN
+
+            _now = time.time()
+            with self._lock:
+                self.frames += 1
+
+                if status in [0, SHUTDOWN]:
+                    if notification.token not in self.delivered:
+                        self.delivered.add(notification.token)
+                        self.finished = _now
+                    if (status == 0) and (self._failed_at is not None):
+                        self.recoveries.append(_now - self._failed_at)
+                        self._failed_at = None
+
+                if status != 0:
+                    self._failed_at = _now
+
+            return status
+
+    simulator = FaultSimulator(errors=errors, record=False)
+    simulator.start()
+    pipe.send(tuple(simulator.environment))
+
+    expected, timeout = pipe.recv()
+    deadline = time.time() + timeout
+    while (len(simulator.delivered) < expected) and (time.time() < deadline):
+        time.sleep(0.005)
+
+    with simulator._lock:
+        pipe.send(OrderedDict([
+            ('frames', simulator.frames),
+            ('delivered', len(simulator.delivered)),
+            ('rejected', len(simulator.rejected)),
+            ('connections', simulator.connections),
+            ('finished', simulator.finished),
+            ('recoveries', sorted(simulator.recoveries)),
+        ]))
+
+    simulator.stop()
+
+
+#
+# Client
+#
+
+def run_case(invalid_rate, shutdown_rate, count, fanout, grace, seed, timeout):
+    from apns_worker import ApnsManager, Environment, Message
+    from apns_worker.simulator import CERT_PATH
+
+    rng = random.Random(seed)
+    invalid = set(i for i in range(count) if rng.random() < invalid_rate)
+    errors = dict((token(i), 8) for i in invalid)
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, errors, shutdown_rate, seed))
+    server.start()
+    environment = Environment(*parent.recv())
+
+    failures = []
+    apns = ApnsManager(
+        CERT_PATH, CERT_PATH, environment=environment, message_grace=grace, error_handler=failures.append
+    )
+    messages = [
+        Message([token(i) for i in range(start, min(start + fanout, count))], PAYLOAD)
+        for start in range(0, count, fanout)
+    ]
+
+    try:
+        start = time.time()
+        apns.send_messages(messages)
+        parent.send((count - len(invalid), timeout))
+        stats = parent.recv()
+
+        # Wait out the grace period so that the reports are final.
+        apns.flush_messages(timeout=timeout)
+    finally:
+        apns._backend.stop()
+        server.join()
+
+    reports = [message.report() for message in messages]
+    elapsed = (stats['finished'] - start) if stats['finished'] else float('nan')
+    recoveries = stats['recoveries']
+
+    return OrderedDict([
+        ('invalid_rate', invalid_rate),
+        ('shutdown_rate', shutdown_rate),
+        ('count', count),
+        ('invalid', len(invalid)),
+        ('delivered', stats['delivered']),
+        ('reported_failed', sum(report.failed for report in reports)),
+        ('goodput_per_sec', stats['delivered'] / elapsed),
+        ('amplification', sum(report.sent for report in reports) / float(count)),
+        ('frames_received', stats['frames']),
+        ('errors', stats['rejected']),
+        ('reconnects', stats['connections'] - 1),
+        ('recover_p50_ms', percentile(recoveries, 50) * 1000),
+        ('recover_p99_ms', percentile(recoveries, 99) * 1000),
+    ])
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def report(name, result):
+    print("{0:<18} {1:>10,.0f}/s  x{2:<6.3f} {3:>6,d} reconnects  recover p50 {4:>7.2f} ms  p99 {5:>7.2f} ms".format(
+        name, result['goodput_per_sec'], result['amplification'], result['reconnects'],
+        result['recover_p50_ms'], result['recover_p99_ms'],
+    ))
+
+    expected = result['count'] - result['invalid']
+    if result['delivered'] < expected:
+        print("    only {0:,d} of {1:,d} valid notifications arrived".format(result['delivered'], expected))
+    if result['reported_failed'] != result['invalid']:
+        print("    {0:,d} failures reported for {1:,d} invalid tokens".format(result['reported_failed'], result['invalid']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000, help="Notifications per case.")
+    parser.add_argument('--fanout', type=int, default=1000, help="Tokens per message.")
+    parser.add_argument('--case', action='append', choices=list(CASES), help="Run only these cases.")
+    parser.add_argument('--invalid-rate', type=float, help="Run a single case with this share of invalid tokens.")
+    parser.add_argument('--shutdown-rate', type=float, help="Run a single case with this chance of a shutdown.")
+    parser.add_argument('--grace', type=float, default=1, help="The message grace period in seconds.")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for choosing faults.")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for each case.")
+    parser.add_argument('--output', help="Save results to this JSON file.")
+    args = parser.parse_args()
+
+    if (args.invalid_rate is not None) or (args.shutdown_rate is not None):
+        cases = OrderedDict([('custom', (args.invalid_rate or 0, args.shutdown_rate or 0))])
+    else:
+        cases = OrderedDict((name, CASES[name]) for name in (args.case or CASES))
+
+    print("{0:,d} notifications per case, {1:,d} per message".format(args.count, args.fanout))
+
+    results = OrderedDict()
+    for name, (invalid_rate, shutdown_rate) in cases.items():
+        results[name] = run_case(
+            invalid_rate, shutdown_rate, args.count, args.fanout, args.grace, args.seed, args.timeout
+        )
+        report(name, results[name])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Feedback parsing throughput.
+
+Compares the original parse-and-slice loop with
+:class:`~apns_worker.FeedbackParser` over a synthetic feedback stream, fed in
+chunks the way :class:`~apns_worker.backend.threaded.FeedbackThread` receives
+it.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+import os
+import struct
+import time
+
+from apns_worker.apns import Feedback, FeedbackParser
+
+
+def synthetic_stream(count):
+    """ Builds a feedback stream with `count` random records. """
+    record = struct.Struct('!IH32s')
+    tokens = os.urandom(32 * 1024)
+
+    return b''.join(
+        record.pack(1441065600 + i, 32, tokens[(i % 1024) * 32:(i % 1024 + 1) * 32])
+        for i in range(count)
+    )
+
+
+def chunks(stream, size):
+    for i in range(0, len(stream), size):
+        yield stream[i:i + size]
+
+
+def legacy(stream, chunk_size):
+    """ The original FeedbackThread.read_more/process_buffer loop. """
+    count = 0
+    buf = b''
+
+    for chunk in chunks(stream, chunk_size):
+        buf += chunk
+        feedback, remain = Feedback.parse(buf)
+        while feedback is not None:
+            count += 1
+            feedback, remain = Feedback.parse(remain)
+        buf = remain
+
+    return count
+
+
+def streaming(stream, chunk_size, lazy=False):
+    count = 0
+    parser = FeedbackParser(lazy=lazy)
+
+    for chunk in chunks(stream, chunk_size):
+        parser.feed(chunk)
+        count += len(parser.parse())
+
+    return count
+
+
+def run(name, func, *args):
+    start = time.time()
+    count = func(*args)
+    elapsed = time.time() - start
+
+    print("{0:<24} {1:>10,d} records {2:>8.3f} s {3:>12,.0f} records/s".format(
+        name, count, elapsed, count / elapsed
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--chunk', type=int, default=65536, help="Bytes per simulated recv().")
+    parser.add_argument('--skip-legacy', action='store_true', help="Skip the (slow) original parser.")
+    args = parser.parse_args()
+
+    stream = synthetic_stream(args.records)
+    print("{0:,d} records, {1:,d} bytes, {2:,d} byte chunks".format(args.records, len(stream), args.chunk))
+
+    if not args.skip_legacy:
+        run('Feedback.parse', legacy, stream, args.chunk)
+    run('FeedbackParser', streaming, stream, args.chunk)
+    run('FeedbackParser(lazy)', streaming, stream, args.chunk, True)
+
+
+if __name__ == '__main__':
+    main()
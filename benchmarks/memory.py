@@ -0,0 +1,126 @@
+"""
+Memory footprint of large broadcasts.
+
+Builds a single broadcast :class:`~apns_worker.Message`, queues it and walks
+it through the life of a send, reporting the memory retained per token at
+each stage, as measured by :mod:`tracemalloc`:
+
+- message: the message itself (decoded tokens and payload)
+- queued: after queueing, before anything is claimed
+- claimed: everything claimed, i.e. during the grace window
+- purged: after the grace period, with the message still referenced
+
+The hex tokens passed in are allocated before tracing starts, since the
+caller owns them. The run fails if any stage exceeds its budget, so that
+improvements to the queue stay improvements::
+
+    python -m benchmarks.memory --tokens 5000000 --budget claimed=400
+
+tracemalloc requires Python 3.4 or later.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+from collections import OrderedDict
+import gc
+import json
+import sys
+import tracemalloc
+
+from apns_worker.apns import Message
+from apns_worker.queue import NotificationQueue
+
+
+SIZES = [10000, 100000, 1000000]
+
+STAGES = ['message', 'queued', 'claimed', 'purged']
+
+# Bytes per token, about 10% above what we measure on CPython 3 (64-bit).
+BUDGETS = OrderedDict([
+    ('message', 80),
+    ('queued', 330),
+    ('claimed', 415),
+    ('purged', 85),
+])
+
+
+def measure(count):
+    """ Returns retained bytes per token at each stage. """
+    tokens = ['{0:064x}'.format(i + 1) for i in range(count)]
+    results = OrderedDict()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+
+        def stage(name):
+            gc.collect()
+            results[name] = (tracemalloc.get_traced_memory()[0] - base) / float(count)
+
+        message = Message(tokens, {'aps': {'alert': "Hello", 'badge': 1}})
+        stage('message')
+
+        queue = NotificationQueue(grace=0)
+        queue.append(message)
+        stage('queued')
+
+        while queue.claim() is not None:
+            pass
+        stage('claimed')
+
+        queue.purge_expired()
+        stage('purged')
+
+        results['peak'] = (tracemalloc.get_traced_memory()[1] - base) / float(count)
+    finally:
+        tracemalloc.stop()
+
+    return results
+
+
+def parse_budget(spec):
+    stage, limit = spec.split('=', 1)
+    if stage not in BUDGETS:
+        raise argparse.ArgumentTypeError("Unknown stage {0!r}.".format(stage))
+
+    return stage, float(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tokens', action='append', type=int, help="Broadcast sizes (default: {0}).".format(SIZES))
+    parser.add_argument('--budget', action='append', type=parse_budget, default=[], metavar='STAGE=BYTES',
+                        help="Bytes per token allowed at a stage.")
+    parser.add_argument('--output', help="Save results to this JSON file.")
+    args = parser.parse_args()
+
+    budgets = OrderedDict(BUDGETS)
+    budgets.update(args.budget)
+
+    print("Retained bytes per token")
+    print("{0:>10} {1}".format('tokens', ' '.join('{0:>9}'.format(name) for name in STAGES + ['peak'])))
+
+    results = OrderedDict()
+    failures = []
+    for count in (args.tokens or SIZES):
+        result = results[count] = measure(count)
+        print("{0:>10,d} {1}".format(count, ' '.join('{0:>9.1f}'.format(result[name]) for name in STAGES + ['peak'])))
+
+        for name, limit in budgets.items():
+            if result[name] > limit:
+                failures.append("{0:,d} tokens: {1} {2:.1f} bytes/token exceeds {3:.0f}".format(count, name, result[name], limit))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('budgets', budgets), ('results', results)]), f, indent=2)
+
+    if failures:
+        print("\nOver budget:")
+        for failure in failures:
+            print("    " + failure)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
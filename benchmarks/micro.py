@@ -0,0 +1,284 @@
+"""
+Microbenchmarks for the hot paths.
+
+Times individual operations in isolation, so that a change to one of them can
+be judged without the noise of an end-to-end run:
+
+- :class:`~apns_worker.Message` construction (token decoding and JSON
+  encoding)
+- :meth:`~apns_worker.data.Notification.frame`
+- :class:`~apns_worker.queue.NotificationQueue` operations at a range of
+  queue depths
+- feedback parsing
+- :meth:`~apns_worker.backend.threaded.ReadThread.handle_response_data`
+- the same queue and write paths with :mod:`apns_worker.hooks` disabled and
+  enabled
+
+Every result is reported in microseconds per operation, taking the best of
+several runs. Use ``--filter`` to run a subset::
+
+    python -m benchmarks.micro --filter queue --depth 1000 --depth 1000000
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+from binascii import hexlify
+from collections import OrderedDict
+import json
+import os
+import struct
+import time
+
+from apns_worker.apns import Feedback, FeedbackParser, Message
+from apns_worker.backend import threaded
+from apns_worker.hooks import Hooks
+from apns_worker.queue import NotificationQueue
+
+
+DEPTHS = [1000, 10000, 100000, 1000000]
+
+SMALL_PAYLOAD = {'aps': {'badge': 1}}
+LARGE_PAYLOAD = {
+    'aps': {
+        'alert': {'title': "Order update", 'body': "Your order #12345 has shipped and will arrive on Tuesday."},
+        'badge': 3,
+        'sound': 'default',
+        'category': 'ORDER',
+    },
+    'order': {'id': 12345, 'items': ['Widget', 'Gadget', 'Sprocket'], 'total': '99.95'},
+    'url': 'https://example.com/orders/12345',
+}
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_tokens = {}
+
+
+def tokens(count):
+    """ `count` random hex tokens, cached across benchmarks. """
+    cached = _tokens.get(count)
+    if cached is None:
+        cached = _tokens[count] = [hexlify(os.urandom(32)).decode('ascii') for i in range(count)]
+
+    return cached
+
+
+def timed(func, number, setup=None, repeat=5):
+    """
+    Returns the best time in microseconds per operation.
+
+    `func` is called `number` times per run. If `setup` is given, it's called
+    before each run and its result is passed to `func`.
+
+    """
+    best = None
+
+    for i in range(repeat):
+        arg = setup() if (setup is not None) else None
+        start = _clock()
+        for j in range(number):
+            func(arg)
+        elapsed = _clock() - start
+
+        best = elapsed if (best is None) else min(best, elapsed)
+
+    return best / number * 1e6
+
+
+#
+# Queues
+#
+
+def queue_at(depth, grace=3600, claimed=0, hooks=None):
+    """ A queue with `depth` notifications, `claimed` of which are claimed. """
+    queue = NotificationQueue(grace=grace, hooks=hooks)
+    queue.append(Message(tokens(depth), SMALL_PAYLOAD))
+    for i in range(claimed):
+        queue.claim()
+
+    return queue
+
+
+def feedback_stream(count):
+    record = struct.Struct('!IH32s')
+    raw = os.urandom(32 * 1024)
+
+    return b''.join(record.pack(1441065600 + i, 32, raw[(i % 1024) * 32:(i % 1024 + 1) * 32]) for i in range(count))
+
+
+class _NullConnection(object):
+    def sendall(self, buf):
+        pass
+
+
+class _ErrorBackend(threaded.Backend):
+    """ A threaded backend that's never started. """
+    def __init__(self, queue):
+        super(_ErrorBackend, self).__init__(queue, 'sandbox', None, None, None)
+
+
+#
+# Benchmarks
+#
+
+def bench_message(depths):
+    yield 'Message() 1 token, small payload', timed(lambda _: Message(tokens(1), SMALL_PAYLOAD), 20000)
+    yield 'Message() 1 token, large payload', timed(lambda _: Message(tokens(1), LARGE_PAYLOAD), 20000)
+    yield 'Message() per token, 1000 tokens', timed(lambda _: Message(tokens(1000), SMALL_PAYLOAD), 100) / 1000
+
+
+def bench_frame(depths):
+    small = next(Message(tokens(1), SMALL_PAYLOAD, priority=10).notifications(iter([1])))
+    large = next(Message(tokens(1), LARGE_PAYLOAD, priority=10).notifications(iter([1])))
+
+    yield 'Notification.frame() small', timed(lambda _: small.frame(), 50000)
+    yield 'Notification.frame() large', timed(lambda _: large.frame(), 50000)
+    yield 'Notification.size', timed(lambda _: small.size, 50000)
+
+
+def bench_queue(depths):
+    one = tokens(1)
+
+    for depth in depths:
+        queue = queue_at(depth)
+        yield 'append 1 token @{0}'.format(depth), timed(lambda _: queue.append(Message(one, SMALL_PAYLOAD)), 1000)
+
+        queue = queue_at(depth, claimed=depth // 2)
+
+        def claim_unclaim(_):
+            queue.unclaim(queue.claim())
+
+        yield 'claim+unclaim @{0}'.format(depth), timed(claim_unclaim, 10000)
+        yield 'purge_expired, none due @{0}'.format(depth), timed(lambda _: queue.purge_expired(), 10000)
+
+        samples = max(1, min(100, 100000 // depth))
+
+        yield 'purge_expired, all due @{0} (per item)'.format(depth), timed(
+            lambda q: q.purge_expired(), 1, lambda: queue_at(depth, grace=0, claimed=depth), samples
+        ) / depth
+
+        yield 'backtrack to head @{0}'.format(depth), timed(
+            lambda q: q.backtrack(0, status=8), 1, lambda: queue_at(depth, claimed=depth), samples
+        )
+        yield 'backtrack to tail @{0}'.format(depth), timed(
+            lambda q: q.backtrack(depth - 1, status=8), 1, lambda: queue_at(depth, claimed=depth), samples
+        )
+
+
+def bench_feedback(depths):
+    def legacy(stream):
+        def parse(_):
+            buf = stream
+            while True:
+                feedback, buf = Feedback.parse(buf)
+                if feedback is None:
+                    break
+        return parse
+
+    def parser(stream, lazy):
+        def parse(_):
+            p = FeedbackParser(lazy=lazy)
+            p.feed(stream)
+            p.parse()
+        return parse
+
+    # Feedback.parse() copies the rest of the buffer every time, so keep its
+    # input small.
+    yield 'Feedback.parse loop, 10k records (per record)', timed(legacy(feedback_stream(10000)), 1, repeat=3) / 10000
+
+    stream = feedback_stream(100000)
+    yield 'FeedbackParser, 100k records (per record)', timed(parser(stream, False), 1) / 100000
+    yield 'FeedbackParser lazy, 100k records (per record)', timed(parser(stream, True), 1) / 100000
+
+
+def bench_response(depths):
+    def setup(depth):
+        def build():
+            queue = queue_at(depth, claimed=depth)
+            backend = _ErrorBackend(queue)
+            reader = threaded.ReadThread(backend, 'sandbox', None, None, queue, backend.queue_cond)
+            return reader
+        return build
+
+    for depth in depths:
+        samples = max(1, min(100, 100000 // depth))
+        error = struct.pack('!BBI', 8, 8, depth // 2)
+
+        yield 'handle_response_data, error mid-queue @{0}'.format(depth), timed(
+            lambda reader: reader.handle_response_data(error), 1, setup(depth), samples
+        )
+
+
+def bench_hooks(depths):
+    def noop(*args):
+        pass
+
+    def hooks(enabled):
+        hooks = Hooks()
+        if enabled:
+            for point in Hooks.POINTS:
+                hooks.register(point, noop)
+        return hooks
+
+    def check(_):
+        hook = disabled.claim
+        if hook is not None:
+            hook()
+
+    disabled = hooks(False)
+    yield 'empty call (baseline for the next line)', timed(lambda _: None, 100000)
+    yield 'empty call with a disabled hook check', timed(check, 100000)
+
+    for enabled in [False, True]:
+        label = 'no-op hooks' if enabled else 'no hooks'
+
+        queue = queue_at(10000, claimed=5000, hooks=hooks(enabled))
+
+        def claim_unclaim(_):
+            queue.unclaim(queue.claim())
+
+        yield 'claim+unclaim @10000, {0}'.format(label), timed(claim_unclaim, 10000)
+
+        def writer():
+            queue = queue_at(100000, hooks=hooks(enabled))
+            return threaded.WriteThread(_NullConnection(), queue, queue._backend.queue_lock())
+
+        yield 'WriteThread, one notification, {0}'.format(label), timed(
+            lambda writer: writer.send_more_notifications(), 10000, writer
+        )
+
+
+BENCHMARKS = OrderedDict([
+    ('message', bench_message),
+    ('frame', bench_frame),
+    ('queue', bench_queue),
+    ('feedback', bench_feedback),
+    ('response', bench_response),
+    ('hooks', bench_hooks),
+])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--filter', action='append', choices=list(BENCHMARKS), help="Run only these groups.")
+    parser.add_argument('--depth', action='append', type=int, help="Queue depths (default: {0}).".format(DEPTHS))
+    parser.add_argument('--output', help="Save results to this JSON file.")
+    args = parser.parse_args()
+
+    depths = args.depth or DEPTHS
+    results = OrderedDict()
+
+    for group in (args.filter or BENCHMARKS):
+        print(group)
+        for name, usec in BENCHMARKS[group](depths):
+            results[name] = usec
+            print("    {0:<48} {1:>12.3f} us/op".format(name, usec))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
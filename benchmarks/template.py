@@ -0,0 +1,104 @@
+"""
+Cost of personalized payloads.
+
+Compares one :class:`~apns_worker.Message` per token, each with its own
+rendered payload, with a single :class:`~apns_worker.TemplateMessage`. A
+broadcast of one fixed payload to the same tokens is included for reference.
+Each case builds the messages and renders every frame.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import argparse
+import os
+from binascii import hexlify
+import time
+
+from apns_worker.apns import Message, TemplateMessage
+
+
+TEMPLATE = {
+    'aps': {
+        'alert': {'title': "Order update", 'body': "Hi {name}, your order #{order} has shipped."},
+        'badge': '{badge}',
+        'sound': 'default',
+    },
+    'order': '{order}',
+    'url': 'https://example.com/orders',
+}
+
+
+def build_inputs(count):
+    tokens = [hexlify(os.urandom(32)).decode('ascii') for i in range(count)]
+    values = [{'name': "User {0}".format(i), 'order': 100000 + i, 'badge': i % 10} for i in range(count)]
+
+    return tokens, values
+
+
+def per_token_payload(vals):
+    return {
+        'aps': {
+            'alert': {'title': "Order update", 'body': "Hi {name}, your order #{order} has shipped.".format(**vals)},
+            'badge': vals['badge'],
+            'sound': 'default',
+        },
+        'order': vals['order'],
+        'url': 'https://example.com/orders',
+    }
+
+
+def per_token(tokens, values):
+    frames = []
+    for token, vals in zip(tokens, values):
+        message = Message([token], per_token_payload(vals))
+        frames.extend(notif.frame() for notif in message.notifications())
+
+    return frames
+
+
+def templated(tokens, values):
+    message = TemplateMessage(tokens, TEMPLATE, values)
+
+    return [notif.frame() for notif in message.notifications()]
+
+
+def broadcast(tokens, values):
+    message = Message(tokens, per_token_payload(values[0]))
+
+    return [notif.frame() for notif in message.notifications()]
+
+
+def run(name, func, tokens, values, repeat):
+    best = None
+
+    for i in range(repeat):
+        start = time.time()
+        frames = func(tokens, values)
+        elapsed = time.time() - start
+
+        best = elapsed if (best is None) else min(best, elapsed)
+
+    print("{0:<24} {1:>8.2f} us/token".format(name, best / len(tokens) * 1e6))
+
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tokens, values = build_inputs(args.tokens)
+
+    print("{0:,d} personalized notifications, best of {1}".format(args.tokens, args.repeat))
+
+    run('broadcast', broadcast, tokens, values, args.repeat)
+    expected = run('Message per token', per_token, tokens, values, args.repeat)
+    actual = run('TemplateMessage', templated, tokens, values, args.repeat)
+
+    if actual != expected:
+        raise SystemExit("Frames differ.")
+
+
+if __name__ == '__main__':
+    main()
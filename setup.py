@@ -25,6 +25,7 @@ setup(
 
     install_requires=[
         'six',
+        'futures; python_version < "3.2"',
     ],
     packages=[
         'apns_worker',